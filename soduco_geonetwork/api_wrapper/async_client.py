@@ -0,0 +1,138 @@
+"""Asyncio client to the Geonetwork API
+
+This module requires aiohttp, installed with the "async" extra of this package.
+Its methods mirror the functions of the `dataset` module and return the same decoded json responses,
+so that e.g. `helpers.get_geonetwork_uuid()` can be applied to the result of `upload()`.
+"""
+
+import asyncio
+import base64
+import json
+import xml.etree.ElementTree as ET
+from typing import List, Optional
+from uuid import UUID
+
+try:
+    import aiohttp
+except ImportError:  # pragma: no cover
+    aiohttp = None
+
+from . import config, dataset
+
+
+class AsyncGeoNetworkClient:
+    """Asyncio connection to a Geonetwork instance.
+
+    At most `concurrency` requests are in flight at the same time, they share a pool of kept-alive connections.
+    The client must be used as an async context manager:
+
+        async with AsyncGeoNetworkClient(concurrency=20) as client:
+            await client.log_in(user, password)
+            responses = await asyncio.gather(*(client.upload(xml) for xml in xml_files))
+    """
+
+    def __init__(
+        self,
+        concurrency: int = 10,
+        timeout: tuple = (10, 300),
+        https_verify: bool = True,
+    ) -> None:
+        if aiohttp is None:
+            raise ImportError("AsyncGeoNetworkClient requires aiohttp, install the 'async' extra.")
+        self.concurrency = concurrency
+        self.timeout = aiohttp.ClientTimeout(sock_connect=timeout[0], sock_read=timeout[1])
+        self.https_verify = https_verify
+        self.headers = {"accept": "application/json"}
+        self.session: Optional["aiohttp.ClientSession"] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    async def __aenter__(self) -> "AsyncGeoNetworkClient":
+        connector = aiohttp.TCPConnector(limit=self.concurrency, ssl=None if self.https_verify else False)
+        # Geonetwork instances may be reached by IP address, which the default cookie jar ignores.
+        self.session = aiohttp.ClientSession(
+            connector=connector, timeout=self.timeout, cookie_jar=aiohttp.CookieJar(unsafe=True)
+        )
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    async def close(self) -> None:
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def refresh_headers(self) -> None:
+        """Build the headers sent with every request from the session cookies."""
+        self.headers = {"accept": "application/json"}
+        for cookie in self.session.cookie_jar:
+            if cookie.key == "XSRF-TOKEN":
+                self.headers["X-XSRF-TOKEN"] = cookie.value
+
+    async def request(self, method: str, url: str, headers: Optional[dict] = None, **kwargs):
+        """Send a request with the client headers and return its decoded json body, or None if empty.
+
+        An aiohttp.ClientResponseError is raised on error responses.
+        """
+        headers = {**self.headers, **headers} if headers else self.headers
+        async with self._semaphore:
+            async with self.session.request(method, url, headers=headers, **kwargs) as response:
+                response.raise_for_status()
+                body = await response.read()
+        return decode_json(body)
+
+    async def log_in(self, user: str, password: str) -> "AsyncGeoNetworkClient":
+        """Connect to Geonetwork using the username and password in parameters, see `geonetwork.log_in()`."""
+        await self.request("GET", config.api_route_me)
+        self.refresh_headers()
+        if "X-XSRF-TOKEN" not in self.headers:
+            raise Exception("Could not get a XSRF-TOKEN.")
+
+        credentials = base64.b64encode(f"{user}:{password}".encode("utf8")).decode("ascii")
+        await self.request("GET", config.api_route_me, headers={"Authorization": f"Basic {credentials}"})
+        self.refresh_headers()
+        return self
+
+    async def upload(self, xml: ET.ElementTree) -> dict:
+        """Upload a xml metadata file in the catalog, see `dataset.upload()`."""
+        return await self.request(
+            "PUT",
+            config.api_route_records,
+            params={"uuidProcessing": "NOTHING"},
+            headers={"Content-Type": "application/xml"},
+            data=dataset.upload_payload(xml),
+        )
+
+    async def update(self, uuid_list: List[UUID], edition_location: str, xml_patch: str, mode: str = None) -> dict:
+        """Call the batch_edit API endpoint in geonetwork, see `dataset.update()`."""
+        return await self.update_edits(uuid_list, [dataset.batchedit_edit(edition_location, xml_patch, mode)])
+
+    async def update_edits(self, uuid_list: List[UUID], edits: List[dict]) -> dict:
+        """Call the batch_edit API endpoint in geonetwork with several edits, see `dataset.update_edits()`."""
+        params = [("uuids", str(uuid_)) for uuid_ in uuid_list] + [("updateDateStamp", "true")]
+        return await self.request(
+            "PUT",
+            config.api_route_batchediting,
+            params=params,
+            headers={"Content-Type": "application/json"},
+            data=json.dumps(edits),
+        )
+
+    async def delete(self, uuid_list: List[UUID], backup_records: bool = True) -> dict:
+        """Delete one or more records from their uuid, see `dataset.delete()`."""
+        params = [("uuids", str(uuid_)) for uuid_ in uuid_list] + [("withBackup", str(backup_records).lower())]
+        return await self.request("DELETE", config.api_route_records, params=params)
+
+    async def edit_postponed_values(self, postponed_values: dict, prior_postponed_values: dict) -> List[dict]:
+        """Edit the postponed links of a recently uploaded record, see `dataset.edit_postponed_values()`."""
+        accumulator = dataset.BatchEditAccumulator()
+        dataset.edit_postponed_values(postponed_values, prior_postponed_values, accumulator=accumulator)
+        return await asyncio.gather(
+            *(self.update_edits(uuid_list, edits) for uuid_list, edits in accumulator.pending_requests())
+        )
+
+
+def decode_json(body: bytes):
+    """Decode a json response body"""
+    return json.loads(body) if body else None
@@ -0,0 +1,310 @@
+"""HTTP client to the Geonetwork API
+"""
+
+import email.utils
+import random
+import threading
+import time
+from typing import Optional, Union
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import config
+from .session_cache import SessionCache
+
+# (connect, read) timeouts in seconds
+DEFAULT_TIMEOUT = (10, 300)
+
+
+class RetryPolicy:
+    """When and how long to wait before sending a failed request again.
+
+    Requests failing with a connection error or with one of `statuses` are sent again up to `retries` times,
+    waiting an exponential backoff of `backoff * 2 ** attempt` seconds capped at `max_backoff`,
+    with full jitter, or the delay asked by a Retry-After header.
+    Only requests with one of the idempotent `methods` are retried, unless the caller states otherwise.
+    """
+
+    def __init__(
+        self,
+        retries: int = 3,
+        backoff: float = 0.5,
+        max_backoff: float = 30,
+        jitter: bool = True,
+        statuses: tuple = (429, 502, 503, 504),
+        methods: tuple = ("GET", "HEAD", "OPTIONS", "DELETE"),
+    ) -> None:
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.statuses = frozenset(statuses)
+        self.methods = frozenset(methods)
+
+    def should_retry(self, method: str, attempt: int, response: Optional[requests.Response] = None,
+                     retry: Optional[bool] = None) -> bool:
+        """Tell if a request that failed `attempt + 1` times, with `response` if any, should be sent again"""
+        if attempt >= self.retries:
+            return False
+        if retry is None:
+            retry = method.upper() in self.methods
+        if not retry:
+            return False
+        return response is None or response.status_code in self.statuses
+
+    def delay(self, attempt: int, response: Optional[requests.Response] = None) -> float:
+        """Return the number of seconds to wait before the next attempt"""
+        retry_after = parse_retry_after(response.headers.get("Retry-After")) if response is not None else None
+        if retry_after is not None:
+            return min(retry_after, self.max_backoff)
+        delay = min(self.backoff * 2 ** attempt, self.max_backoff)
+        return random.uniform(0, delay) if self.jitter else delay
+
+
+NO_RETRY = RetryPolicy(retries=0)
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Return the delay in seconds of a Retry-After header, given in seconds or as a HTTP date"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, date.timestamp() - time.time())
+
+
+class RateLimiter:
+    """Token bucket letting through `rate` requests per second on average, with bursts of up to `burst` requests.
+
+    A single limiter can be shared by all the threads sending requests.
+    """
+
+    def __init__(self, rate: float, burst: int = 1) -> None:
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Wait until a request can be sent"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class GeoNetworkClient:
+    """Connection to a Geonetwork instance shared by the functions of the `dataset` module.
+
+    The client owns a `requests.Session` whose connection pool holds up to `pool_size` connections,
+    so that up to `pool_size` concurrent requests reuse kept-alive connections instead of opening new ones.
+    Headers sent with every request, including the CSRF token once logged in, are built once
+    instead of at each call.
+    Failed requests are sent again according to `retry_policy`, and a `rate_limiter` shared between
+    clients or threads bounds the rate of requests sent to the server.
+    """
+
+    def __init__(
+        self,
+        session: Optional[requests.Session] = None,
+        pool_size: int = 10,
+        timeout: Union[float, tuple] = DEFAULT_TIMEOUT,
+        https_verify: bool = True,
+        retry_policy: Optional[RetryPolicy] = None,
+        rate_limiter: Optional[RateLimiter] = None,
+    ) -> None:
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+        self.session = session
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.https_verify = https_verify
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self.rate_limiter = rate_limiter
+        self.credentials = None
+        self.session_cache = None
+        self._local = threading.local()
+        self._session_generation = 0
+        self._auth_lock = threading.Lock()
+        self.headers = {}
+        self.refresh_headers()
+
+    @classmethod
+    def from_session(cls, session: Union["GeoNetworkClient", requests.Session, None]) -> "GeoNetworkClient":
+        """Return `session` if it is a client already, otherwise a client wrapping it."""
+        if isinstance(session, cls):
+            return session
+        return cls(session)
+
+    @property
+    def cookies(self) -> requests.cookies.RequestsCookieJar:
+        return self.session.cookies
+
+    def refresh_headers(self) -> None:
+        """Build the headers sent with every request from the session cookies."""
+        headers = {"accept": "application/json"}
+        token = self.session.cookies.get_dict().get("XSRF-TOKEN")
+        if token:
+            headers["X-XSRF-TOKEN"] = token
+        self.headers = headers
+
+    def log_in(self, user: str, password: str, cache: Optional[SessionCache] = None) -> "GeoNetworkClient":
+        """Connect to Geonetwork using the username and password in parameters.
+        The session then holds a cookie with a CSRF token, which is added to the headers of the next requests.
+
+        Given a `cache`, a session of the same user on the same server cached by a previous log in is reused
+        instead of logging in again. Whenever a request is answered with a 401 or 403 error,
+        the client logs in again once and sends the request again.
+        """
+        self.credentials = (user, password)
+        self.session_cache = cache
+        if cache is not None:
+            cookies = cache.load(config.api_route_me, user)
+            if cookies:
+                self.session.cookies.update(cookies)
+                self.refresh_headers()
+                return self
+
+        self.authenticate()
+        return self
+
+    def authenticate(self) -> None:
+        """Log in with the credentials given to `log_in` and cache the session if a cache was given.
+
+        The cookies of the new session replace those of the previous one in a single assignment,
+        so that requests sent meanwhile by other threads keep the previous session.
+        """
+        user, password = self.credentials
+        self._local.authenticating = True
+        try:
+            response = self.get(config.api_route_me)
+            cookies = response.cookies or {}
+            token = cookies.get("XSRF-TOKEN", None)
+
+            if not token:
+                raise Exception("Could not get a XSRF-TOKEN.")
+
+            response = self.get(
+                config.api_route_me,
+                headers={"X-XSRF-TOKEN": token},
+                auth=(user, password),
+                cookies=cookies,
+                allow_redirects=True,
+            )
+        finally:
+            self._local.authenticating = False
+
+        # Swap in session cookies updated with the cookie holding the CSRF TOKEN
+        cookies = self.session.cookies.copy()
+        cookies.update(requests.utils.dict_from_cookiejar(response.cookies))
+        self.session.cookies = cookies
+        self.refresh_headers()
+        self._session_generation += 1
+        if self.session_cache is not None:
+            self.session_cache.save(config.api_route_me, user, self.session.cookies)
+
+    def reauthenticate(self, generation: int) -> None:
+        """Log in again, unless another thread did since the session `generation` was used.
+
+        Threads whose request was denied while another thread logs in wait for it, then use its session.
+        """
+        with self._auth_lock:
+            if generation != self._session_generation:
+                return
+            if self.session_cache is not None:
+                self.session_cache.delete(config.api_route_me, self.credentials[0])
+            self.authenticate()
+
+    def request(self, method: str, url: str, headers: Optional[dict] = None, retry: Optional[bool] = None,
+                **kwargs) -> requests.Response:
+        """Send a request with the client headers and timeouts, raise an HTTPError on error responses.
+
+        Failed requests are sent again if the retry policy allows it. `retry` overrides whether the request
+        is safe to send again, which by default depends on its method.
+        A request answered with a 401 or 403 error is sent again once after logging in again.
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        kwargs.setdefault("verify", self.https_verify)
+        extra_headers = headers
+
+        bodies = rewindable_bodies(kwargs)
+        attempt = 0
+        # Requests sent by a log in are not retried after another log in, those of other threads are
+        reauthenticated = self.credentials is None or getattr(self._local, "authenticating", False)
+        while True:
+            generation = self._session_generation
+            headers = {**self.headers, **extra_headers} if extra_headers else self.headers
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            try:
+                response = self.session.request(method, url, headers=headers, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if not self.retry_policy.should_retry(method, attempt, retry=retry):
+                    raise
+                response = None
+            else:
+                if response.status_code in (401, 403) and not reauthenticated:
+                    reauthenticated = True
+                    self.reauthenticate(generation)
+                    rewind(bodies)
+                    continue
+                if response.ok or not self.retry_policy.should_retry(method, attempt, response, retry):
+                    response.raise_for_status()
+                    return response
+
+            time.sleep(self.retry_policy.delay(attempt, response))
+            attempt += 1
+            rewind(bodies)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def put(self, url: str, **kwargs) -> requests.Response:
+        return self.request("PUT", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def delete(self, url: str, **kwargs) -> requests.Response:
+        return self.request("DELETE", url, **kwargs)
+
+    def close(self) -> None:
+        self.session.close()
+
+    def __enter__(self) -> "GeoNetworkClient":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def rewind(bodies: list) -> None:
+    for body, position in bodies:
+        body.seek(position)
+
+
+def rewindable_bodies(kwargs: dict) -> list:
+    """Return the file objects sent as body of a request with their position, to rewind them before a retry"""
+    candidates = [kwargs.get("data")]
+    for value in (kwargs.get("files") or {}).values():
+        candidates.append(value[1] if isinstance(value, tuple) else value)
+    return [(body, body.tell()) for body in candidates if hasattr(body, "seek") and hasattr(body, "tell")]
@@ -0,0 +1,194 @@
+"""Helpers to run API calls concurrently
+"""
+
+import math
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Iterator, Optional, Union
+
+import requests
+
+# Result of a call that raised an exception, yielded instead of raising so that other calls can go on.
+Failure = namedtuple("Failure", ["error"])
+
+# State of an AdaptiveLimit: allowed and current calls in flight, and p95 of the recent call latencies in seconds.
+LimitStats = namedtuple("LimitStats", ["limit", "in_flight", "p95_latency"])
+
+
+class AdaptiveLimit:
+    """Number of calls allowed in flight, adapted to the server health with AIMD.
+
+    Each successful call raises the limit by `increase / limit`, i.e. by `increase` once a whole window of
+    calls succeeded. A call failing with a server overload (5xx or 429 response, timeout, connection error),
+    or a p95 of the last `window` latencies above `latency_tolerance` times the long-term average latency,
+    multiplies the limit by `decrease`. The limit is decreased at most once per round trip: calls started
+    before the last decrease do not decrease it again.
+
+    `on_change(stats, reason)` is called whenever the integer limit changes.
+    """
+
+    def __init__(
+        self,
+        initial: int = 4,
+        minimum: int = 1,
+        maximum: int = 64,
+        increase: float = 1.0,
+        decrease: float = 0.5,
+        window: int = 20,
+        latency_tolerance: float = 2.0,
+        on_change: Optional[Callable[[LimitStats, str], None]] = None,
+    ) -> None:
+        if not 1 <= minimum <= initial <= maximum:
+            raise ValueError("limits must verify 1 <= minimum <= initial <= maximum")
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        self.on_change = on_change
+        self._limit = float(initial)
+        self._in_flight = 0
+        self._latencies = deque(maxlen=window)
+        self._average_latency = None
+        self._decreased_at = -math.inf
+        self._condition = threading.Condition()
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    @property
+    def p95_latency(self) -> Optional[float]:
+        with self._condition:
+            return percentile(self._latencies, 0.95)
+
+    def stats(self) -> LimitStats:
+        with self._condition:
+            return LimitStats(self.limit, self._in_flight, percentile(self._latencies, 0.95))
+
+    def acquire(self) -> float:
+        """Wait until a call can start and return its start time"""
+        with self._condition:
+            while self._in_flight >= self.limit:
+                self._condition.wait()
+            self._in_flight += 1
+        return time.monotonic()
+
+    def release(self, started: float, overloaded: bool = False) -> None:
+        """Record the end of a call started at `started` and adapt the limit"""
+        now = time.monotonic()
+        latency = now - started
+        with self._condition:
+            self._in_flight -= 1
+            previous = self.limit
+            self._latencies.append(latency)
+            p95 = percentile(self._latencies, 0.95)
+            slow = (
+                self._average_latency is not None
+                and len(self._latencies) == self._latencies.maxlen
+                and p95 > self.latency_tolerance * self._average_latency
+            )
+            self._average_latency = latency if self._average_latency is None else (
+                0.95 * self._average_latency + 0.05 * latency
+            )
+
+            reason = None
+            if overloaded or slow:
+                if started > self._decreased_at:
+                    self._limit = max(self.minimum, self._limit * self.decrease)
+                    self._decreased_at = now
+                    reason = "server error" if overloaded else "latency increase"
+            else:
+                self._limit = min(self.maximum, self._limit + self.increase / self._limit)
+                reason = "healthy responses"
+            changed = self.limit != previous
+            stats = LimitStats(self.limit, self._in_flight, p95)
+            self._condition.notify_all()
+
+        if changed and self.on_change is not None:
+            self.on_change(stats, reason)
+
+    def call(self, function: Callable[[Any], Any], item: Any, started: float) -> tuple:
+        """Like `call`, releasing the slot acquired at `started` once done"""
+        result = call(function, item)
+        self.release(started, isinstance(result[1], Failure) and is_overload(result[1].error))
+        return result
+
+
+def is_overload(error: Exception) -> bool:
+    """Tell if an error means that the server is overloaded"""
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code >= 500 or error.response.status_code == 429
+    return False
+
+
+def percentile(values: Iterable[float], fraction: float) -> Optional[float]:
+    """Return the `fraction` percentile of `values`, or None if there are none"""
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, math.ceil(fraction * len(values)) - 1)]
+
+
+def map_concurrently(
+    function: Callable[[Any], Any], items: Iterable, concurrency: Union[int, AdaptiveLimit] = 1
+) -> Iterator:
+    """Apply `function` to each item with up to `concurrency` calls in flight and yield
+    `(item, result)` pairs in the order of `items`.
+
+    An exception raised by a call is yielded as a `Failure` instead of being raised.
+    Items are consumed lazily, at most 2 * `concurrency` calls are pending at any time.
+    Given an `AdaptiveLimit`, the number of calls in flight follows the limit, up to its maximum.
+    """
+    if isinstance(concurrency, AdaptiveLimit):
+        yield from map_adaptively(function, items, concurrency)
+        return
+
+    if concurrency <= 1:
+        for item in items:
+            yield call(function, item)
+        return
+
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        in_flight = deque()
+        while True:
+            for item in items:
+                in_flight.append(executor.submit(call, function, item))
+                if len(in_flight) >= concurrency * 2:
+                    break
+            if not in_flight:
+                break
+            yield in_flight.popleft().result()
+
+
+def map_adaptively(function: Callable[[Any], Any], items: Iterable, limit: AdaptiveLimit) -> Iterator:
+    """`map_concurrently` with the number of calls in flight set by `limit`"""
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=limit.maximum) as executor:
+        in_flight = deque()
+        while True:
+            for item in items:
+                started = limit.acquire()
+                in_flight.append(executor.submit(limit.call, function, item, started))
+                if len(in_flight) >= limit.maximum * 2:
+                    break
+            if not in_flight:
+                break
+            yield in_flight.popleft().result()
+
+
+def call(function: Callable[[Any], Any], item: Any) -> tuple:
+    """Return `item` and `function(item)`, or a `Failure` if it raised an exception"""
+    try:
+        return item, function(item)
+    except Exception as e:
+        return item, Failure(e)
@@ -11,3 +11,4 @@ config = {
 api_route_me = config["GEONETWORK"] + config["API_PATH"] + "/me"
 api_route_records = config["GEONETWORK"] + config["API_PATH"] + "/records"
 api_route_batchediting = api_route_records + "/batchediting"
+api_route_search = config["GEONETWORK"] + config["API_PATH"] + "/search/records/_search"
@@ -7,31 +7,40 @@
 """
 
 import json
+import os
+import tempfile
 import xml.etree.ElementTree as ET
-from typing import List
+import xml.parsers.expat
+import zipfile
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator, List, Optional, Sequence, Union
 from uuid import UUID
 
 import requests
 
-from . import config, helpers, xml_composers
+from . import config, helpers, xml_composers, xml_diff
+from .client import GeoNetworkClient
+from .record_cache import RecordCache
+
+# Functions of this module accept either a GeoNetworkClient, usually returned by `geonetwork.log_in()`,
+#  or a logged in requests.Session.
+Session = Union[GeoNetworkClient, requests.Session]
 
 # region DELETE
 
 
 def delete(
     uuid_list: List[UUID],
-    session: requests.Session = requests.session(),
+    session: Session = None,
     backup_records: bool = True,
 ):
     """delete one or more records from their uuid"""
     # TODO : ensure that the session is "logged in" ?
-    token = session.cookies.get_dict().get("XSRF-TOKEN")
-    headers = {"X-XSRF-TOKEN": token, "accept": "application/json"}
+    client = GeoNetworkClient.from_session(session)
     params = {"uuids": uuid_list, "withBackup": backup_records}
 
-    response = session.delete(config.api_route_records, headers=headers, params=params)
-    response.raise_for_status()
-    return response
+    return client.delete(config.api_route_records, params=params)
 
 
 # endregion
@@ -39,25 +48,218 @@ def delete(
 # region UPLOAD
 
 
-def upload(xml: ET.ElementTree, session: requests.Session = requests.Session()):
-    """Upload a xml metadata file in the catalog and return its UUID"""
+def upload(xml: ET.ElementTree, session: Session = None, uuid_processing: str = "NOTHING"):
+    """Upload a xml metadata file in the catalog and return its UUID
+
+    With `uuid_processing` set to "OVERWRITE", a record already in the catalog with the same uuid is replaced.
+    """
     # TODO : ensure that the session is "logged in" ?
-    token = session.cookies.get_dict().get("XSRF-TOKEN")
+    client = GeoNetworkClient.from_session(session)
+
+    headers = {"Content-Type": "application/xml"}
+    payload = upload_payload(xml)
+    # A record is replaced with uuidProcessing=OVERWRITE, so the upload is safe to retry. It is not with NOTHING:
+    #  if the server imported the record before the connection failed, the retry is rejected as a duplicate
+    #  and the upload reported as failed although the record is in the catalog.
+    return client.put(
+        config.api_route_records, params={"uuidProcessing" : uuid_processing}, headers=headers, data=payload,
+        retry=True,
+    )
+
+
+def upload_file(xml_file: str, session: Session = None, check_xml: bool = False, uuid_processing: str = "NOTHING"):
+    """Upload a xml metadata file in the catalog as it is on disk and return its UUID
+
+    The file is streamed without being parsed. With `check_xml`, it is first read once by a non-validating
+    parser, which raises a `xml.parsers.expat.ExpatError` if the file is not well-formed.
+    """
+    client = GeoNetworkClient.from_session(session)
+
+    headers = {"Content-Type": "application/xml"}
+    with open(xml_file, "rb") as payload:
+        if check_xml:
+            check_well_formed(payload)
+            payload.seek(0)
+        # Retried as in upload(), a record imported by a failed attempt makes a NOTHING retry fail
+        return client.put(
+            config.api_route_records, params={"uuidProcessing" : uuid_processing}, headers=headers, data=payload,
+            retry=True,
+        )
+
 
+def check_well_formed(file) -> None:
+    """Parse a binary file object without building a tree, raise an `ExpatError` if it is not well-formed"""
+    parser = xml.parsers.expat.ParserCreate()
+    parser.ParseFile(file)
+
+
+def upload_payload(xml: ET.ElementTree) -> str:
+    """Return the body of an upload request for a xml metadata file"""
     for namespace, uri in xml_composers.NAMESPACES.items():
         ET.register_namespace(namespace, uri)
-    xml_string = helpers.xml_to_utf8string(xml)
+    return helpers.xml_to_utf8string(xml)
+
+
+# endregion
+
+# region FETCH
+
+
+def fetch(uuid_: UUID, session: Session = None, cache: RecordCache = None) -> Optional[bytes]:
+    """Return the xml document of a record of the catalog, or None if there is no record with this uuid
+
+    Given a `cache`, a record already cached is only transferred again if the server tells it changed,
+    according to its ETag or Last-Modified headers.
+    """
+    client = GeoNetworkClient.from_session(session)
+    headers = {"accept": "application/xml"}
+    if cache is not None:
+        headers.update(cache.validators(uuid_))
+    try:
+        response = client.get(f"{config.api_route_records}/{uuid_}/formatters/xml", headers=headers)
+    except requests.HTTPError as error:
+        if error.response is not None and error.response.status_code == 404:
+            if cache is not None:
+                cache.delete(uuid_)
+            return None
+        raise
+
+    if cache is None:
+        return response.content
+    if response.status_code == 304:
+        return cache.load(uuid_)
+    cache.save(uuid_, response.content, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+    return response.content
 
-    headers = {
-        "X-XSRF-TOKEN": token,
-        "accept": "application/json",
-        "Content-Type": "application/xml",
+
+# endregion
+
+# region SEARCH
+
+
+def search(
+    query: Optional[dict] = None,
+    fields: Sequence[str] = ("uuid",),
+    page_size: int = 500,
+    session: Session = None,
+    sort: Optional[list] = None,
+) -> Iterator[dict]:
+    """Yield the hits of a search in the catalog, as returned by its Elasticsearch search endpoint
+
+    :param dict query: an Elasticsearch query, all the records by default
+    :param fields: the fields of the records returned in the "_source" of each hit
+    :param int page_size: the number of hits requested at once
+    :param list sort: the sort of the hits, which must be unique for each record, by uuid by default
+
+    Pages are requested with `search_after`, given the sort values of the last hit of the previous page,
+    the next page being requested while the current one is consumed. The default sort is on the `uuid`
+    keyword field, as sorting on `_id` needs fielddata, disabled by Elasticsearch 8.
+    """
+    client = GeoNetworkClient.from_session(session)
+    body = {
+        "query": query or {"match_all": {}},
+        "size": page_size,
+        "sort": sort or [{"uuid": "asc"}],
+        "_source": {"includes": list(fields)},
+        "track_total_hits": False,
     }
-    payload = xml_string
-    response = session.put(config.api_route_records, params={"uuidProcessing" : "NOTHING"}, headers=headers, data=payload)
-    response.raise_for_status()
 
-    return response
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        page = executor.submit(search_page, body, client)
+        while True:
+            hits = page.result()
+            if len(hits) == page_size:
+                page = executor.submit(search_page, {**body, "search_after": hits[-1]["sort"]}, client)
+            yield from hits
+            if len(hits) < page_size:
+                return
+
+
+def search_page(body: dict, session: Session = None) -> List[dict]:
+    """Return the hits of one page of search results"""
+    client = GeoNetworkClient.from_session(session)
+    headers = {"Content-Type": "application/json"}
+    # A search changes nothing, hence it is safe to retry
+    response = client.post(config.api_route_search, headers=headers, data=json.dumps(body), retry=True)
+    return response.json()["hits"]["hits"]
+
+
+def hit_uuid(hit: dict) -> str:
+    """Return the uuid of the record of a search hit"""
+    return hit.get("_source", {}).get("uuid") or hit["_id"]
+
+
+# endregion
+
+# region BULK UPLOAD
+
+# Archives up to this size are built in memory, larger ones are spooled to a temporary file
+ARCHIVE_SPOOL_SIZE = 32 * 1024 * 1024
+
+
+def upload_archive(xml_files: List[str], session: Session = None):
+    """Upload several xml metadata files in the catalog in a single request, packaged as a MEF archive"""
+    client = GeoNetworkClient.from_session(session)
+
+    with tempfile.SpooledTemporaryFile(max_size=ARCHIVE_SPOOL_SIZE) as archive:
+        write_mef_archive(xml_files, archive)
+        archive.seek(0)
+        return client.post(
+            config.api_route_records,
+            params={"metadataType": "METADATA", "uuidProcessing": "NOTHING"},
+            files={"file": ("records.zip", archive, "application/zip")},
+            retry=True,
+        )
+
+
+def write_mef_archive(xml_files: Iterable[str], fileobj) -> None:
+    """Write xml metadata files to `fileobj` as a MEF archive, one `<name>/metadata/metadata.xml` entry per file
+
+    Files are copied into the archive as they are, without being parsed.
+    """
+    with zipfile.ZipFile(fileobj, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for index, xml_file in enumerate(xml_files):
+            name = os.path.splitext(os.path.basename(xml_file))[0] or str(index)
+            archive.write(xml_file, f"{index:06d}_{name}/metadata/metadata.xml")
+
+
+def archive_chunks(items: Iterable, path, max_records: int = 100, max_bytes: int = None) -> Iterator[list]:
+    """Group `items` in chunks of at most `max_records` items whose files weight at most `max_bytes`
+
+    `path(item)` returns the xml file of an item. A file larger than `max_bytes` goes up alone.
+    """
+    chunk, chunk_bytes = [], 0
+    for item in items:
+        size = os.path.getsize(path(item))
+        if chunk and (len(chunk) >= max_records or (max_bytes and chunk_bytes + size > max_bytes)):
+            yield chunk
+            chunk, chunk_bytes = [], 0
+        chunk.append(item)
+        chunk_bytes += size
+    if chunk:
+        yield chunk
+
+
+def record_identifier(xml_file: str) -> str:
+    """Return the metadata identifier of a xml metadata file, reading it only up to that element"""
+    identifier_tag = f"{{{xml_composers.NAMESPACES['mdb']}}}metadataIdentifier"
+    code_tag = f"{{{xml_composers.NAMESPACES['gco']}}}CharacterString"
+    with open(xml_file, "rb") as file:
+        for _, element in ET.iterparse(file):
+            if element.tag == identifier_tag:
+                code = element.find(f".//{code_tag}")
+                return code.text if code is not None else None
+    return None
+
+
+def imported_uuids(json_response: dict) -> List[UUID]:
+    """Return the uuids of all the records imported according to an import report"""
+    return [
+        info["uuid"]
+        for infos in json_response.get("metadataInfos", {}).values()
+        for info in infos
+        if "uuid" in info
+    ]
 
 
 # endregion
@@ -69,13 +271,13 @@ def update(
     uuid_list: List[UUID],
     edition_location: str,
     xml_patch: str,
-    session: requests.Session = requests.Session(),
+    session: Session = None,
     mode:str = None
 ):
     """
     Call the batch_edit API endpoint in geonetwork.
 
-    :param session requests.Session: the http connexion
+    :param session GeoNetworkClient: the http connexion
     :param List[UUID] uuid_list: list of uuid to edit
     :param str edition_location: xpath of the element to edit
     :param str xml_patch: the xml element to add
@@ -90,6 +292,28 @@ def update(
     }]"
     """
 
+    return update_edits(uuid_list, [batchedit_edit(edition_location, xml_patch, mode)], session)
+
+
+def update_edits(uuid_list: List[UUID], edits: List[dict], session: Session = None):
+    """Call the batch_edit API endpoint in geonetwork with several edits, each applied to all the records
+
+    `edits` is a list of {"xpath", "value"} objects, as returned by `batchedit_edit`.
+    """
+    payload = json.dumps(edits)
+
+    client = GeoNetworkClient.from_session(session)
+    headers = {"Content-Type": "application/json"}
+
+    params = {"uuids": uuid_list, "updateDateStamp": True}
+
+    return client.put(
+        config.api_route_batchediting, headers=headers, params=params, data=payload
+    )
+
+
+def batchedit_edit(edition_location: str, xml_patch: str, mode: str = None) -> dict:
+    """Return a batch_edit object applying `xml_patch` at `edition_location`"""
     # Apparently geonetwork does require le leading dot
     xpath = edition_location#helpers.drop_leading_dot_in_xpath(edition_location)
     # Add the geonetwork tags to the value "patch"
@@ -102,32 +326,165 @@ def update(
         patch = f"<gn_delete>{xml_patch}</gn_delete>"
     elif mode == "REPLACE":
         patch = f"<gn_replace>{xml_patch}</gn_replace>"
-    payload = json.dumps([{"xpath": xpath, "value": patch}])
-    #print(f"update for {','.join(uuid_list)}: {payload}")
-
-    token = session.cookies.get_dict().get("XSRF-TOKEN")
-    headers = {
-        "X-XSRF-TOKEN": token,
-        "accept": "application/json",
-        "Content-Type": "application/json",
-    }
+    return {"xpath": xpath, "value": patch}
 
-    params = {"uuids": uuid_list, "updateDateStamp": True}
 
-    response = session.put(
-        config.api_route_batchediting, headers=headers, params=params, data=payload
-    )
-    response.raise_for_status()
-    return response
+# How a record was brought up to date by `update_record()`: "unchanged", "patch" or "upload",
+#  with the response of the request if one was sent.
+RecordUpdate = namedtuple("RecordUpdate", ["method", "response"])
+
+
+def update_record(
+    uuid_: UUID,
+    xml_file: str,
+    session: Session = None,
+    published: Optional[bytes] = None,
+    ignore: Iterable[str] = (),
+    max_patch_ratio: float = 0.5,
+) -> RecordUpdate:
+    """Bring a published record up to date with a xml file, with the smallest batch edits or a full upload
+
+    The published record is fetched unless given. The edits turning it into the xml file are sent
+    if their payload is smaller than `max_patch_ratio` times the file, otherwise the file replaces the record.
+    Elements whose prefixed tag is in `ignore`, e.g. "mdb:dateInfo", are not compared.
+    """
+    client = GeoNetworkClient.from_session(session)
+    if published is None:
+        published = fetch(uuid_, client)
+
+    edits = None
+    if published is not None:
+        try:
+            edits = xml_diff.diff(published, xml_file, ignore)
+        except xml_diff.UnsupportedDiff:
+            edits = None
+
+    if edits == []:
+        return RecordUpdate("unchanged", None)
+    if xml_diff.prefer_patch(edits, os.path.getsize(xml_file), max_patch_ratio):
+        payload = [batchedit_edit(edit.xpath, edit.value, edit.mode) for edit in edits]
+        return RecordUpdate("patch", update_edits([uuid_], payload, client))
+    return RecordUpdate("upload", upload_file(xml_file, client, uuid_processing="OVERWRITE"))
+
+
+class BatchEditAccumulator:
+    """Collect batch edits per record and send them as multi-edit batch_edit requests.
+
+    Edits added with `add` are kept until `flush`, which sends one request per group of records
+    receiving the same list of edits. Requests hold at most `max_edits` edits, `max_payload_bytes`
+    bytes of payload and `max_uuids` records, longer lists being split across requests.
+    Used as a context manager, the accumulator flushes on exit.
+    """
+
+    def __init__(
+        self,
+        session: Session = None,
+        max_edits: int = 100,
+        max_payload_bytes: int = 1024 * 1024,
+        max_uuids: int = 100,
+    ) -> None:
+        self.session = session
+        self.max_edits = max_edits
+        self.max_payload_bytes = max_payload_bytes
+        self.max_uuids = max_uuids
+        self.edits = {}
+
+    def add(self, uuid_list: List[UUID], edition_location: str, xml_patch: str, mode: str = None) -> None:
+        """Queue an edit of the records in `uuid_list`"""
+        edit = batchedit_edit(edition_location, xml_patch, mode)
+        for uuid_ in uuid_list:
+            self.edits.setdefault(uuid_, []).append(edit)
+
+    def __len__(self) -> int:
+        return sum(len(edits) for edits in self.edits.values())
+
+    def pending_requests(self) -> List[tuple]:
+        """Return the pending edits as (uuid_list, edits) pairs, one per request to send"""
+        groups = {}
+        for uuid_, edits in self.edits.items():
+            key = json.dumps(edits)
+            groups.setdefault(key, (edits, []))[1].append(uuid_)
+
+        requests_ = []
+        for edits, uuid_list in groups.values():
+            for edits_part in self.split_edits(edits):
+                for start in range(0, len(uuid_list), self.max_uuids):
+                    requests_.append((uuid_list[start:start + self.max_uuids], edits_part))
+        return requests_
+
+    def split_edits(self, edits: List[dict]) -> List[List[dict]]:
+        """Split a list of edits in parts bounded by `max_edits` and `max_payload_bytes`"""
+        parts, part, part_bytes = [], [], 2
+        for edit in edits:
+            edit_bytes = len(json.dumps(edit).encode()) + 2
+            if part and (len(part) >= self.max_edits or part_bytes + edit_bytes > self.max_payload_bytes):
+                parts.append(part)
+                part, part_bytes = [], 2
+            part.append(edit)
+            part_bytes += edit_bytes
+        if part:
+            parts.append(part)
+        return parts
+
+    def flush(self) -> List[requests.Response]:
+        """Send the pending edits and return the responses"""
+        requests_ = self.pending_requests()
+        self.edits = {}
+        return [update_edits(uuid_list, edits, self.session) for uuid_list, edits in requests_]
+
+    def __enter__(self) -> "BatchEditAccumulator":
+        return self
+
+    def __exit__(self, exc_type, *exc_info) -> None:
+        if exc_type is None:
+            self.flush()
+
+
+def add_patches(accumulator: BatchEditAccumulator, rows: Iterable[dict], patches: List[dict]) -> None:
+    """Add the patches to the records of `rows`, which have a "geonetwork_uuid" column
+
+    The xpath and value of a patch whose "template" is set are templates formatted with the columns
+    of each row, e.g. "{yaml_identifier}", others are sent as they are.
+    Rows without a geonetwork uuid are skipped.
+    """
+    for row in rows:
+        if not row.get("geonetwork_uuid"):
+            continue
+        for patch in patches:
+            xpath, value = patch["xpath"], patch["value"]
+            if patch.get("template"):
+                xpath, value = xpath.format_map(row), value.format_map(row)
+            accumulator.add([row["geonetwork_uuid"]], xpath, value, patch.get("mode"))
 
 
 def edit_postponed_values(
-    postponed_values: dict, prior_postponed_values: dict, session: requests.Session = requests.Session()
+    postponed_values: dict,
+    prior_postponed_values: dict,
+    session: Session = None,
+    accumulator: BatchEditAccumulator = None,
 ):
-    """Edit the postponed links between recently uploaded records"""
+    """Edit the postponed links between recently uploaded records
+
+    All the links of the record are fixed in a single request. Given an `accumulator`,
+    the edits are added to it instead, to be sent when it is flushed.
+    """
+    if accumulator is None:
+        accumulator = BatchEditAccumulator(GeoNetworkClient.from_session(session))
+        edit_postponed_values(postponed_values, prior_postponed_values, accumulator=accumulator)
+        return accumulator.flush()
+
+    for geonetwork_uuid, xpath, value, mode in postponed_value_edits(postponed_values, prior_postponed_values):
+        accumulator.add([geonetwork_uuid], xpath, value, mode)
+
 
+def postponed_value_edits(postponed_values: dict, prior_postponed_values: dict) -> List[tuple]:
+    """Return the edits fixing the postponed links of a record, as (uuid, xpath, value, mode) tuples
+
+    `postponed_values` hold the geonetwork uuids of the linked records and `prior_postponed_values`
+    the yaml identifiers they replace.
+    """
     geonetwork_uuid = postponed_values["uuid"]
-    #print(f"edit_postponed_values for {geonetwork_uuid}")
+    edits = []
 
     if "associatedResource" in postponed_values.keys():
         for index, associated_ressource in enumerate(postponed_values["associatedResource"]):
@@ -142,24 +499,24 @@ def edit_postponed_values(
             xml_element = builder.compose().find("mri:MD_AssociatedResource", namespaces=xml_composers.NAMESPACES)
             xml_element = ET.tostring(xml_element, encoding="unicode")
             prior_value = prior_postponed_values["associatedResource"][index]["value"]
-            #print(f"associatedResource for {geonetwork_uuid}: {xml_element} with {builder.parent_xpath}")
-            response = update(
-                [geonetwork_uuid], builder.parent_xpath+f"/mri:associatedResource[mri:MD_AssociatedResource/mri:metadataReference/@uuidref='{prior_value}']", xml_element, session, "REPLACE"
-            ).json()
-            print(response)
+            edits.append((
+                geonetwork_uuid,
+                builder.parent_xpath+f"/mri:associatedResource[mri:MD_AssociatedResource/mri:metadataReference/@uuidref='{prior_value}']",
+                xml_element,
+                "REPLACE",
+            ))
 
     if "resourceLineage" in postponed_values.keys():
         for index, resource in enumerate(postponed_values["resourceLineage"]):
-            builder = xml_composers.ResourceLineage(resource)
-            for namespace, uri in xml_composers.NAMESPACES.items():
-                ET.register_namespace(namespace, uri)
-            xml_element = ET.tostring(builder.compose(), encoding="unicode")
             prior_value = prior_postponed_values["resourceLineage"][index]["value"]
-            print(f"resourceLineage for {geonetwork_uuid}: {xml_element} with {builder.parent_xpath}[mrl:source/@uuidref='{prior_value}'] with {resource}")
-            response = update(
-                [geonetwork_uuid], f"{builder.parent_xpath}/mrl:source[@uuidref='{prior_value}']/@uuidref", resource, session, "REPLACE"
-            ).json()
-            print(response)
+            edits.append((
+                geonetwork_uuid,
+                f"{xml_composers.ResourceLineage.parent_xpath}/mrl:source[@uuidref='{prior_value}']/@uuidref",
+                resource,
+                "REPLACE",
+            ))
+
+    return edits
 
 
 # endregion
@@ -13,6 +13,10 @@ import xml.etree.ElementTree as ET
 from typing import List
 from uuid import UUID
 
+import yaml
+
+from .state import StateStore
+
 
 def is_valid_file(parser, arg):
     """
@@ -111,6 +115,8 @@ def get_geonetwork_uuid(json_response: json) -> UUID:
 
     # The key "Id" in "metadaInfos" change for every response, we can't access it directly
     # That's why next(iter(dict)) is needed here.
+    if not json_response.get("metadataInfos"):
+        raise ValueError(f"No record imported according to the response: {json_response}")
     database_record_id = next(iter(json_response["metadataInfos"]))
     geonetwork_uuid = json_response["metadataInfos"][database_record_id][0]["uuid"]
 
@@ -120,45 +126,10 @@ def get_geonetwork_uuid(json_response: json) -> UUID:
 def replace_uuid(csv_file: str, output_file: str):
     """Replace yaml identifier by geonerwork uuid"""
 
-    postponed_list = []
-    fieldnames = [
-        "yaml_identifier",
-        "geonetwork_uuid",
-        "xml_file_path",
-        "postponed_values",
-    ]
-
-    with open(csv_file, encoding="utf8") as csvfile:
-        reader = csv.DictReader(csvfile)
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-
-        for row in reader:
-            postponed_list.append(row)
-
-        for postponed in postponed_list:
-            postponed_values = json.loads(postponed["postponed_values"])
-
-            postponed_values["uuid"] = return_uuid(
-                postponed_list, postponed_values["uuid"]
-            )
-            if "associatedResource" in postponed_values.keys():
-                for index, ressource in enumerate(postponed_values["associatedResource"]):
-                    postponed_values["associatedResource"][index]["value"] = return_uuid(
-                        postponed_list, ressource["value"]
-                    )
-            if "resourceLineage" in postponed_values.keys():
-                for index, ressource in enumerate(postponed_values["resourceLineage"]):
-                    postponed_values["resourceLineage"][index] = return_uuid(
-                        postponed_list, ressource["value"]
-                    )
-            postponed["postponed_values"] = json.dumps(postponed_values)
-
-    with open(output_file, "w", newline="", encoding="utf8") as output_file:
-        writer = csv.DictWriter(output_file, fieldnames=fieldnames)
-
-        writer.writeheader()
-        for row in postponed_list:
-            writer.writerow(row)
+    # References are resolved by indexed lookups in a temporary state store
+    with StateStore() as store:
+        store.import_csv(csv_file)
+        store.export_csv(output_file, resolve=True)
 
 
 # Parcours toute la liste, y a sûrement plus propre comme méthode
@@ -199,3 +170,26 @@ def read_postponed_values(csv_file: str) -> list:
             postponed_list.append(json.loads(row["postponed_values"]))
 
         return postponed_list
+
+
+def read_patch_spec(spec_file: str) -> List[dict]:
+    """Read a list of patches, each with a "xpath", a "value", an optional "mode" and an optional "template"
+    flag, from a yaml or csv file"""
+    with open(spec_file, encoding="utf8") as file:
+        if str(spec_file).endswith(".csv"):
+            patches = list(csv.DictReader(file))
+        else:
+            patches = yaml.safe_load(file)
+            if isinstance(patches, dict):
+                patches = [patches]
+
+    if not isinstance(patches, list) or not patches:
+        raise ValueError(f"{spec_file} does not hold a list of patches")
+    for index, patch in enumerate(patches, start=1):
+        if not isinstance(patch, dict):
+            raise ValueError(f"Patch {index} of {spec_file} is not a mapping: {patch}")
+        if not patch.get("xpath") or "value" not in patch:
+            raise ValueError(f"Patch {index} of {spec_file} needs a xpath and a value: {patch}")
+        patch["mode"] = patch.get("mode") or None
+        patch["template"] = str(patch.get("template") or "").lower() in ("true", "yes", "1")
+    return patches
@@ -0,0 +1,69 @@
+"""On-disk cache of the records fetched from Geonetwork
+"""
+
+import json
+import os
+import threading
+from typing import Optional
+
+
+class RecordCache:
+    """Store fetched records in `folder` as `<uuid>.xml`, with their ETag and Last-Modified in `<uuid>.json`.
+
+    `hits` counts the records revalidated by the server and `misses` the ones transferred.
+    """
+
+    def __init__(self, folder: str) -> None:
+        self.folder = folder
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+
+    def path(self, uuid_: str) -> str:
+        return os.path.join(self.folder, f"{uuid_}.xml")
+
+    def validators(self, uuid_: str) -> dict:
+        """Return the conditional request headers revalidating the cached copy of a record"""
+        if not os.path.exists(self.path(uuid_)):
+            return {}
+        try:
+            with open(os.path.join(self.folder, f"{uuid_}.json"), encoding="utf8") as file:
+                metadata = json.load(file)
+        except (OSError, ValueError):
+            return {}
+        headers = {}
+        if metadata.get("etag"):
+            headers["If-None-Match"] = metadata["etag"]
+        if metadata.get("last_modified"):
+            headers["If-Modified-Since"] = metadata["last_modified"]
+        return headers
+
+    def load(self, uuid_: str) -> Optional[bytes]:
+        """Return the cached copy of a record revalidated by the server"""
+        with self.lock:
+            self.hits += 1
+        with open(self.path(uuid_), "rb") as file:
+            return file.read()
+
+    def save(self, uuid_: str, content: bytes, etag: str = None, last_modified: str = None) -> None:
+        """Cache a record transferred from the server"""
+        with self.lock:
+            self.misses += 1
+        write_atomically(self.path(uuid_), content)
+        metadata = {"etag": etag, "last_modified": last_modified}
+        write_atomically(os.path.join(self.folder, f"{uuid_}.json"), json.dumps(metadata).encode("utf8"))
+
+    def delete(self, uuid_: str) -> None:
+        for path in (self.path(uuid_), os.path.join(self.folder, f"{uuid_}.json")):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def write_atomically(path: str, content: bytes) -> None:
+    temp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(temp_path, "wb") as file:
+        file.write(content)
+    os.replace(temp_path, path)
@@ -0,0 +1,82 @@
+"""On-disk cache of the authenticated Geonetwork sessions
+"""
+
+import hashlib
+import json
+import os
+import time
+from typing import Optional
+
+import requests
+
+
+class SessionCache:
+    """Store the cookies of logged in sessions in `folder`, one file per server and user.
+
+    Files are only readable by their owner. Cached sessions are dropped once older than `max_age` seconds
+    or when one of their cookies expired.
+    """
+
+    def __init__(self, folder: str, max_age: float = 12 * 3600) -> None:
+        self.folder = folder
+        self.max_age = max_age
+
+    def path(self, server: str, user: str) -> str:
+        key = hashlib.sha256(f"{server}\n{user}".encode()).hexdigest()
+        return os.path.join(self.folder, f"{key}.json")
+
+    def load(self, server: str, user: str) -> Optional[requests.cookies.RequestsCookieJar]:
+        """Return the cookies of the cached session of `user` on `server`, or None if there is no valid one"""
+        path = self.path(server, user)
+        try:
+            with open(path, encoding="utf8") as file:
+                entry = json.load(file)
+        except (OSError, ValueError):
+            return None
+
+        now = time.time()
+        if now - entry.get("saved", 0) > self.max_age:
+            self.delete(server, user)
+            return None
+
+        jar = requests.cookies.RequestsCookieJar()
+        for cookie in entry.get("cookies", []):
+            if cookie.get("expires") is not None and cookie["expires"] <= now:
+                self.delete(server, user)
+                return None
+            jar.set(
+                cookie["name"], cookie["value"],
+                domain=cookie.get("domain", ""), path=cookie.get("path", "/"),
+                expires=cookie.get("expires"), secure=cookie.get("secure", False),
+            )
+        return jar
+
+    def save(self, server: str, user: str, cookies: requests.cookies.RequestsCookieJar) -> None:
+        """Cache the cookies of the session of `user` on `server`"""
+        entry = {
+            "saved": time.time(),
+            "cookies": [
+                {
+                    "name": cookie.name,
+                    "value": cookie.value,
+                    "domain": cookie.domain,
+                    "path": cookie.path,
+                    "expires": cookie.expires,
+                    "secure": cookie.secure,
+                }
+                for cookie in cookies
+            ],
+        }
+        os.makedirs(self.folder, mode=0o700, exist_ok=True)
+        path = self.path(server, user)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        descriptor = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(descriptor, "w", encoding="utf8") as file:
+            json.dump(entry, file)
+        os.replace(temp_path, path)
+
+    def delete(self, server: str, user: str) -> None:
+        try:
+            os.remove(self.path(server, user))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,154 @@
+"""SQLite copy of the csv files listing records
+
+The store imports the rows of the csv files exchanged between commands (`yaml_list.csv`) and exports them
+back, with references resolved by a join on indexed yaml identifiers instead of scanning the whole list
+for each of them. The commands keep exchanging csv files, the store is not updated by them.
+"""
+
+import csv
+import json
+import sqlite3
+from typing import Dict, Iterator
+
+CSV_FIELDS = ["yaml_identifier", "geonetwork_uuid", "xml_file_path", "postponed_values"]
+
+# Kinds of postponed references, keys of the postponed values holding lists of references
+REFERENCE_KINDS = ("associatedResource", "resourceLineage")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    position INTEGER PRIMARY KEY,
+    yaml_identifier TEXT NOT NULL,
+    geonetwork_uuid TEXT NOT NULL DEFAULT '',
+    xml_file_path TEXT,
+    postponed_values TEXT
+);
+CREATE INDEX IF NOT EXISTS records_yaml_identifier ON records (yaml_identifier);
+CREATE TABLE IF NOT EXISTS postponed_references (
+    record INTEGER NOT NULL REFERENCES records (position) ON DELETE CASCADE,
+    kind TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    target TEXT,
+    PRIMARY KEY (record, kind, position)
+);
+"""
+
+# The postponed references of all the records, with the geonetwork uuid of the first record
+#  having the referenced yaml identifier, as `helpers.return_uuid` returns, or NULL if there is none
+RESOLVED_REFERENCES = """
+SELECT p.record, p.kind, p.position, t.geonetwork_uuid
+FROM postponed_references p
+LEFT JOIN records t ON t.position = (SELECT MIN(position) FROM records WHERE yaml_identifier = p.target)
+ORDER BY p.record
+"""
+
+
+class StateStore:
+    """Records of csv files kept in a SQLite database, in memory unless a file is given.
+
+    Records keep the order of the csv file they were imported from. Records without a geonetwork uuid
+    have an empty one, as in the csv files.
+    The identifier of a record's postponed values is kept as a reference of kind "uuid",
+    next to the references of `REFERENCE_KINDS`.
+    """
+
+    def __init__(self, path: str = ":memory:") -> None:
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self.connection.executescript(SCHEMA)
+
+    def import_csv(self, csv_file: str) -> int:
+        """Replace the records of the store by the rows of a csv file and return their number"""
+        with open(csv_file, encoding="utf8", newline="") as file, self.connection:
+            self.connection.execute("DELETE FROM records")
+            count = 0
+            for count, row in enumerate(csv.DictReader(file), start=1):
+                self.add_record(row)
+        return count
+
+    def add_record(self, row: dict) -> int:
+        """Add a record from a csv row and return its position"""
+        cursor = self.connection.execute(
+            "INSERT INTO records (yaml_identifier, geonetwork_uuid, xml_file_path, postponed_values)"
+            " VALUES (?, ?, ?, ?)",
+            (row["yaml_identifier"], row.get("geonetwork_uuid") or "", row.get("xml_file_path"),
+             row.get("postponed_values")),
+        )
+        position = cursor.lastrowid
+        postponed_values = json.loads(row["postponed_values"]) if row.get("postponed_values") else {}
+        references = [("uuid", 0, postponed_values["uuid"])] if "uuid" in postponed_values else []
+        references.extend(
+            (kind, index, reference["value"] if isinstance(reference, dict) else reference)
+            for kind in REFERENCE_KINDS
+            for index, reference in enumerate(postponed_values.get(kind, []))
+        )
+        self.connection.executemany(
+            "INSERT INTO postponed_references (record, kind, position, target) VALUES (?, ?, ?, ?)",
+            [(position, *reference) for reference in references],
+        )
+        return position
+
+    def records(self) -> Iterator[dict]:
+        """Yield the records as csv rows, in their order"""
+        for row in self.connection.execute(f"SELECT {', '.join(CSV_FIELDS)} FROM records ORDER BY position"):
+            yield dict(row)
+
+    def status_counts(self) -> Dict[str, int]:
+        """Count the records with a geonetwork uuid as published, the others as built"""
+        return dict(self.connection.execute(
+            "SELECT CASE WHEN geonetwork_uuid != '' THEN 'published' ELSE 'built' END AS status, COUNT(*)"
+            " FROM records GROUP BY status"
+        ).fetchall())
+
+    def unresolved_references(self) -> Iterator[tuple]:
+        """Yield the (yaml identifier, target) pairs of the references to records without a geonetwork uuid"""
+        for row in self.connection.execute(
+            "SELECT r.yaml_identifier, p.target FROM postponed_references p"
+            " JOIN records r ON r.position = p.record"
+            f" WHERE p.kind IN ({', '.join('?' * len(REFERENCE_KINDS))}) AND NOT EXISTS ("
+            "  SELECT 1 FROM records t WHERE t.yaml_identifier = p.target AND t.geonetwork_uuid != ''"
+            " ) ORDER BY p.record, p.kind, p.position",
+            REFERENCE_KINDS,
+        ):
+            yield tuple(row)
+
+    def resolved_records(self) -> Iterator[dict]:
+        """Yield the records as csv rows, with the yaml identifiers of their postponed values replaced
+        by geonetwork uuids, as `helpers.replace_uuid` does"""
+        references = self.connection.execute(RESOLVED_REFERENCES)
+        reference = next(references, None)
+        records = self.connection.execute(
+            f"SELECT position, {', '.join(CSV_FIELDS)} FROM records ORDER BY position"
+        )
+        for record in records:
+            row = {field: record[field] for field in CSV_FIELDS}
+            postponed_values = json.loads(record["postponed_values"])
+            # References are read along with the records, both being sorted by record position
+            while reference is not None and reference["record"] == record["position"]:
+                geonetwork_uuid = reference["geonetwork_uuid"]
+                if reference["kind"] == "uuid":
+                    postponed_values["uuid"] = geonetwork_uuid
+                elif reference["kind"] == "associatedResource":
+                    postponed_values["associatedResource"][reference["position"]]["value"] = geonetwork_uuid
+                else:
+                    postponed_values["resourceLineage"][reference["position"]] = geonetwork_uuid
+                reference = next(references, None)
+            row["postponed_values"] = json.dumps(postponed_values)
+            yield row
+
+    def export_csv(self, csv_file: str, resolve: bool = False) -> None:
+        """Write the records to a csv file, with their postponed values resolved if `resolve` is set"""
+        with open(csv_file, "w", newline="", encoding="utf8") as file:
+            writer = csv.DictWriter(file, fieldnames=CSV_FIELDS)
+            writer.writeheader()
+            writer.writerows(self.resolved_records() if resolve else self.records())
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def __enter__(self) -> "StateStore":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
@@ -0,0 +1,103 @@
+"""Helpers to publish only the records that changed since their last upload
+
+Records are compared through a hash of their canonical form (C14N 2.0), so that formatting changes
+such as indentation or attribute order do not count as changes.
+"""
+
+import csv
+import hashlib
+import io
+import os
+import xml.etree.ElementTree as ET
+from collections import namedtuple
+from typing import Dict, Iterable, Optional, Union
+
+from .xml_diff import clark_tag
+
+STATE_FIELDS = ["yaml_identifier", "geonetwork_uuid", "xml_hash"]
+
+# Rows of a csv listing records, as written by the parse command, sorted by what a sync has to do with them.
+# `removed` holds the state rows of published records missing from the csv.
+SyncPlan = namedtuple("SyncPlan", ["new", "changed", "unchanged", "removed"])
+
+# Elements Geonetwork rewrites when it imports a record, left out when comparing with a published copy.
+SERVER_UPDATED_TAGS = ("mdb:dateInfo",)
+
+
+class HashWriter:
+    """File-like object hashing the text written to it"""
+
+    def __init__(self) -> None:
+        self.hash = hashlib.sha256()
+
+    def write(self, text: str) -> int:
+        self.hash.update(text.encode("utf8"))
+        return len(text)
+
+    def hexdigest(self) -> str:
+        return self.hash.hexdigest()
+
+
+def canonical_hash(xml: Union[str, os.PathLike, bytes], ignore: Iterable[str] = ()) -> str:
+    """Return the sha256 of the canonical form of a xml file, or of a xml document given as bytes
+
+    Whitespace around text is stripped and comments are dropped before hashing, as well as the elements
+    whose prefixed tag, e.g. "mdb:dateInfo", is in `ignore`.
+    """
+    out = HashWriter()
+    exclude_tags = {clark_tag(tag) for tag in ignore} or None
+    source = io.BytesIO(xml) if isinstance(xml, bytes) else os.fspath(xml)
+    ET.canonicalize(from_file=source, out=out, strip_text=True, exclude_tags=exclude_tags)
+    return out.hexdigest()
+
+
+def read_state(state_file: str) -> Dict[str, dict]:
+    """Return the published records of a state file by yaml identifier, or nothing if there is no such file"""
+    if not os.path.exists(state_file):
+        return {}
+    with open(state_file, encoding="utf8", newline="") as file:
+        return {row["yaml_identifier"]: row for row in csv.DictReader(file)}
+
+
+def write_state(state_file: str, state: Dict[str, dict]) -> None:
+    """Write the published records to a state file, replacing it at once"""
+    temp_file = f"{state_file}.tmp"
+    with open(temp_file, "w", encoding="utf8", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=STATE_FIELDS, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(state.values())
+    os.replace(temp_file, state_file)
+
+
+def plan_sync(rows: Iterable[dict], hashes: Dict[str, str], state: Dict[str, dict],
+              remote_hashes: Optional[Dict[str, Optional[str]]] = None) -> SyncPlan:
+    """Sort the rows of a csv listing records by what a sync has to do with them
+
+    `hashes` maps yaml identifiers to the canonical hash of their xml file. A record is unchanged when
+    its hash matches the one in `state`, or, given `remote_hashes`, the hash of the published copy,
+    None meaning that the record is not published. Both sides must be hashed with the same `ignore` list.
+    """
+    plan = SyncPlan([], [], [], [])
+    identifiers = set()
+    for row in rows:
+        identifier = row["yaml_identifier"]
+        identifiers.add(identifier)
+        if remote_hashes is not None:
+            published_hash = remote_hashes.get(identifier)
+        else:
+            published_hash = state.get(identifier, {}).get("xml_hash")
+
+        if published_hash is None:
+            plan.new.append(row)
+        elif published_hash == hashes[identifier]:
+            plan.unchanged.append(row)
+        else:
+            plan.changed.append(row)
+
+    plan.removed.extend(row for identifier, row in state.items() if identifier not in identifiers)
+    return plan
+
+
+def state_row(row: dict, geonetwork_uuid: str, xml_hash: str) -> dict:
+    return {"yaml_identifier": row["yaml_identifier"], "geonetwork_uuid": geonetwork_uuid, "xml_hash": xml_hash}
+
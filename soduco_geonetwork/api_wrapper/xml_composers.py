@@ -1,18 +1,21 @@
 """System module."""
 import collections
+import copy
+import importlib.metadata
+import inspect
 import json
 import os
-import sys
 import uuid
 import warnings
 import re
-from typing import Any, ClassVar, Union
-from collections import defaultdict
+from typing import Any, ClassVar, Iterable, Optional, Union
+from collections import defaultdict, namedtuple
 from lxml import etree as ET
 
 RECORD_DOCUMENT_TEMPLATE_PATH = (
     os.path.dirname(__file__) + "/xmltemplates/dataset_iso19115.xml"
 )
+PARTIALS_FOLDER = os.path.dirname(__file__) + "/../xml/partials"
 
 """
 register_namespaces() method isn't sufficient alone.
@@ -64,6 +67,51 @@ for namespace, uri in NAMESPACES.items():
     ET.register_namespace(namespace, uri)
 
 
+class DocumentTemplateRegistry:
+    """Registry of the base XML documents used by `RecordDocumentBuilder`.
+
+    Each template is parsed once per process and builders receive a deep copy of the parsed tree.
+    Templates can be registered under a name (e.g. "dataset", "service") or referenced directly by path.
+    The modification time of a template file is checked on each access, so that a long-running process
+    picks up edits of the template without having to be restarted.
+    """
+
+    def __init__(self) -> None:
+        self._paths: dict[str, str] = {}
+        self._trees: dict[str, tuple[int, ET._ElementTree]] = {}
+
+    def register(self, name: str, path: str) -> "DocumentTemplateRegistry":
+        """Make the template at `path` available under `name`."""
+        self._paths[name] = path
+        return self
+
+    def names(self) -> list[str]:
+        """Return the names of the registered templates."""
+        return list(self._paths)
+
+    def resolve(self, template: str) -> str:
+        """Return the path of a template given either its registered name or its path."""
+        return self._paths.get(template, template)
+
+    def get(self, template: str) -> ET._ElementTree:
+        """Return a copy of a template document, parsing the file only if it is not cached or has changed."""
+        path = self.resolve(template)
+        mtime = os.stat(path).st_mtime_ns
+
+        cached = self._trees.get(path)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, ET.parse(path))
+            self._trees[path] = cached
+        return copy.deepcopy(cached[1])
+
+    def clear(self) -> None:
+        """Drop every parsed template, registered names are kept."""
+        self._trees.clear()
+
+
+document_templates = DocumentTemplateRegistry().register("dataset", RECORD_DOCUMENT_TEMPLATE_PATH)
+
+
 class RecordDocumentBuilder:
     """Build a Geonetwork record document in XML format.
 
@@ -80,13 +128,22 @@ class RecordDocumentBuilder:
 
     __document_template__: str = RECORD_DOCUMENT_TEMPLATE_PATH
 
-    def __init__(self) -> None:
+    def __init__(self, document_template: Optional[str] = None, resolve_references: bool = False) -> None:
         """Create a new builder.
 
-        At init stage, a builder holds an XML tree loaded from the template document `__document_template__`.
+        At init stage, a builder holds an XML tree copied from the template document `document_template`,
+        which is either a name registered in `document_templates` or a file path.
+        It defaults to `__document_template__`.
+
+        With `resolve_references`, references to other records by yaml identifier are resolved when building,
+        using the uuid that the referenced record gets from its own `Identifier` composer (see `record_uuid()`).
+        Nothing is then deferred to after the upload. The referenced yaml identifiers are listed in `references`,
+        so that the caller can check that the referenced records exist.
         """
+        self.resolve_references = resolve_references
+        self.references = []
         self.deferred_processing = defaultdict(list)
-        self.record_doc = ET.parse(self.__document_template__)
+        self.record_doc = document_templates.get(document_template or self.__document_template__)
         self._composers = []
         self._constructed = False
 
@@ -104,30 +161,36 @@ class RecordDocumentBuilder:
         at this stage but instead requires the record to be pushed to a GeoNetwork instance first.
         Affected composers are then applied and added to the `self.deferred_processing` dictionary,
         making them available for further processing.
+        Records uploaded with `uuidProcessing=NOTHING` keep the uuid derived from their yaml identifier,
+        so a builder created with `resolve_references` resolves such references itself instead.
         """
         if self._constructed:
             raise ValueError("The builder has already been used")
 
         for composer in self._composers:
+            if self.resolve_references and composer.is_deferred_processing():
+                if not is_uuid(composer.deferred_id):
+                    self.references.append(composer.deferred_id)
+                composer.resolve_deferred_id(resolve_reference(composer.deferred_id))
+
             new_element = composer.compose()
 
             # New XML elements can be duplicated and inserted at multiple points
             #  in the xml_document depending on the parent_xpath expression.
-            insertion_points = self.record_doc.xpath(
-                composer.parent_xpath, namespaces=NAMESPACES
-            )
+            # XPath expressions are compiled once per composer class, see `XMLComposer.__init_subclass__()`.
+            insertion_points = composer._parent_xpath(self.record_doc.getroot())
             for point in insertion_points:
                 if composer.before:
-                    subElement = point.find(composer.before, namespaces=NAMESPACES)
+                    subElement = first_match(composer._before_xpath, point)
                     index = point.index(subElement)
                     point.insert(index, new_element)
                 elif composer.after:
-                    subElement = point.find(composer.after, namespaces=NAMESPACES)
+                    subElement = first_match(composer._after_xpath, point)
                     index = point.index(subElement)
                     point.insert(index + 1, new_element)
                 else:
                     point.append(new_element)
-                
+
         self._constructed = True
         return self.get()
 
@@ -159,28 +222,23 @@ class RecordDocumentBuilder:
         #  at a location specified by the composer.
         # Every node will be visited unless one of this node's parent has is mapped to a *leaf* composer.
         # See @Iso19115Element.is_leaf_composer() for more information.
-        stack = [(k, v) for k, v in data_tree.items()]
+        # The stack is a deque whose left end is the top, children are pushed in reverse order
+        #  so that they are visited in document order.
+        stack = collections.deque(data_tree.items())
         while stack:
-            node, subtree = stack.pop(0)
+            node, subtree = stack.popleft()
 
             # Compositing applies to each element of list-like nodes.
             if is_list_like(subtree):
-                stack = [(node, e) for e in subtree] + stack
+                stack.extendleft(reversed([(node, e) for e in subtree]))
                 continue
 
-            # The name of the composer class to instantiate is formed by the current key
-            #  with the first letter capitalized.
-            # We assumes that keys are strings either in PascalCase or CamelCase,
-            #  as classes names usually are in PascalCase.
-            try:
-                composer_cls = str_to_composer_cls(node)
-            except AttributeError:
-                warnings.warn(
-                    f"No XML composer found for the key `{node}` in the module {__name__}. "
-                    f"A class named `{node}` was expected."
-                    f"This is a non-blocking error, compositing can continue but output XML \
-                        might be invalid."
-                )
+            # Composer classes are looked up by key in the composer registry.
+            # By default a composer is registered under its class name, with the first letter
+            #  either lowercase or uppercase, see `register_composer()`.
+            # Unknown keys only trigger a warning the first time they are met.
+            composer_cls = lookup_composer(node)
+            if composer_cls is None:
                 composer = None
             else:
                 composer = composer_cls(subtree)
@@ -191,15 +249,14 @@ class RecordDocumentBuilder:
                 # Because relationships between resources use the resource's uuid assigned by GeoNetwork,
                 #  all documents have to be pushed before their uuids can be retrieved to update the relationships
                 # FIXME: move this in build() or add_composer() ? Problem : we don't know the `node` anymore in build().
-                if composer.is_deferred_processing():
+                if composer.is_deferred_processing() and not self.resolve_references:
                     self.deferred_processing[node].append(composer.parameters)
-            finally:
-                # If the traversed entry is a sub-tree, we want to visit it
-                #  unless the composer takes care of creating XML content for the entire sub-tree.
-                if isinstance(subtree, dict):
-                    if not composer or not composer.is_leaf_composer():
-                        children = [(k, v) for k, v in subtree.items()]
-                        stack = children + stack
+
+            # If the traversed entry is a sub-tree, we want to visit it
+            #  unless the composer takes care of creating XML content for the entire sub-tree.
+            if isinstance(subtree, dict):
+                if not composer or not composer.is_leaf_composer():
+                    stack.extendleft(reversed(subtree.items()))
         return self
 
     def get(self) -> ET._ElementTree:
@@ -220,13 +277,46 @@ def insert_namespace(xml_string: str) -> str:
     return namespaced
 
 
-def load_element_template(cls: str) -> str:
-    here = os.path.dirname(__file__)
-    path = f"{here}/../xml/partials/{cls.__name__.lower()}.xml"
-    with open(path, "r") as t:
+def load_element_template(cls: type) -> str:
+    with open(cls.template_path(), "r") as t:
         return t.read()
 
 
+TemplateCacheInfo = namedtuple("TemplateCacheInfo", ["hits", "misses", "currsize"])
+
+
+def compile_xpath(xpath_expr: str) -> ET.XPath:
+    """Compile an XPath expression using the namespaces of GeoNetwork record documents."""
+    return ET.XPath(xpath_expr, namespaces=NAMESPACES)
+
+
+def first_match(xpath: ET.XPath, element: ET._Element) -> Optional[ET._Element]:
+    """Return the first element matched by a compiled XPath, as `Element.find()` would."""
+    matches = xpath(element)
+    return matches[0] if matches else None
+
+
+def record_uuid(identifier: str) -> str:
+    """Return the uuid of the record with the yaml identifier `identifier`."""
+    return str(uuid.uuid5(uuid.NAMESPACE_X500, identifier))
+
+
+def resolve_reference(reference: str) -> str:
+    """Return the uuid of a referenced record, given either as a uuid or as a yaml identifier."""
+    if is_uuid(reference):
+        return str(uuid.UUID(reference))
+    return record_uuid(reference)
+
+
+def is_uuid(reference: str) -> bool:
+    """Is a reference to a record given as a uuid rather than as a yaml identifier ?"""
+    try:
+        uuid.UUID(reference)
+    except ValueError:
+        return False
+    return True
+
+
 def is_valid_uuid(uuid_: uuid.uuid4):
     try:
         uuid_obj = uuid.UUID(uuid_, version=4)
@@ -235,10 +325,96 @@ def is_valid_uuid(uuid_: uuid.uuid4):
     return str(uuid_obj) == uuid_
 
 
+###
+# Composer registry
+###
+# Record tree keys are mapped to composer classes when the classes are defined.
+# Third-party packages can provide additional composers through the entry point group below,
+#  e.g. in a pyproject.toml:
+#       [tool.poetry.plugins."soduco_geonetwork.composers"]
+#       myElement = "my_package.composers:MyElement"
+# Entry points may reference a composer class, which is then also registered under the entry point name,
+#  or a module, in which case importing the module registers the composers it defines.
+COMPOSER_ENTRY_POINT_GROUP = "soduco_geonetwork.composers"
+
+_composer_registry: dict[str, type] = {}
+_unknown_keys: set[str] = set()
+_plugins_loaded = False
+
+
+def register_composer(composer_cls: type, *aliases: str) -> type:
+    """Register a composer class for its name, its `aliases` class attribute and `aliases`.
+
+    The class name is registered with its first letter both uppercase and lowercase,
+    to accommodate YAML naming conventions.
+    A key already registered is mapped to the new class.
+    """
+    if not issubclass(composer_cls, XMLComposer):
+        raise TypeError(f"{composer_cls} is not a subclass of XMLComposer")
+
+    name = composer_cls.__name__
+    keys = (name, name[0].lower() + name[1:], *composer_cls.aliases, *aliases)
+    for key in keys:
+        _composer_registry[key] = composer_cls
+        _unknown_keys.discard(key)
+    return composer_cls
+
+
+def lookup_composer(tree_node: str) -> Optional[type]:
+    """Return the composer class registered for a record tree node, or None.
+
+    A warning is emitted the first time an unknown node is looked up.
+    """
+    composer_cls = _composer_registry.get(tree_node)
+    if composer_cls is not None or tree_node in _unknown_keys:
+        return composer_cls
+
+    if not _plugins_loaded:
+        load_composer_plugins()
+        composer_cls = _composer_registry.get(tree_node)
+        if composer_cls is not None:
+            return composer_cls
+
+    _unknown_keys.add(tree_node)
+    warnings.warn(
+        f"No XML composer registered for the key `{tree_node}`. "
+        "This is a non-blocking error, compositing can continue but output XML might be invalid."
+    )
+    return None
+
+
+def registered_composers() -> list[type]:
+    """Return the registered composer classes, including the ones provided by plugins."""
+    if not _plugins_loaded:
+        load_composer_plugins()
+    return list(dict.fromkeys(_composer_registry.values()))
+
+
+def load_composer_plugins() -> None:
+    """Import the composers declared in the `soduco_geonetwork.composers` entry point group."""
+    global _plugins_loaded
+    _plugins_loaded = True
+
+    try:
+        plugins = importlib.metadata.entry_points(group=COMPOSER_ENTRY_POINT_GROUP)
+    except TypeError:
+        # Python < 3.10
+        plugins = importlib.metadata.entry_points().get(COMPOSER_ENTRY_POINT_GROUP, [])
+
+    for plugin in plugins:
+        try:
+            loaded = plugin.load()
+        except Exception as e:
+            warnings.warn(f"Could not load the XML composer plugin `{plugin.name}`: {e}")
+            continue
+        if isinstance(loaded, type) and issubclass(loaded, XMLComposer):
+            register_composer(loaded, plugin.name)
+
+
 class XMLComposer:
     template: ClassVar[ET.ElementTree] = ""
     insertion_points: ClassVar[dict[str, Union[str, tuple[str, str]]]] = {}
-    parent_xpath: ClassVar[str] = "./"
+    parent_xpath: ClassVar[str] = "."
     before:ClassVar[str] = None
     after:ClassVar[str] = None
 
@@ -255,19 +431,132 @@ class XMLComposer:
     """
     is_leaf: bool = True
 
+    # Folder holding the XML partial of the composer, named after its class: `{classname}.xml`.
+    # When unset, composers of this module use the partials of this package and composers defined
+    #  elsewhere, e.g. by plugins, the `partials` folder next to their own module.
+    partials_folder: ClassVar[Optional[str]] = None
+
+    # Parsed XML partials are shared by every composer of the same class.
+    # Templates are loaded and namespaced once per process, on first use or when calling
+    #  `XMLComposer.warm_template_cache()`. New composers receive a deep copy of the cached element.
+    _template_cache: ClassVar[dict[type, ET._Element]] = {}
+    _template_cache_hits: ClassVar[int] = 0
+    _template_cache_misses: ClassVar[int] = 0
+
+    # Compiled counterparts of `insertion_points`, `parent_xpath`, `before` and `after`.
+    # They are created when a composer class is defined so that lxml does not have to recompile
+    #  the same expressions for every composer of every record.
+    _insertion_xpaths: ClassVar[dict[str, tuple[ET.XPath, Optional[str]]]] = {}
+    _parent_xpath: ClassVar[ET.XPath] = None
+    _before_xpath: ClassVar[Optional[ET.XPath]] = None
+    _after_xpath: ClassVar[Optional[ET.XPath]] = None
+
+    # Parameter holding the identifier of a referenced record when processing is deferred.
+    deferred_parameter: ClassVar[str] = "value"
+
+    # Additional record tree keys this composer applies to, see `register_composer()`.
+    aliases: ClassVar[tuple[str, ...]] = ()
+
+    def __init_subclass__(cls, register: bool = True, **kwargs) -> None:
+        """Prepare a new composer class.
+
+        Subclasses are added to the composer registry unless they are declared with `register=False`,
+        which is useful for intermediate base classes: `class Base(XMLComposer, register=False)`.
+        """
+        super().__init_subclass__(**kwargs)
+        cls.compile_xpaths()
+        if register:
+            register_composer(cls)
+
+    @classmethod
+    def compile_xpaths(cls) -> None:
+        """Compile the XPath expressions declared by this composer class.
+
+        Must be called again if `insertion_points`, `parent_xpath`, `before` or `after`
+        are modified after the class definition.
+        """
+        insertion_xpaths = {}
+        for k, point in cls.insertion_points.items():
+            # If point is a tuple it means that the insertion point is an attribute.
+            if isinstance(point, tuple):
+                xpath_expr, attr = point
+            else:
+                xpath_expr, attr = point, None
+            insertion_xpaths[k] = (compile_xpath(xpath_expr), attr)
+
+        cls._insertion_xpaths = insertion_xpaths
+        cls._parent_xpath = compile_xpath(cls.parent_xpath)
+        cls._before_xpath = compile_xpath(cls.before) if cls.before else None
+        cls._after_xpath = compile_xpath(cls.after) if cls.after else None
+
     def __new__(cls, *args) -> "XMLComposer":
+        obj = super(XMLComposer, cls).__new__(cls)
+        obj.xml_element = copy.deepcopy(cls.get_template())
+        obj.deferred_id = None
+        obj.parameters = {}
+        return obj
+
+    @classmethod
+    def template_path(cls) -> str:
+        """Return the path of the XML partial of this composer class."""
+        folder = cls.partials_folder
+        if folder is None:
+            if cls.__module__ == __name__:
+                folder = PARTIALS_FOLDER
+            else:
+                folder = os.path.join(os.path.dirname(inspect.getfile(cls)), "partials")
+        return os.path.join(folder, f"{cls.__name__.lower()}.xml")
+
+    @classmethod
+    def get_template(cls) -> ET._Element:
+        """Return the cached XML partial of this composer class, loading it on first use.
+
+        The returned element is shared and must not be modified, use a copy instead.
+        """
+        template = XMLComposer._template_cache.get(cls)
+        if template is not None:
+            XMLComposer._template_cache_hits += 1
+            return template
+
+        XMLComposer._template_cache_misses += 1
         try:
-            template = load_element_template(cls)
-            xml_element = insert_namespace(template)
-            obj = super(XMLComposer, cls).__new__(cls)
-            # print(f"template={template}")
-            # print(f"xml_element={xml_element}")
-            obj.xml_element = ET.fromstring(xml_element)
-            obj.deferred_id = None
-            obj.parameters = {}
-            return obj
+            xml_element = insert_namespace(load_element_template(cls))
         except FileNotFoundError as e:
             raise ValueError(f"Empty XML template for {cls}") from e
+        template = ET.fromstring(xml_element)
+        XMLComposer._template_cache[cls] = template
+        return template
+
+    @staticmethod
+    def warm_template_cache(composers: Optional[Iterable[type]] = None) -> "TemplateCacheInfo":
+        """Eagerly load the XML partials of `composers` (default: every registered composer).
+
+        Loading is otherwise done lazily the first time a composer class is instantiated.
+        Composers without a partial, such as abstract bases, are skipped.
+        """
+        if composers is None:
+            composers = registered_composers()
+        for composer_cls in composers:
+            if composer_cls in XMLComposer._template_cache or not os.path.exists(composer_cls.template_path()):
+                continue
+            composer_cls.get_template()
+        return XMLComposer.template_cache_info()
+
+    @staticmethod
+    def template_cache_info() -> "TemplateCacheInfo":
+        """Report the hits, misses and current size of the template cache."""
+        return TemplateCacheInfo(
+            XMLComposer._template_cache_hits,
+            XMLComposer._template_cache_misses,
+            len(XMLComposer._template_cache),
+        )
+
+    @staticmethod
+    def clear_template_cache() -> None:
+        """Empty the template cache and reset its statistics."""
+        XMLComposer._template_cache.clear()
+        XMLComposer._template_cache_hits = 0
+        XMLComposer._template_cache_misses = 0
 
     def __init__(self, *args) -> None:
         """Create a new GeoNetwork record composer in charge of the generation of a part of a XML record document."""
@@ -275,14 +564,8 @@ class XMLComposer:
 
     def compose(self) -> ET._Element:
         for k, v in self.parameters.items():
-            point = self.insertion_points[k]
-            # If point is a tuple it means that the insertion point is an attribute.
-            if isinstance(point, tuple):
-                xpath_expr, attr = point
-            else:
-                xpath_expr, attr = point, None
-
-            matches = self.xml_element.xpath(xpath_expr, namespaces=NAMESPACES)
+            xpath, attr = self._insertion_xpaths[k]
+            matches = xpath(self.xml_element)
 
             if not matches:
                 raise ValueError(f"Could not locate {k} at {v} in {self}")
@@ -298,6 +581,11 @@ class XMLComposer:
         """Does this composer require post-processing ?"""
         return bool(self.deferred_id)
 
+    def resolve_deferred_id(self, uuid_: str) -> None:
+        """Replace the deferred identifier by the uuid of the referenced record."""
+        self.parameters[self.deferred_parameter] = uuid_
+        self.deferred_id = None
+
     def is_leaf_composer(self) -> bool:
         """Does this composer apply to a whole sub-tree instead of on a single node ?"""
         return self.is_leaf
@@ -325,7 +613,7 @@ class Identifier(XMLComposer):
 
     def __init__(self, record_tree) -> None:
         self.parameters = {
-            "uuid": str(uuid.uuid5(uuid.NAMESPACE_X500, record_tree))
+            "uuid": record_uuid(record_tree)
         }
 
 
@@ -698,25 +986,15 @@ class ProcessStepOutput(XMLComposer):
 ###
 # Helper functions
 ###
-# TODO: the warning is currently raised for elements inside a builder if it has a sub-builder. It shouldn't.
 def str_to_composer_cls(tree_node: str) -> type:
     """Return a composer class for a record tree node.
 
-    This function tries to instanciates a sublclass of Iso19115Element from this module
-    whose name is the same as the YAML key, with the first letter capitalized.
-    An AttributeError is raised if the class does not exist.
+    An AttributeError is raised if no composer is registered for this node.
     """
-    class_name = tree_node[0].upper() + tree_node[1:]
-    class_ = getattr(sys.modules[__name__], class_name)
-
-    if class_ == "Iso19115Element":
-        warnings.warn(
-            f"You tried to create a {class_} object"
-            " but this class is not meant to be instanciated directly.",
-            UserWarning,
-        )
-    assert issubclass(class_, XMLComposer)
-    return class_
+    composer_cls = lookup_composer(tree_node)
+    if composer_cls is None:
+        raise AttributeError(f"No XML composer registered for the key `{tree_node}`")
+    return composer_cls
 
 
 def is_list_like(obj: Any) -> bool:
@@ -0,0 +1,148 @@
+"""Compute the batch edits turning a published record into a freshly built one
+
+Elements are compared recursively. Children are paired by tag and position, elements whose attributes
+or text differ are replaced as a whole, children missing on one side are added or deleted.
+Geonetwork appends added elements after the last child of their parent, so new children are added only
+when they follow all the other children; otherwise their parent is replaced as a whole.
+A subtree is replaced at once whenever that is smaller than the edits of its children.
+"""
+
+import copy
+from collections import namedtuple
+from typing import Iterable, List, Optional, Union
+
+from lxml import etree as ET
+
+from .xml_composers import NAMESPACES
+
+# A batch edit as given to `dataset.update()`: the xpath of the element, its new xml and the edit mode.
+Edit = namedtuple("Edit", ["xpath", "value", "mode"])
+
+PREFIXES = {uri: prefix for prefix, uri in NAMESPACES.items()}
+
+
+class UnsupportedDiff(Exception):
+    """The records can not be turned into each other with batch edits"""
+
+
+def parse(xml: Union[bytes, str, ET._ElementTree, ET._Element]) -> ET._Element:
+    """Return the root element of a document given as bytes, a file path or a tree"""
+    if isinstance(xml, bytes):
+        return ET.fromstring(xml, ET.XMLParser(remove_blank_text=True, remove_comments=True))
+    if isinstance(xml, ET._ElementTree):
+        return xml.getroot()
+    if isinstance(xml, ET._Element):
+        return xml
+    return ET.parse(xml, ET.XMLParser(remove_blank_text=True, remove_comments=True)).getroot()
+
+
+def diff(published, built, ignore: Iterable[str] = ()) -> List[Edit]:
+    """Return the edits turning the `published` record into the `built` one, in the order to apply them
+
+    Elements whose prefixed tag, e.g. "mdb:dateInfo", is in `ignore` are left out of the comparison.
+    Raise `UnsupportedDiff` when the root elements differ or a tag has no known prefix.
+    """
+    published, built = parse(published), parse(built)
+    if published.tag != built.tag:
+        raise UnsupportedDiff(f"root elements differ: {published.tag} and {built.tag}")
+    ignored = {clark_tag(tag) for tag in ignore}
+    if not same_node(published, built):
+        raise UnsupportedDiff("attributes or text of the root element differ")
+    return diff_children(published, built, f"/{prefixed(built.tag)}", ignored)
+
+
+def diff_element(published: ET._Element, built: ET._Element, xpath: str, ignored: set) -> List[Edit]:
+    if not same_node(published, built):
+        return [replace(built, xpath)]
+    edits = diff_children(published, built, xpath, ignored)
+    if len(edits) > 1:
+        replacement = replace(built, xpath)
+        if edit_size(replacement) <= sum(edit_size(edit) for edit in edits):
+            return [replacement]
+    return edits
+
+
+def diff_children(published: ET._Element, built: ET._Element, xpath: str, ignored: set) -> List[Edit]:
+    edits, deletions, added = [], [], []
+    for tag in unique_tags(published, built):
+        if tag in ignored:
+            continue
+        published_children = [child for child in published if child.tag == tag]
+        built_children = [child for child in built if child.tag == tag]
+        child_xpath = f"{xpath}/{prefixed(tag)}"
+        for index, (published_child, built_child) in enumerate(zip(published_children, built_children), start=1):
+            edits.extend(diff_element(published_child, built_child, f"{child_xpath}[{index}]", ignored))
+        # Delete from the last one so that the positions of the remaining ones do not change
+        for index in range(len(published_children), len(built_children), -1):
+            deletions.append(Edit(f"{child_xpath}[{index}]", "", "DELETE"))
+        added.extend(built_children[len(published_children):])
+    if not added:
+        return edits + deletions
+
+    # Added elements are appended to the parent, which keeps the built order only for trailing children
+    children = [child for child in built if isinstance(child.tag, str)]
+    if children[len(children) - len(added):] != sorted(added, key=children.index):
+        if published.getparent() is None:
+            raise UnsupportedDiff("elements are added before other children of the root element")
+        return [replace(built, xpath)]
+    additions = [Edit(xpath, serialize(child), "ADD") for child in children[len(children) - len(added):]]
+    return edits + deletions + additions
+
+
+def same_node(published: ET._Element, built: ET._Element) -> bool:
+    """Tell if two elements have the same attributes and text, children aside"""
+    return (
+        dict(published.attrib) == dict(built.attrib)
+        and (published.text or "").strip() == (built.text or "").strip()
+        and (published.tail or "").strip() == (built.tail or "").strip()
+    )
+
+
+def unique_tags(*elements: ET._Element) -> List[str]:
+    tags = {}
+    for element in elements:
+        for child in element:
+            if isinstance(child.tag, str):
+                tags.setdefault(child.tag, None)
+    return list(tags)
+
+
+def replace(element: ET._Element, xpath: str) -> Edit:
+    return Edit(xpath, serialize(element), "REPLACE")
+
+
+def serialize(element: ET._Element) -> str:
+    """Serialize an element with the declarations of the namespaces it uses only"""
+    element = copy.deepcopy(element)
+    ET.cleanup_namespaces(element)
+    return ET.tostring(element, encoding="unicode", with_tail=False)
+
+
+def edit_size(edit: Edit) -> int:
+    return len(edit.xpath) + len(edit.value)
+
+
+def prefixed(tag: str) -> str:
+    """Return a tag in Clark notation, e.g. "{http://...mdb/2.0}dateInfo", with its prefix, e.g. "mdb:dateInfo" """
+    qname = ET.QName(tag)
+    if qname.namespace is None:
+        return qname.localname
+    if qname.namespace not in PREFIXES:
+        raise UnsupportedDiff(f"no prefix for the namespace {qname.namespace}")
+    return f"{PREFIXES[qname.namespace]}:{qname.localname}"
+
+
+def clark_tag(tag: str) -> str:
+    """Return a prefixed tag, e.g. "mdb:dateInfo", in Clark notation"""
+    prefix, _, localname = tag.rpartition(":")
+    return f"{{{NAMESPACES[prefix]}}}{localname}" if prefix else localname
+
+
+def patch_size(edits: List[Edit]) -> int:
+    """Return the size in bytes of the batch edit payload holding `edits`"""
+    return sum(len(edit.xpath.encode()) + len(edit.value.encode()) + 48 for edit in edits)
+
+
+def prefer_patch(edits: Optional[List[Edit]], document_size: int, max_patch_ratio: float = 0.5) -> bool:
+    """Tell if applying `edits` costs less than uploading the whole document of `document_size` bytes"""
+    return edits is not None and patch_size(edits) < max_patch_ratio * document_size
@@ -2,52 +2,334 @@
 """
 
 import csv
+import hashlib
+import inspect
 import json
 import os
+import pickle
+import warnings
+from collections import deque, namedtuple
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import Any, Iterable, Iterator, Optional, TextIO
 
 import lxml.etree as ET
 import yaml
 
 from . import xml_composers
 
+# Number of yaml documents sent at once to a worker process when parsing with several jobs.
+CHUNK_SIZE = 16
 
-def parse(input_file: str, output_folder: str):
+# Incremental parse manifest, dumped next to yaml_list.csv
+MANIFEST_FILE = 'yaml_list.manifest.csv'
+MANIFEST_FIELDS = ['yaml_identifier', 'xml_file_path', 'postponed_values', 'yaml_hash', 'build_hash', 'references']
+
+# The libyaml based loader is much faster than the pure Python one, it is used when PyYAML was built with it.
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+# Report returned by `parse()`, counting records whose xml file was built, left untouched or deleted.
+# `unresolved` holds the (yaml identifier, referenced identifier) pairs of references to records missing
+#  from the yaml file, when references are resolved.
+ParseReport = namedtuple("ParseReport", ["rebuilt", "skipped", "removed", "unresolved"], defaults=[()])
+
+# Record whose yaml document and build inputs did not change since the previous incremental parse.
+UnchangedRecord = namedtuple("UnchangedRecord", ["info"])
+
+
+def parse(input_file: str, output_folder: str, jobs: int = 1, yaml_cache: Optional[str] = None,
+          incremental: bool = False, resolve_references: bool = False) -> ParseReport:
     """
         Read yaml file -> Build XML record with xml_composers
         Dump result in a xml file with "xml.etree.ElementTree.write()"
         Dump csv with yaml identifiers, corresponding xml file and postponed values
-    """
-
-    # Loads a dataset definition from a YAML document
-    with open(input_file, encoding='utf8') as yaml_multidoc:
 
-        doc_infos = []
+        Yaml documents are read, built and written one after the other, and the csv row of each record
+        is written as soon as its xml file is, so at most one document (or the chunks in flight with `jobs`)
+        is held in memory. The identifiers and references of the records are kept until the end of the run
+        to report unresolved references, as are the previous manifest entries with `incremental`:
+        this bookkeeping grows with the number of records of the input file.
 
-        yaml_documents = list(yaml.load_all(yaml_multidoc, Loader=yaml.SafeLoader))
+        With `jobs` > 1, records are built and written by a pool of `jobs` processes.
+        The csv is the same as with a serial run, rows keep the order of the yaml documents.
 
-        for yaml_doc in yaml_documents:
-            builder = xml_composers.RecordDocumentBuilder().process_data_tree(yaml_doc)
-            xml_tree = builder.build()
-            ET.indent(xml_tree) # Beautify XML doc
+        With `yaml_cache`, parsed yaml documents are stored in this folder and reused by later runs
+        for every document whose source text did not change, see `YamlDocumentCache`.
 
-            xml_file_path = f"{output_folder}/{yaml_doc['identifier']}.xml"
-            xml_tree.write(xml_file_path)
+        With `incremental`, a manifest holding the hash of each yaml document and of the build inputs
+        (templates and composers) is dumped next to the csv. Later incremental runs only rebuild the records
+        whose hashes changed and delete the xml files of records that are no longer in the yaml file.
+        The csv is the same as with a full run.
 
-            doc_infos.append({'identifier': yaml_doc['identifier'],
-                              'xml_file_path': xml_file_path,
-                              'postponed_values': builder.deferred_processing})
+        With `resolve_references`, references between records are resolved to the uuids derived from
+        the referenced yaml identifiers, so postponed values only hold the record identifier and
+        no edition is needed after the upload. References to identifiers missing from the yaml file
+        trigger a warning and are listed in the report.
+    """
 
     fields = ['yaml_identifier', 'xml_file_path', 'postponed_values']
 
-    rows = []
-
     # We dump the yaml list in the current folder
-    for info in doc_infos:
-        rows.append([info['identifier'], info['xml_file_path'], json.dumps(info['postponed_values'])])
-        output_file = f'{os.getcwd()}/yaml_list.csv'
+    output_file = f'{os.getcwd()}/yaml_list.csv'
+    manifest_file = f'{os.getcwd()}/{MANIFEST_FILE}'
 
-    with open(output_file, 'w', newline='', encoding='utf8') as file:
+    previous_records = read_manifest(manifest_file) if incremental else {}
+    build_hash = build_fingerprint(resolve_references) if incremental else None
+    yaml_hashes = deque()
+    identifiers = set()
+    references = []
+    rebuilt = skipped = 0
+
+    # Loads a dataset definition from a YAML document
+    with open(input_file, encoding='utf8') as yaml_multidoc, \
+            open(output_file, 'w', newline='', encoding='utf8') as file, \
+            open(f'{manifest_file}.tmp', 'w', newline='', encoding='utf8') if incremental else nullcontext() \
+            as manifest:
         # using csv.writer method from CSV package
         write = csv.writer(file)
         write.writerow(fields)
-        write.writerows(rows)
+
+        cache = YamlDocumentCache(yaml_cache) if yaml_cache else None
+        if incremental:
+            write_manifest = csv.writer(manifest)
+            write_manifest.writerow(MANIFEST_FIELDS)
+            yaml_documents = changed_documents(
+                yaml_multidoc, previous_records, build_hash, output_folder, cache, yaml_hashes
+            )
+        elif cache:
+            yaml_documents = cache.load_all(yaml_multidoc)
+        else:
+            yaml_documents = yaml.load_all(yaml_multidoc, Loader=YamlLoader)
+
+        for info in build_records(yaml_documents, output_folder, jobs, resolve_references):
+            row = [info['identifier'], info['xml_file_path'], json.dumps(info['postponed_values'])]
+            write.writerow(row)
+            if info.get('unchanged'):
+                skipped += 1
+            else:
+                rebuilt += 1
+            identifiers.add(info['identifier'])
+            references.extend((info['identifier'], target) for target in info['references'])
+            if incremental:
+                write_manifest.writerow(row + [yaml_hashes.popleft(), build_hash, json.dumps(info['references'])])
+
+    removed = 0
+    if incremental:
+        os.replace(f'{manifest_file}.tmp', manifest_file)
+        # Records that disappeared from the yaml file
+        for identifier, entry in previous_records.items():
+            if identifier not in identifiers and os.path.exists(entry['xml_file_path']):
+                os.unlink(entry['xml_file_path'])
+                removed += 1
+
+    unresolved = tuple((identifier, target) for identifier, target in references if target not in identifiers)
+    for identifier, target in unresolved:
+        warnings.warn(f"Record `{identifier}` references `{target}`, which is not in {input_file}.")
+
+    return ParseReport(rebuilt, skipped, removed, unresolved)
+
+
+def build_records(yaml_documents: Iterable[dict], output_folder: str, jobs: int = 1,
+                  resolve_references: bool = False) -> Iterator[dict]:
+    """Build and write the XML records of `yaml_documents`, yielding their infos in the same order
+
+    Documents wrapped in `UnchangedRecord` are not built, their infos are yielded as is.
+    Documents are consumed lazily. With `jobs` > 1, at most 2 chunks of documents per job are
+    in flight at any time.
+    """
+    if jobs <= 1:
+        for yaml_doc in yaml_documents:
+            yield build_or_reuse(yaml_doc, output_folder, resolve_references)
+        return
+
+    yaml_documents = iter(yaml_documents)
+    # Each worker warms its composer and template caches once, when it starts.
+    with ProcessPoolExecutor(max_workers=jobs, initializer=warm_caches) as executor:
+        in_flight = deque()
+        while True:
+            while len(in_flight) < jobs * 2:
+                chunk = list(islice(yaml_documents, CHUNK_SIZE))
+                if not chunk:
+                    break
+                in_flight.append(executor.submit(build_chunk, chunk, output_folder, resolve_references))
+            if not in_flight:
+                break
+            yield from in_flight.popleft().result()
+
+
+def build_chunk(yaml_documents: list, output_folder: str, resolve_references: bool = False) -> list:
+    """Build and write the XML records of a list of yaml documents and return their infos"""
+    return [build_or_reuse(yaml_doc, output_folder, resolve_references) for yaml_doc in yaml_documents]
+
+
+def build_or_reuse(yaml_doc, output_folder: str, resolve_references: bool = False) -> dict:
+    """Build the XML record of a yaml document unless it is an `UnchangedRecord`"""
+    if isinstance(yaml_doc, UnchangedRecord):
+        return yaml_doc.info
+    return build_record(yaml_doc, output_folder, resolve_references)
+
+
+def build_record(yaml_doc: dict, output_folder: str, resolve_references: bool = False) -> dict:
+    """Build the XML record of a yaml document, write it in `output_folder` and return its infos"""
+    builder = xml_composers.RecordDocumentBuilder(resolve_references=resolve_references)
+    builder.process_data_tree(yaml_doc)
+    xml_tree = builder.build()
+    ET.indent(xml_tree) # Beautify XML doc
+
+    xml_file_path = f"{output_folder}/{yaml_doc['identifier']}.xml"
+    xml_tree.write(xml_file_path)
+
+    return {'identifier': yaml_doc['identifier'],
+            'xml_file_path': xml_file_path,
+            'postponed_values': builder.deferred_processing,
+            'references': builder.references}
+
+
+def changed_documents(stream: TextIO, previous_records: dict, build_hash: str, output_folder: str,
+                      cache: Optional["YamlDocumentCache"], yaml_hashes: deque) -> Iterator[Any]:
+    """Yield the documents of a yaml stream, wrapping the ones that do not need to be built again
+    in `UnchangedRecord`.
+
+    A record is unchanged if the hash of its yaml source and the build hash are the ones stored
+    in `previous_records` and its xml file is still in `output_folder`.
+    The hash of each document is appended to `yaml_hashes`, in the order documents are yielded.
+    """
+    by_hash = {entry['yaml_hash']: entry for entry in previous_records.values()}
+
+    for source in split_yaml_documents(stream):
+        yaml_hash = source_hash(source)
+        yaml_hashes.append(yaml_hash)
+
+        entry = by_hash.get(yaml_hash)
+        if entry and entry['build_hash'] == build_hash \
+                and os.path.dirname(entry['xml_file_path']) == output_folder.rstrip('/') \
+                and os.path.exists(entry['xml_file_path']):
+            yield UnchangedRecord({'identifier': entry['yaml_identifier'],
+                                   'xml_file_path': entry['xml_file_path'],
+                                   'postponed_values': json.loads(entry['postponed_values']),
+                                   'references': json.loads(entry.get('references') or '[]'),
+                                   'unchanged': True})
+        elif cache:
+            yield cache.load(source)
+        else:
+            yield yaml.load(source, Loader=YamlLoader)
+
+
+def read_manifest(manifest_file: str) -> dict:
+    """Return the entries of an incremental parse manifest by yaml identifier"""
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file, encoding='utf8') as file:
+        return {row['yaml_identifier']: row for row in csv.DictReader(file)}
+
+
+def build_fingerprint(resolve_references: bool = False) -> str:
+    """Return a hash of everything besides the yaml document that a record's xml depends on:
+    the record document template, the composers partials, the code of the modules defining composers
+    and the build options.
+    """
+    paths = [xml_composers.document_templates.resolve(xml_composers.RecordDocumentBuilder.__document_template__),
+             __file__]
+    for composer_cls in xml_composers.registered_composers():
+        paths.append(composer_cls.template_path())
+        paths.append(inspect.getfile(composer_cls))
+
+    fingerprint = hashlib.sha256(f"resolve_references={resolve_references}".encode('utf8'))
+    for path in sorted(set(paths)):
+        if not os.path.exists(path):
+            continue
+        fingerprint.update(path.encode('utf8'))
+        with open(path, 'rb') as file:
+            fingerprint.update(file.read())
+    return fingerprint.hexdigest()
+
+
+def warm_caches():
+    """Load composer partials and the record document template ahead of the first build"""
+    xml_composers.XMLComposer.warm_template_cache()
+    xml_composers.document_templates.get(xml_composers.RecordDocumentBuilder.__document_template__)
+
+
+class YamlDocumentCache:
+    """On-disk cache of parsed yaml documents.
+
+    Documents are stored as pickles named after the sha256 hash of their source text, including directives
+    and document markers. Only trusted folders should be used as cache since loading a pickle can execute code.
+    """
+
+    def __init__(self, folder: str) -> None:
+        self.folder = folder
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(folder, exist_ok=True)
+
+    def load_all(self, stream: TextIO) -> Iterator[Any]:
+        """Yield the documents of a multi-document yaml stream, parsing only the ones not in the cache"""
+        for source in split_yaml_documents(stream):
+            yield self.load(source)
+
+    def load(self, source: str) -> Any:
+        """Return the document parsed from `source`"""
+        key = source_hash(source)
+        path = f"{self.folder}/{key}.pickle"
+        try:
+            with open(path, "rb") as cached:
+                document = pickle.load(cached)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            pass
+        else:
+            self.hits += 1
+            return document
+
+        self.misses += 1
+        document = yaml.load(source, Loader=YamlLoader)
+        # Write then rename so that concurrent runs never read a partial file.
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as cached:
+            pickle.dump(document, cached, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+        return document
+
+
+def source_hash(source: str) -> str:
+    """Return the sha256 hash of the source text of a yaml document"""
+    return hashlib.sha256(source.encode("utf8")).hexdigest()
+
+
+def split_yaml_documents(stream: Iterable[str]) -> Iterator[str]:
+    """Yield the source text of each document of a multi-document yaml stream, without parsing it.
+
+    Documents are delimited by the "---" and "..." markers, which the YAML specification
+    forbids at the start of a line inside a document. Directives (e.g. "%YAML 1.1")
+    are kept with the document they precede.
+    Comment-only sections are skipped, like `yaml.load_all()` does.
+    """
+    lines = []
+    is_document = False
+    for line in stream:
+        if is_marker(line, "---"):
+            if is_document:
+                yield "".join(lines)
+                lines = []
+            lines.append(line)
+            is_document = True
+        elif is_marker(line, "..."):
+            if is_document:
+                lines.append(line)
+                yield "".join(lines)
+            lines = []
+            is_document = False
+        else:
+            lines.append(line)
+            if not is_document and not line.startswith("%"):
+                stripped = line.strip()
+                is_document = bool(stripped) and not stripped.startswith("#")
+    if is_document:
+        yield "".join(lines)
+
+
+def is_marker(line: str, marker: str) -> bool:
+    """Is `line` a yaml document marker ?"""
+    return line.startswith(marker) and (len(line) == 3 or line[3] in " \t\r\n")
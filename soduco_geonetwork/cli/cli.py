@@ -2,6 +2,7 @@
 """
 
 import csv
+import json
 import os
 import tempfile
 from pathlib import Path
@@ -11,8 +12,14 @@ from soduco_geonetwork.api_wrapper import (
     dataset,
     geonetwork,
     helpers,
+    sync as sync_records,
     yaml_to_xml,
 )
+from soduco_geonetwork.api_wrapper.client import GeoNetworkClient, RateLimiter, RetryPolicy
+from soduco_geonetwork.api_wrapper.concurrency import AdaptiveLimit, Failure, map_concurrently
+from soduco_geonetwork.api_wrapper.record_cache import RecordCache
+from soduco_geonetwork.api_wrapper.session_cache import SessionCache
+from soduco_geonetwork.api_wrapper.state import StateStore
 
 
 def check_for_environment_variables():
@@ -28,6 +35,60 @@ def check_for_environment_variables():
         raise AssertionError(f"Missing expected ENV variables {', '.join(vars)}")
 
 
+def logged_in_client(pool_size: int = 10, retries: int = 3, rate: float = None) -> GeoNetworkClient:
+    """Return a client logged in with the credentials of the configuration
+
+    Sessions are cached in the GEONETWORK_SESSION_CACHE folder if it is configured.
+    """
+    client = GeoNetworkClient(
+        pool_size=pool_size,
+        retry_policy=RetryPolicy(retries=retries),
+        rate_limiter=RateLimiter(rate, burst=pool_size) if rate else None,
+    )
+    cache_folder = config.config.get("GEONETWORK_SESSION_CACHE")
+    return geonetwork.log_in(
+        config.config["GEONETWORK_USER"], config.config["GEONETWORK_PASSWORD"], client,
+        SessionCache(cache_folder) if cache_folder else None,
+    )
+
+
+def client_options(function):
+    """Add the options tuning the connection to Geonetwork to a command"""
+    function = click.option(
+        "--rate", type=click.FloatRange(min=0, min_open=True), default=None,
+        help="Maximum number of requests per second.",
+    )(function)
+    function = click.option(
+        "--retries", type=click.IntRange(min=0), default=3,
+        help="Number of times a request failing with a transient error is sent again.",
+    )(function)
+    return function
+
+
+def concurrency_options(function):
+    """Add the options setting the number of requests in flight to a command"""
+    function = click.option(
+        "--adaptive", is_flag=True,
+        help="Adapt the number of requests in flight to the server latency and errors, up to --concurrency.",
+    )(function)
+    function = click.option(
+        "--concurrency", type=click.IntRange(min=1), default=1, help="Number of requests in flight."
+    )(function)
+    return function
+
+
+def concurrency_limit(concurrency: int, adaptive: bool):
+    """Return the concurrency given to `map_concurrently`, reporting the changes of an adaptive limit"""
+    if not adaptive:
+        return concurrency
+
+    def report(stats, reason):
+        p95 = f"{stats.p95_latency:.2f}s" if stats.p95_latency is not None else "n/a"
+        click.echo(f"Concurrency set to {stats.limit} after {reason} (p95 latency {p95})", err=True)
+
+    return AdaptiveLimit(initial=min(4, concurrency), maximum=concurrency, on_change=report)
+
+
 @click.group()
 def cli():
     """Main function"""
@@ -37,12 +98,23 @@ def cli():
 @cli.command()
 @click.argument("input_yaml_file", type=click.Path(exists=True))
 @click.option("--output_folder")
-def parse(input_yaml_file, output_folder):
+@click.option("--jobs", type=click.IntRange(min=1), default=1, help="Number of processes building records.")
+@click.option("--yaml-cache", type=click.Path(file_okay=False), help="Folder caching parsed yaml documents.")
+@click.option("--incremental", is_flag=True, help="Only rebuild records that changed since the previous run.")
+@click.option("--resolve-references", is_flag=True, help="Resolve links between records at parse time.")
+def parse(input_yaml_file, output_folder, jobs, yaml_cache, incremental, resolve_references):
     """Generate xml files from a yaml documents
 
 
     Needs 1 argument:
     - A yaml file with one or more documents to parse to xml (dumped in tmp folder by default)
+
+    Records are built by a single process unless --jobs is given.
+    With --yaml-cache, yaml documents that did not change since a previous run are not parsed again.
+    With --incremental, xml files are only rebuilt for records that changed since the previous incremental run,
+    based on a manifest dumped next to the yaml_list.
+    With --resolve-references, links between records use the uuids derived from yaml identifiers,
+    so that update-postponed-values is not needed after the upload.
     """
     if not input_yaml_file.endswith((".yml", ".yaml")):
         raise ValueError("Not a yaml file")
@@ -57,8 +129,14 @@ def parse(input_yaml_file, output_folder):
         else:
             click.echo("folder " + output_folder + " already present. Parsing YAML file.")
 
-    yaml_to_xml.parse(input_yaml_file, output_folder)
+    report = yaml_to_xml.parse(
+        input_yaml_file, output_folder, jobs=jobs, yaml_cache=yaml_cache, incremental=incremental,
+        resolve_references=resolve_references
+    )
 
+    click.echo(f"{report.rebuilt} records rebuilt, {report.skipped} skipped, {report.removed} removed.")
+    if report.unresolved:
+        click.echo(f"{len(report.unresolved)} references to records missing from the yaml file.", err=True)
     click.echo("yaml_list dumped in current folder : " + os.getcwd())
 
 
@@ -67,42 +145,219 @@ def parse(input_yaml_file, output_folder):
 # TO DO : work only in csv given as argument
 @cli.command()
 @click.argument("csv_file", type=click.Path(exists=True))
-def upload(csv_file):
+@concurrency_options
+@click.option("--bulk", is_flag=True, help="Upload the records in MEF archives holding many records each.")
+@click.option("--chunk-size", type=click.IntRange(min=1), default=100, help="Maximum number of records per archive.")
+@click.option("--chunk-bytes", type=click.IntRange(min=1), default=None, help="Maximum size in bytes of the xml files of an archive.")
+@click.option("--raw", is_flag=True, help="Send the xml files as they are on disk, without parsing them.")
+@click.option("--check-xml", is_flag=True, help="With --raw, check that each file is well-formed before sending it.")
+@client_options
+def upload(csv_file, concurrency, adaptive, bulk, chunk_size, chunk_bytes, raw, check_xml, retries, rate):
     """Upload one or more xml files from a csv file
 
 
     Needs 1 arguments:
     - A csv file with the path of the xml files to upload
+
+    Files are uploaded one at a time unless --concurrency is given.
+    With --adaptive, the number of uploads in flight follows the server health, up to --concurrency.
+    With --bulk, files are packaged in archives of up to --chunk-size records and --chunk-bytes bytes,
+    each archive being uploaded in one request.
+    With --raw, files are streamed from disk as they are instead of being parsed and serialized again.
+    Requests failing with a transient error are sent again up to --retries times.
+    Records that could not be uploaded are reported at the end and keep an empty geonetwork_uuid.
     """
-    session = geonetwork.log_in(
-        config.config["GEONETWORK_USER"], config.config["GEONETWORK_PASSWORD"]
-    )
+    session = logged_in_client(concurrency, retries, rate)
+    limit = concurrency_limit(concurrency, adaptive)
 
     file = open(csv_file, "r", encoding="utf8")
     reader = csv.DictReader(file)
     parent = Path(csv_file).parent.absolute()
     temp_file = parent / "temp.csv"
     rows_to_dump = []
+    failures = []
+
+    if bulk:
+        uploads = upload_archives(reader, parent, session, limit, chunk_size, chunk_bytes)
+    else:
+        uploads = upload_files(reader, parent, session, limit, raw, check_xml)
 
-    for row in reader:
-        # xml_file = helpers.xml_to_utf8string((helpers.read_xml_file(f"{dirname}/{row['xml_file']}")))
-        xml_file = helpers.read_xml_file(parent / row["xml_file_path"])
-        json_response = dataset.upload(xml_file, session).json()
-        geonetwork_uuid = helpers.get_geonetwork_uuid(json_response)
-        row["geonetwork_uuid"] = geonetwork_uuid
+    for row, geonetwork_uuid in uploads:
+        if isinstance(geonetwork_uuid, Failure):
+            row["geonetwork_uuid"] = ""
+            failures.append(geonetwork_uuid)
+            click.echo(f"Could not upload {row['xml_file_path']}: {geonetwork_uuid.error}", err=True)
+        else:
+            row["geonetwork_uuid"] = geonetwork_uuid
         rows_to_dump.append(row)
 
+    helpers.dump_uploaded_uuid(rows_to_dump, temp_file)
+    helpers.replace_uuid(temp_file, csv_file)
+
+    if failures:
+        raise click.ClickException(f"{len(failures)} of {len(rows_to_dump)} records could not be uploaded")
+
+
+def upload_files(rows, parent, session, concurrency, raw=False, check_xml=False):
+    """Upload the xml file of each row in its own request, yield (row, uuid or Failure) pairs"""
+
+    def upload_row(row):
+        if raw:
+            json_response = dataset.upload_file(parent / row["xml_file_path"], session, check_xml).json()
+        else:
+            # xml_file = helpers.xml_to_utf8string((helpers.read_xml_file(f"{dirname}/{row['xml_file']}")))
+            xml_file = helpers.read_xml_file(parent / row["xml_file_path"])
+            json_response = dataset.upload(xml_file, session).json()
         click.echo(json_response)
+        # A report importing nothing fails this row only
+        return helpers.get_geonetwork_uuid(json_response)
 
-    helpers.dump_uploaded_uuid(rows_to_dump, temp_file)
+    yield from map_concurrently(upload_row, rows, concurrency)
+
+
+def upload_archives(rows, parent, session, concurrency, chunk_size, chunk_bytes):
+    """Upload the xml files of the rows in MEF archives, yield (row, uuid or Failure) pairs"""
+
+    def xml_path(row):
+        return parent / row["xml_file_path"]
+
+    def upload_chunk(chunk):
+        return dataset.upload_archive([xml_path(row) for row in chunk], session).json()
+
+    chunks = dataset.archive_chunks(rows, xml_path, chunk_size, chunk_bytes)
+    for chunk, json_response in map_concurrently(upload_chunk, chunks, concurrency):
+        if isinstance(json_response, Failure):
+            for row in chunk:
+                yield row, json_response
+            continue
+        click.echo(json_response)
+        imported = set(dataset.imported_uuids(json_response))
+        for row in chunk:
+            identifier = dataset.record_identifier(xml_path(row))
+            if identifier in imported:
+                yield row, identifier
+            else:
+                yield row, Failure(Exception(f"record {identifier} is missing from the import report"))
+
+
+@cli.command()
+@click.argument("csv_file", type=click.Path(exists=True))
+@click.option("--state", "state_file", type=click.Path(dir_okay=False), default=None,
+              help="File holding the hashes of the published records, published.csv next to the csv file by default.")
+@click.option("--remote", is_flag=True, help="Compare with the published copy of each record instead of the state file.")
+@click.option("--delete-removed", is_flag=True, help="Delete the published records missing from the csv file.")
+@click.option("--patch", is_flag=True,
+              help="Update changed records with batch edits of their published copy when smaller than an upload.")
+@click.option("--ignore", type=str, multiple=True,
+              help='A prefixed tag of elements left out of the comparison, e.g. "mdb:dateInfo".')
+@concurrency_options
+@client_options
+def sync(csv_file, state_file, remote, delete_removed, patch, ignore, concurrency, adaptive, retries, rate):
+    """Upload the records of a csv file that are new or changed since they were last published
+
+
+    Needs 1 argument:
+    - A csv file with the path of the xml files to publish (one is generated by the parse command)
+
+    Records are compared through a hash of their canonical xml. Changed records replace their published copy,
+    or with --patch, are edited where they differ from it if that is cheaper. New records are uploaded
+    with the OVERWRITE uuid processing too, as they may have been published without a state file.
+    The geonetwork uuids of all the records are written to the csv file, as the upload command does.
+    """
+    parent = Path(csv_file).parent.absolute()
+    state_file = state_file or parent / "published.csv"
+    with open(csv_file, encoding="utf8") as file:
+        rows = list(csv.DictReader(file))
+
+    def xml_path(row):
+        return parent / row["xml_file_path"]
+
+    hashes = {row["yaml_identifier"]: sync_records.canonical_hash(xml_path(row), ignore) for row in rows}
+    state = sync_records.read_state(state_file)
+    session = logged_in_client(concurrency, retries, rate)
+    limit = concurrency_limit(concurrency, adaptive)
+
+    # Published copies hold the elements rewritten by the server, left out when comparing with them
+    remote_ignore = (*ignore, *sync_records.SERVER_UPDATED_TAGS)
+    local_hashes, remote_hashes = hashes, None
+    if remote:
+        local_hashes = {
+            row["yaml_identifier"]: sync_records.canonical_hash(xml_path(row), remote_ignore) for row in rows
+        }
+
+        def remote_hash(row):
+            document = dataset.fetch(dataset.record_identifier(xml_path(row)), session)
+            return sync_records.canonical_hash(document, remote_ignore) if document is not None else None
+
+        remote_hashes = {}
+        for row, xml_hash in map_concurrently(remote_hash, rows, limit):
+            if isinstance(xml_hash, Failure):
+                raise click.ClickException(f"Could not fetch the record of {row['xml_file_path']}: {xml_hash.error}")
+            remote_hashes[row["yaml_identifier"]] = xml_hash
+
+    plan = sync_records.plan_sync(rows, local_hashes, state, remote_hashes)
+    click.echo(
+        f"{len(plan.new)} new, {len(plan.changed)} changed, {len(plan.unchanged)} unchanged, "
+        f"{len(plan.removed)} removed records."
+    )
+
+    for row in plan.unchanged:
+        geonetwork_uuid = state.get(row["yaml_identifier"], {}).get("geonetwork_uuid") \
+            or dataset.record_identifier(xml_path(row))
+        state[row["yaml_identifier"]] = sync_records.state_row(row, geonetwork_uuid, hashes[row["yaml_identifier"]])
+
+    def upload_row(item):
+        row, uuid_processing = item
+        if uuid_processing == "PATCH":
+            geonetwork_uuid = state.get(row["yaml_identifier"], {}).get("geonetwork_uuid") \
+                or dataset.record_identifier(xml_path(row))
+            update = dataset.update_record(geonetwork_uuid, xml_path(row), session, ignore=remote_ignore)
+            click.echo(f"{row['xml_file_path']}: {update.method}")
+            return geonetwork_uuid
+        json_response = dataset.upload_file(xml_path(row), session, uuid_processing=uuid_processing).json()
+        click.echo(json_response)
+        return helpers.get_geonetwork_uuid(json_response)
+
+    uploads = [(row, "OVERWRITE") for row in plan.new]
+    uploads += [(row, "PATCH" if patch else "OVERWRITE") for row in plan.changed]
+    failures = []
+    for (row, _), geonetwork_uuid in map_concurrently(upload_row, uploads, limit):
+        if isinstance(geonetwork_uuid, Failure):
+            failures.append(geonetwork_uuid)
+            click.echo(f"Could not upload {row['xml_file_path']}: {geonetwork_uuid.error}", err=True)
+        else:
+            state[row["yaml_identifier"]] = sync_records.state_row(row, geonetwork_uuid, hashes[row["yaml_identifier"]])
+
+    if delete_removed:
+        removed = {row["geonetwork_uuid"]: row["yaml_identifier"] for row in plan.removed if row.get("geonetwork_uuid")}
+        chunks = (list(removed)[i:i+100] for i in range(0, len(removed), 100))
+        for chunk, json_response in map_concurrently(lambda chunk: dataset.delete(chunk, session).json(), chunks, limit):
+            if isinstance(json_response, Failure):
+                failures.append(json_response)
+                click.echo(f"Could not delete {len(chunk)} records: {json_response.error}", err=True)
+            else:
+                click.echo(json_response)
+                for geonetwork_uuid in chunk:
+                    del state[removed[geonetwork_uuid]]
+
+    sync_records.write_state(state_file, state)
+    for row in rows:
+        row["geonetwork_uuid"] = state.get(row["yaml_identifier"], {}).get("geonetwork_uuid", "")
+    temp_file = parent / "temp.csv"
+    helpers.dump_uploaded_uuid(rows, temp_file)
     helpers.replace_uuid(temp_file, csv_file)
 
+    if failures:
+        raise click.ClickException(f"{len(failures)} requests failed, their records will be synced next time")
+
 
 @cli.command()
 @click.argument("input_csv_file", type=click.Path(exists=True))
 @click.argument("edition_location", type=str)
 @click.argument("xml_patch", type=str)
-def update(input_csv_file, edition_location, xml_patch):
+@concurrency_options
+@client_options
+def update(input_csv_file, edition_location, xml_patch, concurrency, adaptive, retries, rate):
     """Update a xml dataset on geonetwork
 
 
@@ -110,61 +365,250 @@ def update(input_csv_file, edition_location, xml_patch):
     - A csv file with a column "geonetwork_uuid" with uuids to update
     - An edition location in the document (in Xpath)
     - A xml element to save at the location (it will erase any previous element)
+
+    Records are updated by chunks of 100, with up to --concurrency requests in flight.
     """
-    session = geonetwork.log_in(
-        config.config["GEONETWORK_USER"], config.config["GEONETWORK_PASSWORD"]
-    )
+    session = logged_in_client(concurrency, retries, rate)
 
     uuid_list = helpers.uuid_list_from_csv(input_csv_file)
 
-    response = dataset.update(uuid_list, edition_location, xml_patch, session)
-    click.echo(response)
+    def update_chunk(chunk):
+        return dataset.update(chunk, edition_location, xml_patch, session).json()
+
+    run_chunks(update_chunk, uuid_list, concurrency_limit(concurrency, adaptive), "update")
+
+
+def run_chunks(function, uuid_list, limit, action, chunk_size=100):
+    """Apply `function` to chunks of `uuid_list` concurrently, echo the responses and report failures"""
+    chunks = (uuid_list[i:i+chunk_size] for i in range(0, len(uuid_list), chunk_size))
+    failures = 0
+    for chunk, json_response in map_concurrently(function, chunks, limit):
+        if isinstance(json_response, Failure):
+            failures += len(chunk)
+            click.echo(f"Could not {action} {len(chunk)} records: {json_response.error}", err=True)
+        else:
+            click.echo(json_response)
+
+    if failures:
+        raise click.ClickException(f"{failures} of {len(uuid_list)} records could not be {action}d")
 
 
 @cli.command()
 @click.argument("csv_postponed_values", type=click.Path(exists=True))
 @click.argument("temp_csv_postponed_values", type=click.Path(exists=True))
-def update_postponed_values(csv_postponed_values, temp_csv_postponed_values):
+@client_options
+def update_postponed_values(csv_postponed_values, temp_csv_postponed_values, retries, rate):
     """Edit the postponed links between uploaded records
 
 
     Needs 1 argument: a csv file with postponed values (one is generated by the parse command)
     """
-    session = geonetwork.log_in(
-        config.config["GEONETWORK_USER"], config.config["GEONETWORK_PASSWORD"]
-    )
+    session = logged_in_client(retries=retries, rate=rate)
 
     postponed_list = helpers.read_postponed_values(csv_postponed_values)
     if temp_csv_postponed_values:
         prior_postponed_list = helpers.read_postponed_values(temp_csv_postponed_values)
 
+    accumulator = dataset.BatchEditAccumulator(session)
     for index, item in enumerate(postponed_list):
         if temp_csv_postponed_values:
             prior_item = prior_postponed_list[index]
-            response = dataset.edit_postponed_values(item, prior_item, session)
-            click.echo(response)
+            dataset.edit_postponed_values(item, prior_item, accumulator=accumulator)
+
+    for response in accumulator.flush():
+        click.echo(response.json())
+
+@cli.command()
+@click.argument("spec_file", type=click.Path(exists=True))
+@click.argument("input_csv_file", type=click.Path(exists=True))
+@click.option("--max-uuids", type=click.IntRange(min=1), default=100, help="Maximum number of records per request.")
+@concurrency_options
+@client_options
+def patch(spec_file, input_csv_file, max_uuids, concurrency, adaptive, retries, rate):
+    """Apply the patches of a spec file to the records of a csv file
+
+
+    Needs 2 arguments:
+    - A yaml or csv file listing patches, each with a "xpath", a "value" and an optional "mode"
+      (CREATE, ADD, DELETE or REPLACE)
+    - A csv file with a column "geonetwork_uuid" with uuids to patch
+
+    Xpaths and values of patches with "template" set may use the columns of the csv file, e.g. "{yaml_identifier}".
+    Records receiving the same patches are edited in the same requests.
+    """
+    try:
+        patches = helpers.read_patch_spec(spec_file)
+    except ValueError as error:
+        raise click.BadParameter(str(error), param_hint="SPEC_FILE")
+
+    session = logged_in_client(concurrency, retries, rate)
+    limit = concurrency_limit(concurrency, adaptive)
+
+    accumulator = dataset.BatchEditAccumulator(session, max_uuids=max_uuids)
+    with open(input_csv_file, encoding="utf8") as file:
+        try:
+            dataset.add_patches(accumulator, csv.DictReader(file), patches)
+        except KeyError as error:
+            raise click.ClickException(f"Unknown column {error} in a patch template")
+        except (ValueError, IndexError) as error:
+            raise click.ClickException(f"Invalid patch template: {error}")
+
+    def send(request):
+        uuid_list, edits = request
+        return dataset.update_edits(uuid_list, edits, session).json()
+
+    failures = 0
+    for (uuid_list, _), json_response in map_concurrently(send, accumulator.pending_requests(), limit):
+        if isinstance(json_response, Failure):
+            failures += 1
+            click.echo(f"Could not patch {len(uuid_list)} records: {json_response.error}", err=True)
+        else:
+            click.echo(json_response)
+
+    if failures:
+        raise click.ClickException(f"{failures} patch requests failed")
+
+
+@cli.command()
+@click.argument("input_csv_file", type=click.Path(exists=True))
+@click.argument("output_folder", type=click.Path(file_okay=False))
+@concurrency_options
+@client_options
+def fetch(input_csv_file, output_folder, concurrency, adaptive, retries, rate):
+    """Download records from geonetwork to a folder
+
+
+    Needs 2 arguments:
+    - A csv file with a column "geonetwork_uuid" with uuids to download
+    - A folder where records are written as <uuid>.xml
+
+    The folder is also a cache: records downloaded by a previous run are only transferred again
+    if they changed on the server.
+    """
+    session = logged_in_client(concurrency, retries, rate)
+    cache = RecordCache(output_folder)
+
+    uuid_list = [uuid_ for uuid_ in helpers.uuid_list_from_csv(input_csv_file) if uuid_]
+
+    def fetch_record(uuid_):
+        return dataset.fetch(uuid_, session, cache)
+
+    missing, failures = 0, 0
+    for uuid_, document in map_concurrently(fetch_record, uuid_list, concurrency_limit(concurrency, adaptive)):
+        if isinstance(document, Failure):
+            failures += 1
+            click.echo(f"Could not fetch {uuid_}: {document.error}", err=True)
+        elif document is None:
+            missing += 1
+            click.echo(f"Record {uuid_} does not exist", err=True)
+
+    click.echo(f"{cache.misses} records downloaded, {cache.hits} not modified, {missing} missing.")
+    if failures:
+        raise click.ClickException(f"{failures} of {len(uuid_list)} records could not be fetched")
+
+
+@cli.command()
+@click.argument("output_csv_file", type=click.Path(dir_okay=False))
+@click.option("--query", "query_string", type=str, default=None,
+              help='A query in the Lucene syntax, e.g. "tag.default:Verniquet". All the records by default.')
+@click.option("--query-file", type=click.File("r", encoding="utf8"), default=None,
+              help="A json file holding an Elasticsearch query.")
+@click.option("--field", "fields", type=str, multiple=True, help="A field of the records to write to the csv file.")
+@click.option("--page-size", type=click.IntRange(min=1), default=500, help="Number of records requested at once.")
+@client_options
+def search(output_csv_file, query_string, query_file, fields, page_size, retries, rate):
+    """Search records on geonetwork and write their uuids to a csv file
+
+
+    Needs 1 argument:
+    - The csv file to write, with a column "geonetwork_uuid" as read by the update and delete commands
+      and a column for each --field
+    """
+    if query_string and query_file:
+        raise click.UsageError("--query and --query-file can not be used together")
+    if query_file:
+        query = json.load(query_file)
+    elif query_string:
+        query = {"query_string": {"query": query_string}}
+    else:
+        query = None
+
+    session = logged_in_client(retries=retries, rate=rate)
+
+    count = 0
+    with open(output_csv_file, "w", newline="", encoding="utf8") as file:
+        writer = csv.DictWriter(file, fieldnames=["geonetwork_uuid", *fields], extrasaction="ignore")
+        writer.writeheader()
+        for hit in dataset.search(query, ("uuid", *fields), page_size, session):
+            source = hit.get("_source", {})
+            writer.writerow({
+                "geonetwork_uuid": dataset.hit_uuid(hit),
+                **{field: json.dumps(source[field]) if isinstance(source.get(field), (dict, list)) else source.get(field)
+                   for field in fields},
+            })
+            count += 1
+
+    click.echo(f"{count} records found.")
+
 
 @cli.command()
 @click.argument("input_csv_file", type=click.Path(exists=True))
-def delete(input_csv_file):
+@concurrency_options
+@client_options
+def delete(input_csv_file, concurrency, adaptive, retries, rate):
     """Delete one or more dataset on geonetwork from a csv file
 
 
     Needs 1 argument:
     - A csv file with a column "geonetwork_uuid" with uuids to delete
+
+    Records are deleted by chunks of 100, with up to --concurrency requests in flight.
     """
 
-    session = geonetwork.log_in(
-        config.config["GEONETWORK_USER"], config.config["GEONETWORK_PASSWORD"]
-    )
+    session = logged_in_client(concurrency, retries, rate)
 
     uuid_list = helpers.uuid_list_from_csv(input_csv_file)
 
-    chunk_size = 100
+    def delete_chunk(chunk):
+        return dataset.delete(chunk, session).json()
+
+    run_chunks(delete_chunk, uuid_list, concurrency_limit(concurrency, adaptive), "delete")
+
 
-    for i in range(0, len(uuid_list), chunk_size):
-        response = dataset.delete(uuid_list[i:i+chunk_size], session).json()
-        click.echo(response)
+@cli.group()
+def state():
+    """Import csv files listing records into a SQLite database and export them back"""
+
+
+@state.command("import")
+@click.argument("csv_file", type=click.Path(exists=True))
+@click.argument("database", type=click.Path(dir_okay=False))
+def state_import(csv_file, database):
+    """Import the records of a csv file (one is generated by the parse command) into a database"""
+    with StateStore(database) as store:
+        count = store.import_csv(csv_file)
+    click.echo(f"{count} records imported.")
+
+
+@state.command("export")
+@click.argument("database", type=click.Path(exists=True, dir_okay=False))
+@click.argument("csv_file", type=click.Path(dir_okay=False))
+@click.option("--resolve", is_flag=True, help="Replace the yaml identifiers of the postponed values by geonetwork uuids.")
+def state_export(database, csv_file, resolve):
+    """Export the records of a database to a csv file"""
+    with StateStore(database) as store:
+        store.export_csv(csv_file, resolve)
+
+
+@state.command("status")
+@click.argument("database", type=click.Path(exists=True, dir_okay=False))
+def state_status(database):
+    """Show the number of records by status and the references to records not published yet"""
+    with StateStore(database) as store:
+        for status, count in sorted(store.status_counts().items()):
+            click.echo(f"{count} {status} records")
+        for yaml_identifier, target in store.unresolved_references():
+            click.echo(f"{yaml_identifier} references {target}, which is not published", err=True)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,169 @@
+"""Micro-benchmarks for building XML records from YAML documents.
+
+They are not collected by pytest, run them with:
+    python -m tests.benchmark_parse [--documents N] [--memory-documents N]
+"""
+
+import argparse
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+import yaml
+
+from soduco_geonetwork.api_wrapper import xml_composers, yaml_to_xml
+
+
+# ===
+# Resources
+sample_records = os.path.dirname(__file__) + "/fixtures/instance.yaml"
+
+
+def load_sample_record() -> dict:
+    with open(sample_records, encoding="utf8") as yaml_file:
+        return yaml.safe_load(yaml_file)
+
+
+def report(label: str, elapsed: float, count: int):
+    print(f"{label:<50} {elapsed:8.3f} s  {elapsed / count * 1e6:10.1f} µs/op")
+
+
+def build_records(records: list) -> float:
+    start = time.perf_counter()
+    for record in records:
+        xml_composers.RecordDocumentBuilder().process_data_tree(record).build()
+    return time.perf_counter() - start
+
+
+# ===
+# Benchmarks
+
+
+def bench_xpath_evaluation(documents: int):
+    """Compare string XPath evaluation against the compiled expressions held by composers,
+    over the expressions evaluated for `documents` records like the sample one."""
+    builder = xml_composers.RecordDocumentBuilder().process_data_tree(load_sample_record())
+    composers = builder._composers
+    record_doc = builder.get().getroot()
+
+    start = time.perf_counter()
+    for _ in range(documents):
+        for composer in composers:
+            for point in composer.insertion_points.values():
+                xpath_expr = point[0] if isinstance(point, tuple) else point
+                composer.xml_element.xpath(xpath_expr, namespaces=xml_composers.NAMESPACES)
+            record_doc.xpath(composer.parent_xpath, namespaces=xml_composers.NAMESPACES)
+    report(f"string xpath ({documents} records)", time.perf_counter() - start, documents)
+
+    start = time.perf_counter()
+    for _ in range(documents):
+        for composer in composers:
+            for xpath, _attr in composer._insertion_xpaths.values():
+                xpath(composer.xml_element)
+            composer._parent_xpath(record_doc)
+    report(f"compiled xpath ({documents} records)", time.perf_counter() - start, documents)
+
+
+def bench_build_records(documents: int):
+    """Build `documents` copies of the sample record."""
+    record = load_sample_record()
+    xml_composers.XMLComposer.warm_template_cache()
+    elapsed = build_records([record] * documents)
+    report(f"build sample record ({documents} records)", elapsed, documents)
+
+
+def synthetic_record(items: int) -> dict:
+    """Return a record carrying `items` keywords, online resources and lineage sources."""
+    return {
+        "identifier": f"synthetic_{items}",
+        "identification": {"title": "Synthetic record"},
+        "keywords": [{"value": f"keyword {i}", "typeOfKeyword": "theme"} for i in range(items)],
+        "distributionInfo": {
+            "distributor": "The SoDUCo Project",
+            "distributor_mail": "contact@geohistoricaldata.org",
+            "onlineResources": [
+                {
+                    "linkage": f"https://example.org/{i}",
+                    "protocol": "WWW:LINK",
+                    "name": f"resource {i}",
+                    "onlineFunctionCode": "download",
+                }
+                for i in range(items)
+            ],
+        },
+        "resourceLineage": [f"sheet_{i}" for i in range(items)],
+    }
+
+
+def bench_traversal(sizes: tuple = (10, 1000, 10000)):
+    """Traverse synthetic records whose lists hold `sizes` items each.
+
+    Time per item should stay flat as the records grow.
+    """
+    for items in sizes:
+        record = synthetic_record(items)
+        start = time.perf_counter()
+        builder = xml_composers.RecordDocumentBuilder().process_data_tree(record)
+        elapsed = time.perf_counter() - start
+        report(f"process_data_tree ({items} list items)", elapsed, len(builder._composers))
+
+
+def write_synthetic_multidoc(path: str, documents: int):
+    """Write `documents` copies of the sample record, with distinct identifiers, in a yaml file."""
+    with open(sample_records, encoding="utf8") as yaml_file:
+        record = yaml_file.read()
+    record = record.split("---\n", 1)[1].rsplit("...", 1)[0]
+
+    with open(path, "w", encoding="utf8") as yaml_file:
+        for i in range(documents):
+            yaml_file.write("---\n")
+            yaml_file.write(record.replace('identifier: "001"', f'identifier: "record_{i}"'))
+
+
+def parse_peak_memory(input_file: str, output_folder: str, queue: multiprocessing.Queue):
+    """Parse `input_file` and report the peak resident memory of the process, in MiB."""
+    os.chdir(output_folder)
+    yaml_to_xml.parse(input_file, output_folder)
+    queue.put(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+
+
+def bench_parse_memory(documents: int):
+    """Measure the peak memory of `parse` for growing input files, up to `documents` documents.
+
+    Each size is parsed in a fresh process. Peak memory should stay roughly constant.
+    Beware that the generated xml files need about 10 kB of disk per document.
+    """
+    context = multiprocessing.get_context("spawn")
+    sizes = sorted({max(1, documents // 100), max(1, documents // 10), documents})
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as folder:
+            input_file = f"{folder}/records.yaml"
+            write_synthetic_multidoc(input_file, size)
+            queue = context.Queue()
+            start = time.perf_counter()
+            process = context.Process(target=parse_peak_memory, args=(input_file, folder, queue))
+            process.start()
+            peak = queue.get()
+            process.join()
+            elapsed = time.perf_counter() - start
+        print(f"{f'parse peak memory ({size} documents)':<50} {peak:8.1f} MiB  {elapsed:8.1f} s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--documents", type=int, default=2000)
+    parser.add_argument("--memory-documents", type=int, default=100000)
+    args = parser.parse_args()
+
+    bench_xpath_evaluation(args.documents)
+    bench_build_records(args.documents)
+    bench_traversal()
+    bench_parse_memory(args.memory_documents)
+
+
+#region main entrypoint
+if __name__ == "__main__":
+    main()
+#endregion
@@ -0,0 +1,305 @@
+"""Fixtures for pytest
+"""
+
+import hashlib
+import io
+import json
+import re
+import threading
+import time
+import uuid
+import zipfile
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+from lxml import etree
+
+from soduco_geonetwork.api_wrapper import config
+from soduco_geonetwork.api_wrapper.xml_composers import NAMESPACES
+
+
+API_PATH = "/geonetwork/srv/api"
+
+
+class GeonetworkStub(ThreadingHTTPServer):
+    """A local stand-in for the Geonetwork API endpoints used by this package.
+
+    Uploaded records are kept in `records` by uuid and every request is logged in `requests`.
+    Uploads of records whose uuid is in `failing` are answered with an error, those whose uuid is in `skipped`
+    with a report importing nothing.
+    The next `unavailable` requests are answered with a 503 error and a Retry-After header.
+    Once `require_session` is set, write requests need the cookie of a session opened by a log in,
+    sessions being listed in `sessions`. Log ins are answered after `login_delay` seconds.
+    With `reject_duplicates`, uploading a record already there fails unless uuidProcessing is OVERWRITE.
+    """
+
+    daemon_threads = True
+
+    def __init__(self) -> None:
+        super().__init__(("127.0.0.1", 0), GeonetworkStubHandler)
+        self.records = {}
+        self.failing = set()
+        self.skipped = set()
+        self.unavailable = 0
+        self.require_session = False
+        self.reject_duplicates = False
+        self.sessions = set()
+        self.logins = 0
+        self.login_delay = 0
+        self.requests = []
+        self.lock = threading.Lock()
+        self.url = f"http://127.0.0.1:{self.server_address[1]}"
+
+    def requests_to(self, method: str, path: str) -> list:
+        return [r for r in self.requests if r["method"] == method and r["path"] == API_PATH + path]
+
+
+class GeonetworkStubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        request = self.log_request_()
+        if self.unavailable():
+            return
+        if request["path"].startswith(API_PATH + "/records/") and request["path"].endswith("/formatters/xml"):
+            record_uuid = request["path"].split("/")[-3]
+            if record_uuid in self.server.records:
+                body = self.server.records[record_uuid]
+                etag = '"' + hashlib.sha256(body).hexdigest() + '"'
+                if self.headers.get("If-None-Match") == etag:
+                    self.reply_xml(304, b"", etag)
+                else:
+                    self.reply_xml(200, body, etag)
+            else:
+                self.reply(404, {"message": "Record not found"})
+        elif request["path"] == API_PATH + "/me":
+            if "Authorization" in self.headers:
+                time.sleep(self.server.login_delay)
+                with self.server.lock:
+                    self.server.logins += 1
+                    session = "session" if self.server.logins == 1 else f"session{self.server.logins}"
+                    self.server.sessions.add(session)
+                self.reply(200, {"username": "admin"}, cookie=f"JSESSIONID={session}")
+            else:
+                self.reply(204, None, cookie="XSRF-TOKEN=token")
+        else:
+            self.reply(404, {"message": "Not found"})
+
+    def do_PUT(self) -> None:
+        request = self.log_request_()
+        if self.unavailable() or self.unauthorized():
+            return
+        if request["path"] == API_PATH + "/records":
+            record_uuid = uploaded_uuid(request["body"])
+            if record_uuid in self.server.failing:
+                self.reply(500, {"message": "Internal error"})
+                return
+            if record_uuid in self.server.skipped:
+                self.reply(201, upload_report([]))
+                return
+            overwrite = request["query"].get("uuidProcessing") == ["OVERWRITE"]
+            if self.server.reject_duplicates and record_uuid in self.server.records and not overwrite:
+                self.reply(400, {"message": f"Record {record_uuid} already exists"})
+                return
+            with self.server.lock:
+                self.server.records[record_uuid] = request["body"]
+            self.reply(201, upload_report([record_uuid]))
+        elif request["path"] == API_PATH + "/records/batchediting":
+            with self.server.lock:
+                for record_uuid in request["query"].get("uuids", []):
+                    if record_uuid in self.server.records:
+                        self.server.records[record_uuid] = apply_edits(
+                            self.server.records[record_uuid], json.loads(request["body"])
+                        )
+            self.reply(201, processing_report(len(request["query"].get("uuids", []))))
+        else:
+            self.reply(404, {"message": "Not found"})
+
+    def do_POST(self) -> None:
+        request = self.log_request_()
+        if self.unavailable() or self.unauthorized():
+            return
+        if request["path"] == API_PATH + "/search/records/_search":
+            body = json.loads(request["body"])
+            if any("_id" in field for field in body.get("sort", [])):
+                self.reply(400, {"message": "Fielddata access on the _id field is disallowed"})
+            else:
+                self.reply(200, self.search(body))
+        elif request["path"] == API_PATH + "/records":
+            message = BytesParser().parsebytes(
+                f"Content-Type: {request['headers']['Content-Type']}\r\n\r\n".encode() + request["body"]
+            )
+            uuids = []
+            for part in message.get_payload():
+                with zipfile.ZipFile(io.BytesIO(part.get_payload(decode=True))) as archive:
+                    for name in archive.namelist():
+                        if name.endswith("/metadata/metadata.xml"):
+                            body = archive.read(name)
+                            record_uuid = uploaded_uuid(body)
+                            if record_uuid not in self.server.failing:
+                                with self.server.lock:
+                                    self.server.records[record_uuid] = body
+                                uuids.append(record_uuid)
+            self.reply(201, upload_report(uuids))
+        else:
+            self.reply(404, {"message": "Not found"})
+
+    def do_DELETE(self) -> None:
+        request = self.log_request_()
+        if self.unavailable() or self.unauthorized():
+            return
+        if request["path"] == API_PATH + "/records":
+            uuids = request["query"].get("uuids", [])
+            with self.server.lock:
+                for record_uuid in uuids:
+                    self.server.records.pop(record_uuid, None)
+            self.reply(200, processing_report(len(uuids)))
+        else:
+            self.reply(404, {"message": "Not found"})
+
+    def search(self, body: dict) -> dict:
+        """Answer a search on the uploaded records sorted by uuid, a query_string matching their xml
+
+        Sorting on `_id` is refused, as by Elasticsearch 8 where fielddata on `_id` is disabled.
+        """
+        query_string = body.get("query", {}).get("query_string", {}).get("query")
+        with self.server.lock:
+            records = sorted(self.server.records.items())
+        hits = [
+            {"_id": record_uuid, "_source": {"uuid": record_uuid}, "sort": [record_uuid]}
+            for record_uuid, record in records
+            if not query_string or query_string.encode() in record
+        ]
+        if "search_after" in body:
+            hits = [hit for hit in hits if hit["sort"] > body["search_after"]]
+        return {"hits": {"hits": hits[:body.get("size", 10)]}}
+
+    def unavailable(self) -> bool:
+        with self.server.lock:
+            if self.server.unavailable <= 0:
+                return False
+            self.server.unavailable -= 1
+        self.send_response(503)
+        self.send_header("Retry-After", "0")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+        return True
+
+    def unauthorized(self) -> bool:
+        if not self.server.require_session:
+            return False
+        cookies = dict(
+            cookie.strip().split("=", 1) for cookie in self.headers.get("Cookie", "").split(";") if "=" in cookie
+        )
+        if cookies.get("JSESSIONID") in self.server.sessions:
+            return False
+        self.reply(403, {"message": "Access denied"})
+        return True
+
+    def log_request_(self) -> dict:
+        url = urlsplit(self.path)
+        length = int(self.headers.get("Content-Length") or 0)
+        request = {
+            "method": self.command,
+            "path": url.path,
+            "query": parse_qs(url.query),
+            "headers": dict(self.headers),
+            "body": self.rfile.read(length),
+            "client_address": self.client_address,
+        }
+        with self.server.lock:
+            self.server.requests.append(request)
+        return request
+
+    def reply_xml(self, status: int, body: bytes, etag: str = None) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", "application/xml")
+        if etag:
+            self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def reply(self, status: int, payload, cookie: str = None) -> None:
+        body = json.dumps(payload).encode() if payload is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if cookie:
+            self.send_header("Set-Cookie", f"{cookie}; Path=/")
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def apply_edits(record: bytes, edits: list) -> bytes:
+    """Apply batch edits to a record the way Geonetwork does for the modes used by this package"""
+    root = etree.fromstring(record)
+    for edit in edits:
+        match = re.fullmatch(r"<gn_(add|replace|delete)>(.*)</gn_\1>", edit["value"], re.S)
+        mode, value = match.groups() if match else ("replace", edit["value"])
+        for element in etree.ElementTree(root).xpath(edit["xpath"], namespaces=NAMESPACES):
+            if mode == "delete":
+                element.getparent().remove(element)
+            elif mode == "add":
+                element.append(parse_fragment(value))
+            else:
+                element.getparent().replace(element, parse_fragment(value))
+    return etree.tostring(root)
+
+
+def parse_fragment(value: str):
+    """Parse a xml fragment, whose prefixes may be declared by the record only"""
+    declarations = " ".join(f'xmlns:{prefix}="{uri}"' for prefix, uri in NAMESPACES.items())
+    return etree.fromstring(f"<fragment {declarations}>{value}</fragment>")[0]
+
+
+def uploaded_uuid(body: bytes) -> str:
+    match = re.search(
+        rb"<mdb:metadataIdentifier>.*?<gco:CharacterString>(.*?)</gco:CharacterString>", body, re.S
+    )
+    return match.group(1).decode() if match else str(uuid.uuid4())
+
+
+def processing_report(records: int) -> dict:
+    return {
+        "errors": [],
+        "infos": [],
+        "metadataErrors": {},
+        "metadataInfos": {},
+        "numberOfRecordsProcessed": records,
+        "numberOfRecordsWithErrors": 0,
+        "type": "SimpleMetadataProcessingReport",
+    }
+
+
+def upload_report(uuids: list) -> dict:
+    report = processing_report(len(uuids))
+    report["metadataInfos"] = {
+        str(db_id): [{"message": f"Metadata imported with UUID {record_uuid}", "uuid": record_uuid}]
+        for db_id, record_uuid in enumerate(uuids, start=1)
+    }
+    return report
+
+
+@pytest.fixture
+def geonetwork_server(monkeypatch):
+    """Start a Geonetwork stand-in and point the API routes of the config module to it"""
+    server = GeonetworkStub()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    api_url = server.url + API_PATH
+    monkeypatch.setattr(config, "api_route_me", api_url + "/me")
+    monkeypatch.setattr(config, "api_route_records", api_url + "/records")
+    monkeypatch.setattr(config, "api_route_batchediting", api_url + "/records/batchediting")
+    monkeypatch.setattr(config, "api_route_search", api_url + "/search/records/_search")
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,71 @@
+"""Tests for the asyncio client against a local Geonetwork stand-in
+"""
+
+import asyncio
+import json
+import os
+
+import pytest
+
+from soduco_geonetwork.api_wrapper import helpers
+
+aiohttp = pytest.importorskip("aiohttp")
+
+from soduco_geonetwork.api_wrapper.async_client import AsyncGeoNetworkClient
+
+
+# ===
+# Resources
+sample_record = os.path.dirname(__file__) + "/fixtures/catalog_xml_example.xml"
+
+
+def test_async_upload_update_delete(geonetwork_server):
+    """Do the async methods return the same responses as the dataset functions ?"""
+
+    async def scenario():
+        async with AsyncGeoNetworkClient(concurrency=4) as client:
+            await client.log_in("admin", "admin")
+            uploads = await asyncio.gather(
+                *(client.upload(helpers.read_xml_file(sample_record)) for _ in range(3))
+            )
+            record_uuid = helpers.get_geonetwork_uuid(uploads[0])
+            update = await client.update([record_uuid], "//mri:abstract", "<gco:CharacterString/>", "REPLACE")
+            delete = await client.delete([record_uuid])
+            return record_uuid, update, delete
+
+    record_uuid, update, delete = asyncio.run(scenario())
+
+    assert record_uuid == "abc9604f-6e12-4691-b862-7e636f837ce4"
+    assert update["numberOfRecordsProcessed"] == 1
+    assert delete["numberOfRecordsProcessed"] == 1
+    assert record_uuid not in geonetwork_server.records
+
+    batchedit = geonetwork_server.requests_to("PUT", "/records/batchediting")[0]
+    assert batchedit["headers"]["X-XSRF-TOKEN"] == "token"
+    assert b"<gn_replace>" in batchedit["body"]
+
+
+def test_async_edit_postponed_values(geonetwork_server):
+    """Are all the postponed links of a record fixed in one batch edit request ?"""
+    postponed = {
+        "uuid": "record",
+        "associatedResource": [{"value": "atlas_uuid", "typeOfAssociation": "largerWorkCitation"}],
+        "resourceLineage": ["sheet_uuid"],
+    }
+    prior = {
+        "uuid": "record",
+        "associatedResource": [{"value": "atlas", "typeOfAssociation": "largerWorkCitation"}],
+        "resourceLineage": [{"value": "sheet"}],
+    }
+
+    async def scenario():
+        async with AsyncGeoNetworkClient() as client:
+            await client.log_in("admin", "admin")
+            return await client.edit_postponed_values(postponed, prior)
+
+    responses = asyncio.run(scenario())
+
+    assert len(responses) == 1
+    batchedits = geonetwork_server.requests_to("PUT", "/records/batchediting")
+    assert len(batchedits) == 1
+    assert len(json.loads(batchedits[0]["body"])) == 2
@@ -4,8 +4,11 @@
 import csv
 import os
 import subprocess
+import uuid
 from importlib import import_module
 
+import yaml
+
 from click.testing import CliRunner
 
 import soduco_geonetwork.cli.cli as cli
@@ -82,6 +85,13 @@ def test_cmd_delete_records_available():
     assert result.exit_code == 0
 
 
+def test_cmd_patch_records_available():
+    """Is patch command available ?"""
+    runner = CliRunner()
+    result = runner.invoke(cli.patch, "--help")
+    assert result.exit_code == 0
+
+
 def test_fail_without_secret():
     """
     Must fail without a ``SECRET`` environment variable specified
@@ -163,3 +173,355 @@ def test_parse_documents_raise_exception_on_bad_file_format():
     assert isinstance(result.exception, ValueError)
 
     os.unlink(wrong_input_file)
+
+
+# ===
+# Command upload
+
+
+@pytest.mark.parametrize("options", [[], ["--raw", "--check-xml"]])
+def test_concurrent_upload_keeps_csv_order(tmp_path, monkeypatch, geonetwork_server, options):
+    """Does a concurrent upload match each csv row with its uuid and collect failures ?"""
+    with open(sample_records, encoding="utf8") as yaml_file:
+        record = yaml.safe_load(yaml_file)
+    input_file = tmp_path / "records.yaml"
+    with open(input_file, "w", encoding="utf8") as yaml_file:
+        yaml.safe_dump_all(
+            [dict(record, identifier=f"record_{i}") for i in range(8)], yaml_file, allow_unicode=True
+        )
+    monkeypatch.chdir(tmp_path)
+    CliRunner().invoke(cli.parse, [str(input_file), "--output_folder", str(tmp_path)])
+    geonetwork_server.failing.add(str(uuid.uuid5(uuid.NAMESPACE_X500, "record_5")))
+
+    result = CliRunner().invoke(cli.cli, ["upload", "yaml_list.csv", "--concurrency", "4"] + options)
+
+    assert result.exit_code == 1
+    assert "1 of 8 records could not be uploaded" in result.output
+    with open(tmp_path / "yaml_list.csv", encoding="utf8") as csv_file:
+        rows = list(csv.DictReader(csv_file))
+    assert [row["yaml_identifier"] for row in rows] == [f"record_{i}" for i in range(8)]
+    for row in rows:
+        expected = "" if row["yaml_identifier"] == "record_5" else str(
+            uuid.uuid5(uuid.NAMESPACE_X500, row["yaml_identifier"])
+        )
+        assert row["geonetwork_uuid"] == expected
+
+
+def test_upload_reports_a_record_missing_from_its_import_report(tmp_path, monkeypatch, geonetwork_server):
+    """Is an upload answered with a report importing nothing a failure of its row only ?"""
+    with open(sample_records, encoding="utf8") as yaml_file:
+        record = yaml.safe_load(yaml_file)
+    input_file = tmp_path / "records.yaml"
+    with open(input_file, "w", encoding="utf8") as yaml_file:
+        yaml.safe_dump_all(
+            [dict(record, identifier=f"record_{i}") for i in range(4)], yaml_file, allow_unicode=True
+        )
+    monkeypatch.chdir(tmp_path)
+    CliRunner().invoke(cli.parse, [str(input_file), "--output_folder", str(tmp_path)])
+    geonetwork_server.skipped.add(str(uuid.uuid5(uuid.NAMESPACE_X500, "record_1")))
+
+    result = CliRunner().invoke(cli.cli, ["upload", "yaml_list.csv", "--concurrency", "2"])
+
+    assert result.exit_code == 1
+    assert "1 of 4 records could not be uploaded" in result.output
+    with open(tmp_path / "yaml_list.csv", encoding="utf8") as csv_file:
+        uuids = [row["geonetwork_uuid"] for row in csv.DictReader(csv_file)]
+    assert uuids == [
+        "" if i == 1 else str(uuid.uuid5(uuid.NAMESPACE_X500, f"record_{i}")) for i in range(4)
+    ]
+
+
+def test_bulk_upload_maps_report_to_rows(tmp_path, monkeypatch, geonetwork_server):
+    """Does a bulk upload send archives of --chunk-size records and match each csv row with its uuid ?"""
+    with open(sample_records, encoding="utf8") as yaml_file:
+        record = yaml.safe_load(yaml_file)
+    input_file = tmp_path / "records.yaml"
+    with open(input_file, "w", encoding="utf8") as yaml_file:
+        yaml.safe_dump_all(
+            [dict(record, identifier=f"record_{i}") for i in range(7)], yaml_file, allow_unicode=True
+        )
+    monkeypatch.chdir(tmp_path)
+    CliRunner().invoke(cli.parse, [str(input_file), "--output_folder", str(tmp_path)])
+    geonetwork_server.failing.add(str(uuid.uuid5(uuid.NAMESPACE_X500, "record_2")))
+
+    result = CliRunner().invoke(cli.cli, ["upload", "yaml_list.csv", "--bulk", "--chunk-size", "3"])
+
+    assert result.exit_code == 1
+    assert "1 of 7 records could not be uploaded" in result.output
+    assert len(geonetwork_server.requests_to("POST", "/records")) == 3
+    assert not geonetwork_server.requests_to("PUT", "/records")
+    with open(tmp_path / "yaml_list.csv", encoding="utf8") as csv_file:
+        rows = list(csv.DictReader(csv_file))
+    assert [row["yaml_identifier"] for row in rows] == [f"record_{i}" for i in range(7)]
+    for row in rows:
+        expected = "" if row["yaml_identifier"] == "record_2" else str(
+            uuid.uuid5(uuid.NAMESPACE_X500, row["yaml_identifier"])
+        )
+        assert row["geonetwork_uuid"] == expected
+
+
+def test_patch_groups_rows_with_identical_patches(tmp_path, geonetwork_server):
+    """Does patch send one request per distinct patch, with templates formatted per row ?"""
+    csv_file = tmp_path / "yaml_list.csv"
+    with open(csv_file, "w", newline="", encoding="utf8") as file:
+        writer = csv.DictWriter(file, fieldnames=["yaml_identifier", "geonetwork_uuid", "sheet"])
+        writer.writeheader()
+        writer.writerows([
+            {"yaml_identifier": f"record_{i}", "geonetwork_uuid": f"uuid_{i}", "sheet": i % 2} for i in range(5)
+        ])
+        writer.writerow({"yaml_identifier": "not_uploaded", "geonetwork_uuid": "", "sheet": 0})
+    spec_file = tmp_path / "spec.yaml"
+    with open(spec_file, "w", encoding="utf8") as file:
+        yaml.safe_dump([
+            {"xpath": ".//cit:CI_Organisation", "value": "<cit:logo/>", "mode": "ADD"},
+            {
+                "xpath": ".//cit:CI_Citation/cit:title", "value": "<cit:title>sheet {sheet}</cit:title>",
+                "mode": "REPLACE", "template": True,
+            },
+        ], file)
+
+    result = CliRunner().invoke(
+        cli.cli, ["patch", str(spec_file), str(csv_file), "--concurrency", "2", "--adaptive"]
+    )
+
+    assert result.exit_code == 0, result.output
+    batchedits = geonetwork_server.requests_to("PUT", "/records/batchediting")
+    edited = {
+        tuple(b["query"]["uuids"]): [edit["value"] for edit in yaml.safe_load(b["body"])] for b in batchedits
+    }
+    assert edited == {
+        ("uuid_0", "uuid_2", "uuid_4"): ["<gn_add><cit:logo/></gn_add>", "<gn_replace><cit:title>sheet 0</cit:title></gn_replace>"],
+        ("uuid_1", "uuid_3"): ["<gn_add><cit:logo/></gn_add>", "<gn_replace><cit:title>sheet 1</cit:title></gn_replace>"],
+    }
+
+
+def test_patch_rejects_unknown_template_columns(tmp_path, geonetwork_server):
+    """Does patch fail before sending anything when a template uses a missing column ?"""
+    csv_file = tmp_path / "yaml_list.csv"
+    csv_file.write_text("yaml_identifier,geonetwork_uuid\nrecord,uuid\n", encoding="utf8")
+    spec_file = tmp_path / "spec.csv"
+    spec_file.write_text(
+        "xpath,value,mode,template\n.//cit:title,<cit:title>{missing}</cit:title>,REPLACE,true\n", encoding="utf8"
+    )
+
+    result = CliRunner().invoke(cli.cli, ["patch", str(spec_file), str(csv_file)])
+
+    assert result.exit_code == 1
+    assert "Unknown column 'missing'" in result.output
+    assert not geonetwork_server.requests_to("PUT", "/records/batchediting")
+
+
+def test_patch_rejects_malformed_spec_files(tmp_path, geonetwork_server):
+    """Are empty spec files and patches that are not mappings reported with the file and the patch ?"""
+    csv_file = tmp_path / "yaml_list.csv"
+    csv_file.write_text("yaml_identifier,geonetwork_uuid\nrecord,uuid\n", encoding="utf8")
+    spec_file = tmp_path / "spec.yaml"
+
+    for content, message in [("", "does not hold a list of patches"), ("- .//cit:title\n", "Patch 1 of")]:
+        spec_file.write_text(content, encoding="utf8")
+        result = CliRunner().invoke(cli.cli, ["patch", str(spec_file), str(csv_file)])
+
+        assert result.exit_code == 2
+        assert message in result.output
+        assert "spec.yaml" in result.output
+    assert not geonetwork_server.requests_to("PUT", "/records/batchediting")
+
+
+def test_patch_sends_braces_of_fixed_values_as_they_are(tmp_path, geonetwork_server):
+    """Are braces in patches without template sent as is, and reported in malformed templates ?"""
+    csv_file = tmp_path / "yaml_list.csv"
+    csv_file.write_text("yaml_identifier,geonetwork_uuid\nrecord,uuid\n", encoding="utf8")
+    spec_file = tmp_path / "spec.yaml"
+    patch = {"xpath": ".//gex:polygon", "value": '<gco:CharacterString>{"type": "Point"}</gco:CharacterString>'}
+    spec_file.write_text(yaml.safe_dump([patch]), encoding="utf8")
+
+    result = CliRunner().invoke(cli.cli, ["patch", str(spec_file), str(csv_file)])
+
+    assert result.exit_code == 0, result.output
+    batchedit = geonetwork_server.requests_to("PUT", "/records/batchediting")[0]
+    assert yaml.safe_load(batchedit["body"])[0]["value"] == patch["value"]
+
+    spec_file.write_text(yaml.safe_dump([dict(patch, value="<gml:pos>1 2}</gml:pos>", template=True)]), encoding="utf8")
+    result = CliRunner().invoke(cli.cli, ["patch", str(spec_file), str(csv_file)])
+
+    assert result.exit_code == 1
+    assert "Invalid patch template" in result.output
+
+
+def test_adaptive_delete_sends_chunks_and_reports_concurrency(tmp_path, geonetwork_server):
+    """Does delete send all the chunks with an adaptive concurrency and report its changes ?"""
+    csv_file = tmp_path / "yaml_list.csv"
+    csv_file.write_text(
+        "geonetwork_uuid\n" + "".join(f"uuid_{i}\n" for i in range(450)), encoding="utf8"
+    )
+
+    result = CliRunner().invoke(
+        cli.cli, ["delete", str(csv_file), "--concurrency", "8", "--adaptive"]
+    )
+
+    assert result.exit_code == 0, result.output
+    deletes = geonetwork_server.requests_to("DELETE", "/records")
+    assert sorted(len(d["query"]["uuids"]) for d in deletes) == [50, 100, 100, 100, 100]
+    assert "Concurrency set to 5 after healthy responses" in result.output
+
+
+def test_delete_takes_the_client_options(tmp_path, geonetwork_server):
+    """Does --retries set how many times a request of delete failing with a transient error is sent again ?"""
+    csv_file = tmp_path / "yaml_list.csv"
+    csv_file.write_text("geonetwork_uuid\nuuid\n", encoding="utf8")
+    geonetwork_server.unavailable = 1
+
+    result = CliRunner().invoke(cli.cli, ["delete", str(csv_file), "--retries", "0", "--rate", "100"])
+    assert result.exit_code == 1
+    assert not geonetwork_server.requests_to("DELETE", "/records")
+
+    geonetwork_server.unavailable = 1
+    result = CliRunner().invoke(cli.cli, ["delete", str(csv_file), "--retries", "1"])
+    assert result.exit_code == 0, result.output
+    assert len(geonetwork_server.requests_to("DELETE", "/records")) == 1
+
+    for command in (cli.update, cli.update_postponed_values):
+        assert "--retries" in CliRunner().invoke(command, ["--help"]).output
+
+
+def write_records(path, identifiers, titles=None):
+    with open(sample_records, encoding="utf8") as yaml_file:
+        record = yaml.safe_load(yaml_file)
+    titles = titles or {}
+    with open(path, "w", encoding="utf8") as yaml_file:
+        yaml.safe_dump_all(
+            [
+                dict(
+                    record, identifier=identifier,
+                    identification=dict(record["identification"], title=titles.get(identifier, "Title")),
+                )
+                for identifier in identifiers
+            ],
+            yaml_file, allow_unicode=True,
+        )
+
+
+def test_sync_uploads_only_changed_records(tmp_path, monkeypatch, geonetwork_server):
+    """Does sync upload new records, overwrite changed ones, skip unchanged ones and delete removed ones ?"""
+    geonetwork_server.reject_duplicates = True
+    monkeypatch.chdir(tmp_path)
+    input_file = tmp_path / "records.yaml"
+    write_records(input_file, [f"record_{i}" for i in range(5)])
+    CliRunner().invoke(cli.parse, [str(input_file), "--output_folder", str(tmp_path)])
+
+    result = CliRunner().invoke(cli.cli, ["sync", "yaml_list.csv"])
+    assert result.exit_code == 0, result.output
+    assert "5 new, 0 changed, 0 unchanged, 0 removed records." in result.output
+    assert len(geonetwork_server.requests_to("PUT", "/records")) == 5
+
+    write_records(input_file, [f"record_{i}" for i in range(4)], titles={"record_1": "A new title"})
+    CliRunner().invoke(cli.parse, [str(input_file), "--output_folder", str(tmp_path)])
+    result = CliRunner().invoke(cli.cli, ["sync", "yaml_list.csv", "--delete-removed"])
+
+    assert result.exit_code == 0, result.output
+    assert "0 new, 1 changed, 3 unchanged, 1 removed records." in result.output
+    puts = geonetwork_server.requests_to("PUT", "/records")
+    assert len(puts) == 6
+    assert puts[-1]["query"]["uuidProcessing"] == ["OVERWRITE"]
+    removed_uuid = str(uuid.uuid5(uuid.NAMESPACE_X500, "record_4"))
+    assert geonetwork_server.requests_to("DELETE", "/records")[0]["query"]["uuids"] == [removed_uuid]
+    assert sorted(geonetwork_server.records) == sorted(
+        str(uuid.uuid5(uuid.NAMESPACE_X500, f"record_{i}")) for i in range(4)
+    )
+    with open(tmp_path / "yaml_list.csv", encoding="utf8") as csv_file:
+        assert all(row["geonetwork_uuid"] for row in csv.DictReader(csv_file))
+
+    result = CliRunner().invoke(cli.cli, ["sync", "yaml_list.csv", "--remote", "--state", str(tmp_path / "none.csv")])
+    assert result.exit_code == 0, result.output
+    assert "0 new, 0 changed, 4 unchanged, 0 removed records." in result.output
+    assert len(geonetwork_server.requests_to("PUT", "/records")) == 6
+
+
+def test_sync_without_state_compares_normalized_published_records(tmp_path, monkeypatch, geonetwork_server):
+    """Does a first sync without state overwrite records published before, and --remote skip server rewrites ?"""
+    geonetwork_server.reject_duplicates = True
+    monkeypatch.chdir(tmp_path)
+    input_file = tmp_path / "records.yaml"
+    write_records(input_file, ["record_0", "record_1"])
+    CliRunner().invoke(cli.parse, [str(input_file), "--output_folder", str(tmp_path)])
+    CliRunner().invoke(cli.cli, ["upload", "yaml_list.csv"])
+
+    result = CliRunner().invoke(cli.cli, ["sync", "yaml_list.csv"])
+    assert result.exit_code == 0, result.output
+    assert "2 new, 0 changed, 0 unchanged, 0 removed records." in result.output
+
+    date_info = (
+        b'<mdb:dateInfo xmlns:mdb="http://standards.iso.org/iso/19115/-3/mdb/2.0">2024-01-01</mdb:dateInfo>'
+    )
+    for record_uuid, record in geonetwork_server.records.items():
+        geonetwork_server.records[record_uuid] = record.replace(b"</mdb:MD_Metadata>", date_info + b"</mdb:MD_Metadata>")
+    result = CliRunner().invoke(cli.cli, ["sync", "yaml_list.csv", "--remote", "--state", str(tmp_path / "none.csv")])
+
+    assert result.exit_code == 0, result.output
+    assert "0 new, 0 changed, 2 unchanged, 0 removed records." in result.output
+    assert len(geonetwork_server.requests_to("PUT", "/records")) == 4
+
+
+def test_fetch_revalidates_cached_records(tmp_path, geonetwork_server):
+    """Does a second fetch only transfer the records changed on the server ?"""
+    geonetwork_server.records.update({f"uuid_{i}": f"<record>{i}</record>".encode() for i in range(3)})
+    csv_file = tmp_path / "yaml_list.csv"
+    csv_file.write_text("geonetwork_uuid\nuuid_0\nuuid_1\nuuid_2\nmissing\n", encoding="utf8")
+    output_folder = tmp_path / "records"
+
+    result = CliRunner().invoke(cli.cli, ["fetch", str(csv_file), str(output_folder), "--concurrency", "2"])
+    assert result.exit_code == 0, result.output
+    assert "3 records downloaded, 0 not modified, 1 missing." in result.output
+    assert (output_folder / "uuid_1.xml").read_bytes() == b"<record>1</record>"
+
+    geonetwork_server.records["uuid_1"] = b"<record>changed</record>"
+    result = CliRunner().invoke(cli.cli, ["fetch", str(csv_file), str(output_folder)])
+
+    assert result.exit_code == 0, result.output
+    assert "1 records downloaded, 2 not modified, 1 missing." in result.output
+    assert (output_folder / "uuid_1.xml").read_bytes() == b"<record>changed</record>"
+    revalidations = [r for r in geonetwork_server.requests if "If-None-Match" in r["headers"]]
+    assert len(revalidations) == 3
+
+
+def test_search_writes_uuids_for_delete(tmp_path, geonetwork_server):
+    """Does search write a csv of matching uuids that delete can consume ?"""
+    geonetwork_server.records.update({f"uuid_{i}": b"<record>Verniquet</record>" for i in range(5)})
+    geonetwork_server.records["other"] = b"<record>Jacoubet</record>"
+    csv_file = tmp_path / "found.csv"
+
+    result = CliRunner().invoke(cli.cli, ["search", str(csv_file), "--query", "Verniquet", "--page-size", "2"])
+
+    assert result.exit_code == 0, result.output
+    assert "5 records found." in result.output
+    result = CliRunner().invoke(cli.cli, ["delete", str(csv_file)])
+    assert result.exit_code == 0, result.output
+    assert list(geonetwork_server.records) == ["other"]
+
+
+def test_sync_patches_changed_records(tmp_path, monkeypatch, geonetwork_server):
+    """Does sync --patch send batch edits instead of uploading a slightly changed record again,
+    leaving the elements rewritten by the server alone ?"""
+    monkeypatch.chdir(tmp_path)
+    input_file = tmp_path / "records.yaml"
+    write_records(input_file, ["record_0", "record_1"])
+    CliRunner().invoke(cli.parse, [str(input_file), "--output_folder", str(tmp_path)])
+    CliRunner().invoke(cli.cli, ["sync", "yaml_list.csv"])
+    date_info = (
+        b'<mdb:dateInfo xmlns:mdb="http://standards.iso.org/iso/19115/-3/mdb/2.0">2024-01-01</mdb:dateInfo>'
+    )
+    for record_uuid, record in geonetwork_server.records.items():
+        geonetwork_server.records[record_uuid] = record.replace(b"</mdb:MD_Metadata>", date_info + b"</mdb:MD_Metadata>")
+
+    write_records(input_file, ["record_0", "record_1"], titles={"record_1": "A new title"})
+    CliRunner().invoke(cli.parse, [str(input_file), "--output_folder", str(tmp_path)])
+    result = CliRunner().invoke(cli.cli, ["sync", "yaml_list.csv", "--patch"])
+
+    assert result.exit_code == 0, result.output
+    assert ": patch" in result.output
+    assert len(geonetwork_server.requests_to("PUT", "/records")) == 2
+    batchedits = geonetwork_server.requests_to("PUT", "/records/batchediting")
+    assert len(batchedits) == 1
+    assert b"A new title" in batchedits[0]["body"]
+    assert b"A new title" in geonetwork_server.records[str(uuid.uuid5(uuid.NAMESPACE_X500, "record_1"))]
+    assert b"2024-01-01" in geonetwork_server.records[str(uuid.uuid5(uuid.NAMESPACE_X500, "record_1"))]
@@ -0,0 +1,92 @@
+"""Tests for the concurrency module
+"""
+
+import threading
+import time
+
+import requests
+
+from soduco_geonetwork.api_wrapper.concurrency import AdaptiveLimit, Failure, map_concurrently, percentile
+
+
+def http_error(status: int) -> requests.HTTPError:
+    response = requests.Response()
+    response.status_code = status
+    return requests.HTTPError(response=response)
+
+
+def test_adaptive_limit_increases_additively_and_decreases_multiplicatively():
+    """Does the limit grow by about one per window of successes and halve on a server error ?"""
+    limit = AdaptiveLimit(initial=4, maximum=8)
+
+    for _ in range(3):
+        limit.release(limit.acquire())
+    assert limit.limit == 4
+    for _ in range(2):
+        limit.release(limit.acquire())
+    assert limit.limit == 5
+
+    limit.release(limit.acquire(), overloaded=True)
+    assert limit.limit == 2
+
+
+def test_adaptive_limit_decreases_once_per_round_trip():
+    """Do calls started before a decrease leave the limit alone when they fail too ?"""
+    limit = AdaptiveLimit(initial=8, maximum=8)
+    started = [limit.acquire() for _ in range(4)]
+
+    for start in started:
+        limit.release(start, overloaded=True)
+
+    assert limit.limit == 4
+    assert limit.in_flight == 0
+
+
+def test_adaptive_limit_backs_off_on_latency_increase():
+    """Does a p95 latency well above the average latency decrease the limit ?"""
+    changes = []
+    limit = AdaptiveLimit(initial=4, maximum=4, window=5, on_change=lambda stats, reason: changes.append(reason))
+    now = time.monotonic()
+    for _ in range(5):
+        limit.acquire()
+        limit.release(now - 0.01)
+    assert limit.limit == 4
+
+    limit.acquire()
+    limit.release(time.monotonic() - 1)
+
+    assert limit.limit == 2
+    assert changes == ["latency increase"]
+    assert limit.stats().p95_latency >= 1
+
+
+def test_map_concurrently_follows_adaptive_limit():
+    """Are calls in flight bounded by the adaptive limit, which shrinks on server errors ?"""
+    limit = AdaptiveLimit(initial=4, maximum=4)
+    lock = threading.Lock()
+    in_flight = []
+    peak = [0]
+
+    def work(item):
+        with lock:
+            in_flight.append(item)
+            peak[0] = max(peak[0], len(in_flight))
+        time.sleep(0.01)
+        with lock:
+            in_flight.remove(item)
+        if item % 5 == 0:
+            raise http_error(503)
+        return item * 2
+
+    results = list(map_concurrently(work, range(20), limit))
+
+    assert [item for item, _ in results] == list(range(20))
+    assert [isinstance(result, Failure) for _, result in results] == [i % 5 == 0 for i in range(20)]
+    assert peak[0] <= 4
+    assert limit.limit < 4
+
+
+def test_percentile():
+    assert percentile([], 0.95) is None
+    assert percentile(range(1, 101), 0.95) == 95
+    assert percentile([3, 1, 2], 0.5) == 2
@@ -0,0 +1,381 @@
+"""Tests for the dataset module against a local Geonetwork stand-in
+"""
+
+import json
+import os
+import threading
+import time
+import xml.parsers.expat
+import zipfile
+
+import pytest
+
+import requests
+
+from soduco_geonetwork.api_wrapper import config, dataset, geonetwork, helpers
+from soduco_geonetwork.api_wrapper.client import GeoNetworkClient, RateLimiter, RetryPolicy, parse_retry_after
+from soduco_geonetwork.api_wrapper.session_cache import SessionCache
+
+
+# ===
+# Resources
+sample_record = os.path.dirname(__file__) + "/fixtures/catalog_xml_example.xml"
+
+
+def log_in(**kwargs) -> GeoNetworkClient:
+    return geonetwork.log_in("admin", "admin", GeoNetworkClient(**kwargs))
+
+
+# ===
+# Client
+
+
+def test_log_in_returns_client_with_csrf_headers(geonetwork_server):
+    """Does logging in build the headers sent with the next requests ?"""
+    client = geonetwork.log_in("admin", "admin")
+
+    assert isinstance(client, GeoNetworkClient)
+    assert client.headers["X-XSRF-TOKEN"] == "token"
+    assert client.cookies.get_dict()["JSESSIONID"] == "session"
+
+
+def test_client_reuses_connections(geonetwork_server):
+    """Do successive requests of a client share a kept-alive connection ?"""
+    client = log_in()
+    for _ in range(5):
+        dataset.delete(["a"], client)
+
+    deletes = geonetwork_server.requests_to("DELETE", "/records")
+    assert len(deletes) == 5
+    assert len({r["client_address"] for r in deletes}) == 1
+    assert all(r["headers"]["X-XSRF-TOKEN"] == "token" for r in deletes)
+
+
+def test_functions_accept_a_requests_session(geonetwork_server):
+    """Can the dataset functions still be called with a logged in requests.Session ?"""
+    session = log_in().session
+    assert isinstance(session, requests.Session)
+
+    response = dataset.upload(helpers.read_xml_file(sample_record), session)
+
+    assert helpers.get_geonetwork_uuid(response.json()) in geonetwork_server.records
+    assert geonetwork_server.requests_to("PUT", "/records")[0]["headers"]["X-XSRF-TOKEN"] == "token"
+
+
+# ===
+# Raw upload
+
+
+def test_raw_upload_sends_file_bytes_as_is(geonetwork_server):
+    """Is the file sent byte for byte as a xml document ?"""
+    session = log_in()
+
+    response = dataset.upload_file(sample_record, session, check_xml=True)
+
+    assert response.status_code == 201
+    put = geonetwork_server.requests_to("PUT", "/records")[0]
+    with open(sample_record, "rb") as file:
+        assert put["body"] == file.read()
+    assert put["headers"]["Content-Type"] == "application/xml"
+
+
+def test_raw_upload_check_rejects_malformed_files(geonetwork_server, tmp_path):
+    """Is a malformed file rejected before being sent when checked ?"""
+    session = log_in()
+    xml_file = tmp_path / "broken.xml"
+    xml_file.write_text("<mdb:MD_Metadata><unclosed></mdb:MD_Metadata>", encoding="utf8")
+
+    with pytest.raises(xml.parsers.expat.ExpatError):
+        dataset.upload_file(xml_file, session, check_xml=True)
+    assert not geonetwork_server.requests_to("PUT", "/records")
+
+
+# ===
+# Session cache
+
+
+def test_cached_session_skips_log_in(geonetwork_server, tmp_path):
+    """Is a cached session reused by the next log in, from a cache file only readable by its owner ?"""
+    geonetwork_server.require_session = True
+    cache = SessionCache(str(tmp_path / "sessions"))
+    geonetwork.log_in("admin", "admin", cache=cache)
+    assert len(geonetwork_server.requests_to("GET", "/me")) == 2
+    cache_files = os.listdir(tmp_path / "sessions")
+    assert len(cache_files) == 1
+    assert os.stat(tmp_path / "sessions" / cache_files[0]).st_mode & 0o777 == 0o600
+
+    session = geonetwork.log_in("admin", "admin", cache=cache)
+    dataset.delete(["uuid"], session)
+
+    assert len(geonetwork_server.requests_to("GET", "/me")) == 2
+    assert session.headers["X-XSRF-TOKEN"] == "token"
+    assert cache.load(config.api_route_me, "other_user") is None
+
+
+def test_expired_session_is_renewed_once(geonetwork_server, tmp_path):
+    """Is a request denied with an expired session sent again after a new log in, which is cached ?"""
+    geonetwork_server.require_session = True
+    cache = SessionCache(str(tmp_path))
+    geonetwork.log_in("admin", "admin", cache=cache)
+    geonetwork_server.sessions.clear()
+
+    session = geonetwork.log_in("admin", "admin", cache=cache)
+    response = dataset.upload(helpers.read_xml_file(sample_record), session)
+
+    assert response.status_code == 201
+    assert len(geonetwork_server.requests_to("PUT", "/records")) == 2
+    assert len(geonetwork_server.requests_to("GET", "/me")) == 4
+    assert cache.load(config.api_route_me, "admin").get_dict()["JSESSIONID"] in geonetwork_server.sessions
+
+
+def test_session_expiring_during_concurrent_requests(geonetwork_server):
+    """Are requests sent while another thread logs in again sent once more with the new session ?"""
+    session = log_in()
+    geonetwork_server.require_session = True
+    geonetwork_server.sessions.clear()
+    geonetwork_server.login_delay = 0.3
+
+    errors = []
+
+    def delete():
+        try:
+            dataset.delete(["uuid"], session)
+        except requests.HTTPError as error:
+            errors.append(error)
+
+    first = threading.Thread(target=delete)
+    first.start()
+    time.sleep(0.1)
+    others = [threading.Thread(target=delete) for _ in range(7)]
+    for thread in others:
+        thread.start()
+    for thread in [first, *others]:
+        thread.join()
+
+    assert errors == []
+    assert geonetwork_server.logins == 2
+    assert len(geonetwork_server.requests_to("DELETE", "/records")) == 16
+
+
+def test_denied_request_is_not_retried_twice(geonetwork_server):
+    """Is the 403 error raised when the request is still denied after logging in again ?"""
+    session = log_in()
+    geonetwork_server.require_session = True
+
+    class Forgetful(set):
+        def add(self, session):
+            pass
+
+    geonetwork_server.sessions = Forgetful()
+
+    with pytest.raises(requests.HTTPError):
+        dataset.delete(["uuid"], session)
+    assert len(geonetwork_server.requests_to("DELETE", "/records")) == 2
+
+
+# ===
+# Retries
+
+
+def test_upload_is_retried_on_transient_errors(geonetwork_server):
+    """Is an upload sent again after 503 errors, until it succeeds ?"""
+    session = log_in(retry_policy=RetryPolicy(retries=3, backoff=0))
+    geonetwork_server.unavailable = 2
+
+    response = dataset.upload(helpers.read_xml_file(sample_record), session)
+
+    assert response.status_code == 201
+    assert len(geonetwork_server.requests_to("PUT", "/records")) == 3
+
+
+def test_retries_give_up_after_the_policy_limit(geonetwork_server):
+    """Is the last error raised once all retries failed ?"""
+    session = log_in(retry_policy=RetryPolicy(retries=1, backoff=0))
+    geonetwork_server.unavailable = 5
+
+    with pytest.raises(requests.HTTPError):
+        dataset.delete(["uuid"], session)
+    assert len(geonetwork_server.requests_to("DELETE", "/records")) == 2
+
+
+def test_batch_edits_are_not_retried_by_default(geonetwork_server):
+    """Is a batch edit, which may add an element twice, sent only once ?"""
+    session = log_in(retry_policy=RetryPolicy(retries=3, backoff=0))
+    geonetwork_server.unavailable = 1
+
+    with pytest.raises(requests.HTTPError):
+        dataset.update(["uuid"], ".//mri:title", "<mri:title/>", session, "ADD")
+    assert len(geonetwork_server.requests_to("PUT", "/records/batchediting")) == 1
+
+
+def test_bulk_upload_retry_rewinds_the_archive(geonetwork_server, tmp_path):
+    """Is the whole archive sent again when a bulk upload is retried ?"""
+    session = log_in(retry_policy=RetryPolicy(retries=1, backoff=0))
+    geonetwork_server.unavailable = 1
+
+    response = dataset.upload_archive([sample_record], session)
+
+    posts = geonetwork_server.requests_to("POST", "/records")
+    assert len(posts) == 2
+    assert posts[0]["body"] and len(posts[0]["body"]) == len(posts[1]["body"])
+    assert len(dataset.imported_uuids(response.json())) == 1
+
+
+def test_retry_delay_follows_retry_after_then_backoff():
+    """Is Retry-After preferred to the exponential backoff, which is capped ?"""
+    policy = RetryPolicy(backoff=1, max_backoff=5, jitter=False)
+    response = requests.Response()
+    response.headers["Retry-After"] = "2"
+
+    assert policy.delay(0, response) == 2
+    assert [policy.delay(attempt) for attempt in range(4)] == [1, 2, 4, 5]
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0
+    assert parse_retry_after("soon") is None
+
+
+def test_rate_limiter_is_shared_between_threads():
+    """Do threads sharing a limiter send at most `rate` requests per second after the burst ?"""
+    limiter = RateLimiter(rate=50, burst=5)
+    start = time.monotonic()
+
+    threads = [threading.Thread(target=lambda: [limiter.acquire() for _ in range(5)]) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # 15 requests: 5 in the initial burst, then 10 at 50 per second
+    assert time.monotonic() - start >= 0.18
+
+
+# ===
+# Postponed values
+
+
+def test_postponed_value_edits_replace_links_by_uuid():
+    """Are postponed links replaced where the yaml identifiers were written ?"""
+    postponed = {
+        "uuid": "record_uuid",
+        "associatedResource": [{"value": "atlas_uuid", "typeOfAssociation": "largerWorkCitation"}],
+        "resourceLineage": ["sheet_uuid"],
+    }
+    prior = {
+        "uuid": "record",
+        "associatedResource": [{"value": "atlas", "typeOfAssociation": "largerWorkCitation"}],
+        "resourceLineage": [{"value": "sheet"}],
+    }
+
+    edits = dataset.postponed_value_edits(postponed, prior)
+
+    assert [(e[0], e[3]) for e in edits] == [("record_uuid", "REPLACE")] * 2
+    assert edits[0][1].endswith("[mri:MD_AssociatedResource/mri:metadataReference/@uuidref='atlas']")
+    assert 'uuidref="atlas_uuid"' in edits[0][2]
+    assert edits[1][1:3] == (".//mrl:LI_Lineage/mrl:source[@uuidref='sheet']/@uuidref", "sheet_uuid")
+
+
+def test_accumulator_groups_records_with_identical_edits():
+    """Are records receiving the same edits edited together, and long edit lists split ?"""
+    accumulator = dataset.BatchEditAccumulator(max_edits=2)
+    accumulator.add(["a", "b"], ".//mri:title", "<t/>", "REPLACE")
+    accumulator.add(["a", "b"], ".//mri:abstract", "<a/>", "REPLACE")
+    accumulator.add(["c"], ".//mri:title", "<t/>", "REPLACE")
+    accumulator.add(["c"], ".//mri:abstract", "<a/>", "REPLACE")
+    accumulator.add(["c"], ".//mri:purpose", "<p/>", "ADD")
+
+    requests_ = accumulator.pending_requests()
+
+    assert [(uuids, [e["xpath"] for e in edits]) for uuids, edits in requests_] == [
+        (["a", "b"], [".//mri:title", ".//mri:abstract"]),
+        (["c"], [".//mri:title", ".//mri:abstract"]),
+        (["c"], [".//mri:purpose"]),
+    ]
+    assert requests_[2][1][0]["value"] == "<gn_add><p/></gn_add>"
+
+
+def test_edit_postponed_values_sends_one_request_per_record(geonetwork_server):
+    """Are all the postponed links of the records fixed with one batch edit request per record ?"""
+    session = log_in()
+    accumulator = dataset.BatchEditAccumulator(session)
+    for record in ("first", "second"):
+        postponed = {"uuid": f"{record}_uuid", "resourceLineage": [f"{record}_sheet_uuid", f"{record}_map_uuid"]}
+        prior = {"uuid": record, "resourceLineage": [{"value": f"{record}_sheet"}, {"value": f"{record}_map"}]}
+        dataset.edit_postponed_values(postponed, prior, accumulator=accumulator)
+
+    responses = accumulator.flush()
+
+    batchedits = geonetwork_server.requests_to("PUT", "/records/batchediting")
+    assert len(responses) == len(batchedits) == 2
+    assert [b["query"]["uuids"] for b in batchedits] == [["first_uuid"], ["second_uuid"]]
+    assert all(len(json.loads(b["body"])) == 2 for b in batchedits)
+    assert len(accumulator) == 0
+
+
+# ===
+# Search
+
+
+def test_search_pages_through_all_hits(geonetwork_server):
+    """Are all the hits yielded, each page after the first one starting after the last hit of the previous one ?"""
+    session = log_in()
+    geonetwork_server.records.update({f"uuid_{i:02d}": b"<record>Verniquet</record>" for i in range(7)})
+    geonetwork_server.records["other"] = b"<record>Jacoubet</record>"
+
+    hits = dataset.search({"query_string": {"query": "Verniquet"}}, page_size=3, session=session)
+
+    assert [dataset.hit_uuid(hit) for hit in hits] == [f"uuid_{i:02d}" for i in range(7)]
+    searches = [json.loads(r["body"]) for r in geonetwork_server.requests_to("POST", "/search/records/_search")]
+    assert [body.get("search_after") for body in searches] == [None, ["uuid_02"], ["uuid_05"]]
+    assert all(body["_source"] == {"includes": ["uuid"]} and body["size"] == 3 for body in searches)
+    assert all(body["sort"] == [{"uuid": "asc"}] for body in searches)
+
+
+def test_search_is_lazy(geonetwork_server):
+    """Is no more than the next page requested while the first hits are consumed ?"""
+    session = log_in()
+    geonetwork_server.records.update({f"uuid_{i:02d}": b"<record/>" for i in range(10)})
+
+    hits = dataset.search(page_size=2, session=session)
+    next(hits)
+    next(hits)
+    hits.close()
+
+    assert len(geonetwork_server.requests_to("POST", "/search/records/_search")) <= 2
+
+
+# ===
+# Bulk upload
+
+
+def test_archive_chunks_bound_records_and_bytes(tmp_path):
+    """Are chunks limited both in number of records and in bytes, oversized files going alone ?"""
+    sizes = [10, 10, 10, 50, 10, 10]
+    files = []
+    for index, size in enumerate(sizes):
+        path = tmp_path / f"{index}.xml"
+        path.write_bytes(b"x" * size)
+        files.append(path)
+
+    chunks = list(dataset.archive_chunks(files, lambda path: path, max_records=2, max_bytes=25))
+
+    assert [[path.name for path in chunk] for chunk in chunks] == [
+        ["0.xml", "1.xml"], ["2.xml"], ["3.xml"], ["4.xml", "5.xml"]
+    ]
+
+
+def test_mef_archive_holds_one_metadata_file_per_record(tmp_path):
+    """Is each xml file copied as is under its own metadata folder ?"""
+    files = []
+    for index in range(3):
+        path = tmp_path / f"record_{index}.xml"
+        path.write_text(f"<record>{index}</record>", encoding="utf8")
+        files.append(path)
+
+    archive_file = tmp_path / "records.zip"
+    with open(archive_file, "wb") as fileobj:
+        dataset.write_mef_archive(files, fileobj)
+
+    with zipfile.ZipFile(archive_file) as archive:
+        names = archive.namelist()
+        assert len(names) == 3
+        assert all(name.endswith("/metadata/metadata.xml") for name in names)
+        assert [archive.read(name) for name in names] == [path.read_bytes() for path in files]
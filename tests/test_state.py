@@ -0,0 +1,83 @@
+"""Tests for the state module
+"""
+
+import csv
+import json
+
+from soduco_geonetwork.api_wrapper import helpers
+from soduco_geonetwork.api_wrapper.state import CSV_FIELDS, StateStore
+
+
+def write_csv(path, rows):
+    with open(path, "w", newline="", encoding="utf8") as file:
+        writer = csv.DictWriter(file, fieldnames=CSV_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def read_csv(path):
+    with open(path, encoding="utf8") as file:
+        return list(csv.DictReader(file))
+
+
+def record(identifier, geonetwork_uuid, associated=(), lineage=()):
+    postponed_values = {"uuid": identifier}
+    if associated:
+        postponed_values["associatedResource"] = [
+            {"value": value, "typeOfAssociation": "largerWorkCitation"} for value in associated
+        ]
+    if lineage:
+        postponed_values["resourceLineage"] = [{"value": value} for value in lineage]
+    return {
+        "yaml_identifier": identifier,
+        "geonetwork_uuid": geonetwork_uuid,
+        "xml_file_path": f"{identifier}.xml",
+        "postponed_values": json.dumps(postponed_values),
+    }
+
+
+def sample_rows():
+    return [
+        record("atlas", "atlas_uuid"),
+        record("sheet_1", "sheet_1_uuid", associated=["atlas"], lineage=["scan_1", "scan_2"]),
+        record("sheet_2", "", associated=["atlas"]),
+        record("scan_1", "scan_1_uuid"),
+    ]
+
+
+def test_csv_round_trip(tmp_path):
+    """Are the rows of a csv file exported as they were imported ?"""
+    write_csv(tmp_path / "yaml_list.csv", sample_rows())
+
+    with StateStore(str(tmp_path / "state.sqlite")) as store:
+        assert store.import_csv(tmp_path / "yaml_list.csv") == 4
+    with StateStore(str(tmp_path / "state.sqlite")) as store:
+        store.export_csv(tmp_path / "export.csv")
+
+    assert read_csv(tmp_path / "export.csv") == sample_rows()
+
+
+def test_references_are_resolved_like_replace_uuid(tmp_path):
+    """Are postponed references replaced by geonetwork uuids, unknown ones by null ?"""
+    write_csv(tmp_path / "yaml_list.csv", sample_rows())
+
+    helpers.replace_uuid(tmp_path / "yaml_list.csv", tmp_path / "resolved.csv")
+
+    rows = read_csv(tmp_path / "resolved.csv")
+    postponed_values = [json.loads(row["postponed_values"]) for row in rows]
+    assert postponed_values[1] == {
+        "uuid": "sheet_1_uuid",
+        "associatedResource": [{"value": "atlas_uuid", "typeOfAssociation": "largerWorkCitation"}],
+        "resourceLineage": ["scan_1_uuid", None],
+    }
+    assert postponed_values[2]["uuid"] == ""
+    assert [row["geonetwork_uuid"] for row in rows] == ["atlas_uuid", "sheet_1_uuid", "", "scan_1_uuid"]
+
+
+def test_status_and_unresolved_references():
+    """Are records counted by status and references to unpublished records listed ?"""
+    with StateStore() as store:
+        for row in sample_rows():
+            store.add_record(row)
+        assert store.status_counts() == {"published": 3, "built": 1}
+        assert list(store.unresolved_references()) == [("sheet_1", "scan_2")]
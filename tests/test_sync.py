@@ -0,0 +1,46 @@
+"""Tests for the sync module
+"""
+
+from soduco_geonetwork.api_wrapper import sync
+
+
+def test_canonical_hash_ignores_formatting(tmp_path):
+    """Do formatting changes keep the hash while content changes alter it ?"""
+    compact = b'<a xmlns="urn:a" y="2" x="1"><b>text</b></a>'
+    indented = b'<?xml version="1.0"?>\n<a x="1" y="2" xmlns="urn:a">\n  <b> text </b>\n  <!-- note -->\n</a>\n'
+    changed = b'<a xmlns="urn:a" y="2" x="1"><b>other</b></a>'
+    xml_file = tmp_path / "record.xml"
+    xml_file.write_bytes(indented)
+
+    assert sync.canonical_hash(compact) == sync.canonical_hash(indented) == sync.canonical_hash(xml_file)
+    assert sync.canonical_hash(compact) != sync.canonical_hash(changed)
+
+
+def test_canonical_hash_leaves_out_ignored_elements():
+    """Are ignored elements, such as those rewritten by the server, left out of the hash ?"""
+    mdb = "http://standards.iso.org/iso/19115/-3/mdb/2.0"
+    built = f'<mdb:MD_Metadata xmlns:mdb="{mdb}"><mdb:contact/></mdb:MD_Metadata>'.encode()
+    published = f'<mdb:MD_Metadata xmlns:mdb="{mdb}"><mdb:contact/><mdb:dateInfo>now</mdb:dateInfo></mdb:MD_Metadata>'
+
+    assert sync.canonical_hash(built) != sync.canonical_hash(published.encode())
+    assert sync.canonical_hash(built, ["mdb:dateInfo"]) == sync.canonical_hash(published.encode(), ["mdb:dateInfo"])
+
+
+def test_plan_sync_sorts_records(tmp_path):
+    """Are records sorted as new, changed, unchanged or removed against the state or the remote copies ?"""
+    rows = [{"yaml_identifier": identifier} for identifier in ("kept", "edited", "added")]
+    hashes = {"kept": "h1", "edited": "h2", "added": "h3"}
+    state = {
+        identifier: {"yaml_identifier": identifier, "geonetwork_uuid": f"{identifier}_uuid", "xml_hash": xml_hash}
+        for identifier, xml_hash in (("kept", "h1"), ("edited", "old"), ("dropped", "h4"))
+    }
+    state_file = tmp_path / "published.csv"
+    sync.write_state(state_file, state)
+
+    plan = sync.plan_sync(rows, hashes, sync.read_state(state_file))
+
+    assert [[row["yaml_identifier"] for row in rows] for rows in plan] == [["added"], ["edited"], ["kept"], ["dropped"]]
+
+    plan = sync.plan_sync(rows, hashes, state, remote_hashes={"kept": "h1", "edited": "h2", "added": None})
+
+    assert [[row["yaml_identifier"] for row in rows] for rows in plan] == [["added"], [], ["kept", "edited"], ["dropped"]]
@@ -0,0 +1,326 @@
+"""Tests for the xml_composers module
+"""
+
+import os
+import warnings
+
+import pytest
+import yaml
+
+from soduco_geonetwork.api_wrapper import xml_composers
+
+
+# ===
+# Resources
+sample_records = os.path.dirname(__file__) + "/fixtures/instance.yaml"
+
+
+def load_sample_record() -> dict:
+    with open(sample_records, encoding="utf8") as yaml_file:
+        return yaml.safe_load(yaml_file)
+
+
+def to_text(element) -> str:
+    return xml_composers.ET.tostring(element, encoding="unicode")
+
+
+# ===
+# Template cache
+
+
+def test_template_cache_counts_hits_and_misses():
+    """Is a composer template parsed once and then served from the cache ?"""
+    xml_composers.XMLComposer.clear_template_cache()
+
+    xml_composers.Abstract("first")
+    xml_composers.Abstract("second")
+
+    info = xml_composers.XMLComposer.template_cache_info()
+    assert info.misses == 1
+    assert info.hits == 1
+    assert info.currsize == 1
+
+
+def test_template_cache_hands_out_independent_copies():
+    """Does composing an element leave the cached template untouched ?"""
+    first = xml_composers.Abstract("first")
+    second = xml_composers.Abstract("second")
+
+    assert "first" in to_text(first.compose())
+    assert first.xml_element is not second.xml_element
+    assert "first" not in to_text(xml_composers.Abstract.get_template())
+
+
+def test_warm_template_cache_loads_every_composer():
+    """Does warming the cache load the template of every composer class ?"""
+    xml_composers.XMLComposer.clear_template_cache()
+
+    info = xml_composers.XMLComposer.warm_template_cache()
+
+    assert info.currsize == len(xml_composers.registered_composers())
+    assert info.hits == 0
+
+
+def test_cached_templates_build_identical_records():
+    """Does a warm cache produce the same record as a cold one ?"""
+    record = load_sample_record()
+
+    xml_composers.XMLComposer.clear_template_cache()
+    cold = xml_composers.RecordDocumentBuilder().process_data_tree(record).build()
+    warm = xml_composers.RecordDocumentBuilder().process_data_tree(record).build()
+
+    assert xml_composers.ET.tostring(cold) == xml_composers.ET.tostring(warm)
+    assert xml_composers.XMLComposer.template_cache_info().hits > 0
+
+
+# ===
+# Compiled XPath expressions
+
+
+def test_composer_xpaths_are_compiled_at_class_definition():
+    """Does every composer hold a compiled XPath for each of its insertion points ?"""
+    for composer_cls in xml_composers.registered_composers():
+        assert composer_cls._insertion_xpaths.keys() == composer_cls.insertion_points.keys()
+        assert isinstance(composer_cls._parent_xpath, xml_composers.ET.XPath)
+
+
+def test_before_anchor_inserts_process_step_source_first():
+    """Are ProcessStepSource elements inserted before the processing information ?"""
+    builder = xml_composers.RecordDocumentBuilder().process_data_tree(
+        {
+            "identifier": "lineage",
+            "processStep": {
+                "description": "georeferencing",
+                "title": "title",
+                "processingIdentifier": "id",
+                "typeOfActivity": "activity",
+                "softwareTitle": "software",
+                "softwareIdentifier": "software_id",
+                "processStepSource": {
+                    "description": "scan",
+                    "title": "scan",
+                    "identifier": "scan_id",
+                    "url": "https://example.org",
+                },
+            },
+        }
+    )
+    step = builder.build().find(".//mrl:LE_ProcessStep", namespaces=xml_composers.NAMESPACES)
+
+    tags = [xml_composers.ET.QName(child).localname for child in step]
+    assert tags.index("source") < tags.index("processingInformation")
+
+
+# ===
+# Document templates
+
+
+def test_document_template_is_parsed_once_and_copied(tmp_path):
+    """Do builders receive independent copies of a single parsed template ?"""
+    template = tmp_path / "record.xml"
+    template.write_text("<record><title/></record>", encoding="utf8")
+    registry = xml_composers.DocumentTemplateRegistry().register("record", str(template))
+
+    first = registry.get("record")
+    first.getroot().find("title").text = "modified"
+    second = registry.get(str(template))
+
+    assert second.getroot().find("title").text is None
+    assert len(registry._trees) == 1
+
+
+def test_document_template_is_reloaded_when_modified(tmp_path):
+    """Does editing a template file invalidate the cached tree ?"""
+    template = tmp_path / "record.xml"
+    template.write_text("<record/>", encoding="utf8")
+    registry = xml_composers.DocumentTemplateRegistry()
+    assert registry.get(str(template)).getroot().tag == "record"
+
+    template.write_text("<service/>", encoding="utf8")
+    stat = os.stat(template)
+    os.utime(template, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+    assert registry.get(str(template)).getroot().tag == "service"
+
+
+def test_builder_uses_named_document_template():
+    """Can a builder start from a template registered by name ?"""
+    builder = xml_composers.RecordDocumentBuilder("dataset")
+    assert xml_composers.ET.QName(builder.get().getroot()).localname == "MD_Metadata"
+
+
+# ===
+# Data tree traversal
+
+
+def test_process_data_tree_keeps_composer_order():
+    """Are composers registered in the depth-first order of the data tree ?"""
+    builder = xml_composers.RecordDocumentBuilder().process_data_tree(load_sample_record())
+
+    names = [type(composer).__name__ for composer in builder._composers]
+    assert names == [
+        "Identifier",
+        "Identification",
+        "Events",
+        "Events",
+        "Events",
+        "PresentationForm",
+        "Extent",
+        "GeoExtent",
+        "TemporalExtent",
+        "Keywords",
+        "Keywords",
+        "Keywords",
+        "AssociatedResource",
+        "DistributionInfo",
+        "DistributionFormat",
+        "OnlineResources",
+        "ResourceLineage",
+        "Individuals",
+        "Organisations",
+        "Organisations",
+        "Organisations",
+        "Overview",
+    ]
+    keywords = [c.parameters["keyword"] for c in builder._composers if isinstance(c, xml_composers.Keywords)]
+    assert keywords == ["Instanciation", "Paris", "Verniquet"]
+
+
+# ===
+# Composer registry
+
+
+def test_registry_maps_keys_in_both_cases():
+    """Are composers registered with a lowercase and an uppercase first letter ?"""
+    assert xml_composers.lookup_composer("onlineResources") is xml_composers.OnlineResources
+    assert xml_composers.lookup_composer("OnlineResources") is xml_composers.OnlineResources
+
+
+def test_subclass_registers_aliases():
+    """Does defining a composer with aliases register it for each alias ?"""
+
+    class ProjectAbstract(xml_composers.Abstract):
+        aliases = ("summary",)
+
+    try:
+        assert xml_composers.lookup_composer("summary") is ProjectAbstract
+        assert xml_composers.lookup_composer("projectAbstract") is ProjectAbstract
+    finally:
+        for key in ("summary", "ProjectAbstract", "projectAbstract"):
+            del xml_composers._composer_registry[key]
+
+
+def test_unknown_key_warns_once():
+    """Is a warning emitted only the first time an unknown key is looked up ?"""
+    with pytest.warns(UserWarning, match="unknownElement"):
+        assert xml_composers.lookup_composer("unknownElement") is None
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        assert xml_composers.lookup_composer("unknownElement") is None
+
+
+def test_composer_plugins_are_loaded_from_entry_points(monkeypatch):
+    """Are composers declared in the entry point group registered under the entry point name ?"""
+
+    class PluginComposer(xml_composers.Abstract, register=False):
+        pass
+
+    class EntryPoint:
+        name = "pluginElement"
+
+        def load(self):
+            return PluginComposer
+
+    monkeypatch.setattr(
+        xml_composers.importlib.metadata, "entry_points", lambda group: [EntryPoint()]
+    )
+    monkeypatch.setattr(xml_composers, "_plugins_loaded", False)
+    monkeypatch.setattr(xml_composers, "_composer_registry", dict(xml_composers._composer_registry))
+
+    assert xml_composers.lookup_composer("pluginElement") is PluginComposer
+
+
+def test_plugin_composers_use_their_own_partials(monkeypatch, tmp_path):
+    """Is a plugin composer built from the partial of its own folder, and skipped by warm-up without one ?"""
+    (tmp_path / "plugincomposer.xml").write_text(
+        "<mri:abstract><gco:CharacterString>{VALUE_ABSTRACT}</gco:CharacterString></mri:abstract>"
+    )
+
+    class PluginComposer(xml_composers.Abstract, register=False):
+        partials_folder = str(tmp_path)
+
+    class MissingPartialComposer(xml_composers.Abstract, register=False):
+        pass
+
+    class EntryPoint:
+        def __init__(self, name, composer_cls):
+            self.name = name
+            self.composer_cls = composer_cls
+
+        def load(self):
+            return self.composer_cls
+
+    monkeypatch.setattr(
+        xml_composers.importlib.metadata, "entry_points",
+        lambda group: [EntryPoint("pluginElement", PluginComposer),
+                       EntryPoint("missingElement", MissingPartialComposer)],
+    )
+    monkeypatch.setattr(xml_composers, "_plugins_loaded", False)
+    monkeypatch.setattr(xml_composers, "_composer_registry", dict(xml_composers._composer_registry))
+    xml_composers.XMLComposer.clear_template_cache()
+
+    info = xml_composers.XMLComposer.warm_template_cache()
+
+    assert info.currsize == len(xml_composers.registered_composers()) - 1
+    assert MissingPartialComposer.template_path() == os.path.join(
+        os.path.dirname(__file__), "partials", "missingpartialcomposer.xml"
+    )
+    composer = xml_composers.lookup_composer("pluginElement")("plugin abstract")
+    assert "plugin abstract" in to_text(composer.compose())
+    with pytest.raises(ValueError, match="Empty XML template"):
+        MissingPartialComposer("no partial")
+
+
+# ===
+# Local reference resolution
+
+
+def lineage_record() -> dict:
+    return {
+        "identifier": "sheet_2",
+        "associatedResource": [
+            {"value": "atlas", "typeOfAssociation": "largerWorkCitation"},
+        ],
+        "resourceLineage": ["sheet_1", "2ba09c9a-8007-4e7f-b89a-50d55659a6c4"],
+    }
+
+
+def test_references_are_deferred_by_default():
+    """Are references by yaml identifier left for processing after the upload ?"""
+    builder = xml_composers.RecordDocumentBuilder().process_data_tree(lineage_record())
+    builder.build()
+
+    assert builder.deferred_processing["associatedResource"][0]["value"] == "atlas"
+    assert builder.deferred_processing["resourceLineage"] == [{"value": "sheet_1"}]
+
+
+def test_references_are_resolved_to_record_uuids():
+    """Are references resolved to the uuids the referenced records get from their identifier ?"""
+    builder = xml_composers.RecordDocumentBuilder(resolve_references=True)
+    record_doc = builder.process_data_tree(lineage_record()).build()
+
+    assert dict(builder.deferred_processing) == {"uuid": "sheet_2"}
+    assert builder.references == ["atlas", "sheet_1"]
+    uuidrefs = record_doc.xpath("//mri:metadataReference/@uuidref | //mrl:source/@uuidref",
+                                namespaces=xml_composers.NAMESPACES)
+    assert uuidrefs == [
+        xml_composers.record_uuid("atlas"),
+        xml_composers.record_uuid("sheet_1"),
+        "2ba09c9a-8007-4e7f-b89a-50d55659a6c4",
+    ]
+
+    referenced = xml_composers.RecordDocumentBuilder().process_data_tree({"identifier": "atlas"}).build()
+    code = referenced.findtext(".//mdb:metadataIdentifier//mcc:code/gco:CharacterString",
+                               namespaces=xml_composers.NAMESPACES)
+    assert code == xml_composers.record_uuid("atlas")
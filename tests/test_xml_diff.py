@@ -0,0 +1,140 @@
+"""Tests for the xml_diff module
+"""
+
+import copy
+import os
+
+import pytest
+import yaml
+
+from soduco_geonetwork.api_wrapper import dataset, geonetwork, xml_composers, xml_diff
+from soduco_geonetwork.api_wrapper.client import GeoNetworkClient
+from soduco_geonetwork.api_wrapper.sync import canonical_hash
+
+from .conftest import apply_edits
+
+
+# ===
+# Resources
+sample_records = os.path.dirname(__file__) + "/fixtures/instance.yaml"
+
+
+def load_sample_record() -> dict:
+    with open(sample_records, encoding="utf8") as yaml_file:
+        return yaml.safe_load(yaml_file)
+
+
+def build(record: dict) -> bytes:
+    tree = xml_composers.RecordDocumentBuilder().process_data_tree(record).build()
+    return xml_composers.ET.tostring(tree)
+
+
+def with_online_resource(record: dict) -> dict:
+    record = copy.deepcopy(record)
+    record["distributionInfo"]["onlineResources"].append({
+        "linkage": "https://map.geohistoricaldata.org/mapproxy/service=WMS?REQUEST=GetCapabilities",
+        "protocol": "OGC:WMS",
+        "name": "verniquet",
+        "onlineFunctionCode": "browsing",
+    })
+    return record
+
+
+# ===
+# Diff
+
+
+def test_diff_adds_a_new_element_only():
+    """Is an extra online resource added with a single edit that rebuilds the new record ?"""
+    published = build(load_sample_record())
+    built = build(with_online_resource(load_sample_record()))
+
+    edits = xml_diff.diff(published, built)
+
+    assert [edit.mode for edit in edits] == ["ADD"]
+    assert edits[0].xpath.startswith("/mdb:MD_Metadata/mdb:distributionInfo[1]/")
+    assert "OGC:WMS" in edits[0].value
+    assert canonical_hash(apply_edits(published, xml_diff_payload(edits))) == canonical_hash(built)
+
+
+def test_diff_replaces_changed_elements_and_deletes_from_the_end():
+    """Are changed values replaced and removed siblings deleted, last one first ?"""
+    record = load_sample_record()
+    published = build(record)
+    record["identification"]["title"] = "Another title"
+    record["keywords"] = record["keywords"][:1]
+    built = build(record)
+
+    edits = xml_diff.diff(published, built)
+
+    assert "REPLACE" in [edit.mode for edit in edits]
+    deletions = [edit.xpath for edit in edits if edit.mode == "DELETE"]
+    assert deletions == sorted(deletions, reverse=True)
+    assert canonical_hash(apply_edits(published, xml_diff_payload(edits))) == canonical_hash(built)
+
+
+def test_diff_keeps_the_order_of_an_element_inserted_between_siblings():
+    """Is an extra keyword, followed by other elements of its parent, not appended after them ?"""
+    record = load_sample_record()
+    published = build(record)
+    record["keywords"].append({"value": "Atlas", "typeOfKeyword": "theme"})
+    built = build(record)
+
+    edits = xml_diff.diff(published, built)
+
+    assert "ADD" not in [edit.mode for edit in edits]
+    assert canonical_hash(apply_edits(published, xml_diff_payload(edits))) == canonical_hash(built)
+
+
+def test_diff_of_identical_records_is_empty():
+    record = build(load_sample_record())
+    assert xml_diff.diff(record, record) == []
+
+
+def test_diff_ignores_elements():
+    """Are ignored elements, such as dates updated by the server, left out ?"""
+    record = load_sample_record()
+    published = build(record)
+    record["events"][1]["value"] = "2023-01-01"
+    built = build(record)
+
+    assert xml_diff.diff(published, built)
+    assert xml_diff.diff(published, built, ignore=["cit:date"]) == []
+
+
+def test_diff_rejects_different_roots():
+    with pytest.raises(xml_diff.UnsupportedDiff):
+        xml_diff.diff(b"<a/>", b"<b/>")
+
+
+def xml_diff_payload(edits) -> list:
+    return [dataset.batchedit_edit(edit.xpath, edit.value, edit.mode) for edit in edits]
+
+
+# ===
+# Remote update
+
+
+def test_update_record_patches_small_changes_and_uploads_large_ones(geonetwork_server, tmp_path):
+    """Is a small change sent as batch edits and a large one as a new upload of the record ?"""
+    session = geonetwork.log_in("admin", "admin", GeoNetworkClient())
+    record = load_sample_record()
+    xml_file = tmp_path / "record.xml"
+    xml_file.write_bytes(build(record))
+    record_uuid = dataset.record_identifier(xml_file)
+    dataset.upload_file(xml_file, session)
+
+    xml_file.write_bytes(build(with_online_resource(record)))
+    update = dataset.update_record(record_uuid, xml_file, session)
+
+    assert update.method == "patch"
+    assert len(geonetwork_server.requests_to("PUT", "/records/batchediting")) == 1
+    assert canonical_hash(geonetwork_server.records[record_uuid]) == canonical_hash(xml_file)
+    assert dataset.update_record(record_uuid, xml_file, session).method == "unchanged"
+
+    record["keywords"] = [{"value": f"keyword {i}", "typeOfKeyword": "theme"} for i in range(200)]
+    xml_file.write_bytes(build(record))
+    update = dataset.update_record(record_uuid, xml_file, session)
+
+    assert update.method == "upload"
+    assert geonetwork_server.requests_to("PUT", "/records")[-1]["query"]["uuidProcessing"] == ["OVERWRITE"]
@@ -0,0 +1,217 @@
+"""Tests for the yaml_to_xml module
+"""
+
+import csv
+import os
+
+import pytest
+import yaml
+
+from soduco_geonetwork.api_wrapper import yaml_to_xml
+
+
+# ===
+# Resources
+sample_records = os.path.dirname(__file__) + "/fixtures/instance.yaml"
+
+
+def write_multidoc(path, count: int) -> str:
+    """Write `count` copies of the sample record with distinct identifiers in a yaml file"""
+    with open(sample_records, encoding="utf8") as yaml_file:
+        record = yaml.safe_load(yaml_file)
+
+    documents = []
+    for i in range(count):
+        record = dict(record, identifier=f"record_{i}")
+        if i:
+            record["associatedResource"] = [
+                {"value": f"record_{i - 1}", "typeOfAssociation": "crossReference"}
+            ]
+        documents.append(record)
+
+    with open(path, "w", encoding="utf8") as yaml_file:
+        yaml.safe_dump_all(documents, yaml_file, allow_unicode=True)
+    return str(path)
+
+
+def read_csv(path) -> list:
+    with open(path, encoding="utf8") as csv_file:
+        return list(csv.DictReader(csv_file))
+
+
+# ===
+# Parallel parse
+
+
+def test_parallel_parse_matches_serial_parse(tmp_path, monkeypatch):
+    """Does a parse with several jobs produce the same csv and xml files as a serial one ?"""
+    input_file = write_multidoc(tmp_path / "records.yaml", 12)
+    serial, parallel = tmp_path / "serial", tmp_path / "parallel"
+    serial.mkdir()
+    parallel.mkdir()
+
+    monkeypatch.chdir(serial)
+    yaml_to_xml.parse(input_file, str(serial))
+    monkeypatch.chdir(parallel)
+    yaml_to_xml.parse(input_file, str(parallel), jobs=3)
+
+    serial_rows = read_csv(serial / "yaml_list.csv")
+    parallel_rows = read_csv(parallel / "yaml_list.csv")
+    assert [row["yaml_identifier"] for row in serial_rows] == [f"record_{i}" for i in range(12)]
+    for serial_row, parallel_row in zip(serial_rows, parallel_rows):
+        assert parallel_row["yaml_identifier"] == serial_row["yaml_identifier"]
+        assert parallel_row["postponed_values"] == serial_row["postponed_values"]
+        assert parallel_row["xml_file_path"] == serial_row["xml_file_path"].replace("serial", "parallel")
+        with open(serial_row["xml_file_path"], "rb") as s, open(parallel_row["xml_file_path"], "rb") as p:
+            assert s.read() == p.read()
+
+
+# ===
+# Streaming parse
+
+
+def test_build_records_consumes_documents_lazily(tmp_path):
+    """Is a record built before the following yaml documents are read ?"""
+    with open(sample_records, encoding="utf8") as yaml_file:
+        record = yaml.safe_load(yaml_file)
+    read = []
+
+    def documents():
+        for i in range(3):
+            read.append(i)
+            yield dict(record, identifier=f"record_{i}")
+
+    infos = yaml_to_xml.build_records(documents(), str(tmp_path))
+
+    assert next(infos)["identifier"] == "record_0"
+    assert read == [0]
+    assert os.path.exists(tmp_path / "record_0.xml")
+
+
+def test_parse_empty_file_writes_csv_header(tmp_path, monkeypatch):
+    """Does parsing a yaml file without documents write a csv with only its header ?"""
+    input_file = tmp_path / "empty.yaml"
+    input_file.write_text("", encoding="utf8")
+    monkeypatch.chdir(tmp_path)
+
+    yaml_to_xml.parse(str(input_file), str(tmp_path))
+
+    assert read_csv(tmp_path / "yaml_list.csv") == []
+
+
+# ===
+# Yaml document cache
+
+
+def test_split_yaml_documents_matches_load_all():
+    """Does splitting a yaml stream give the same documents as yaml.load_all ?"""
+    source = (
+        "# leading comment\n"
+        "%YAML 1.1\n"
+        "---\n"
+        "identifier: first\n"
+        "abstract: |\n"
+        "    --- not a marker when indented\n"
+        "...\n"
+        "--- {identifier: second}\n"
+        "---\n"
+        "identifier: third\n"
+        "# trailing comment\n"
+    )
+
+    sources = list(yaml_to_xml.split_yaml_documents(source.splitlines(keepends=True)))
+
+    assert len(sources) == 3
+    assert [yaml.safe_load(s) for s in sources] == list(yaml.safe_load_all(source))
+
+
+def test_yaml_cache_skips_unchanged_documents(tmp_path):
+    """Are documents parsed only when their source text changed since the previous run ?"""
+    input_file = write_multidoc(tmp_path / "records.yaml", 3)
+    cache_folder = str(tmp_path / "cache")
+
+    with open(input_file, encoding="utf8") as stream:
+        expected = list(yaml.safe_load_all(stream))
+
+    first = yaml_to_xml.YamlDocumentCache(cache_folder)
+    with open(input_file, encoding="utf8") as stream:
+        assert list(first.load_all(stream)) == expected
+    assert (first.hits, first.misses) == (0, 3)
+
+    with open(input_file, encoding="utf8") as stream:
+        edited = stream.read().replace("identifier: record_2", "identifier: record_two")
+    with open(input_file, "w", encoding="utf8") as stream:
+        stream.write(edited)
+
+    second = yaml_to_xml.YamlDocumentCache(cache_folder)
+    with open(input_file, encoding="utf8") as stream:
+        documents = list(second.load_all(stream))
+    assert (second.hits, second.misses) == (2, 1)
+    assert documents[2]["identifier"] == "record_two"
+
+
+# ===
+# Incremental parse
+
+
+def test_incremental_parse_only_rebuilds_changed_records(tmp_path, monkeypatch):
+    """Are unchanged records skipped, edited ones rebuilt and deleted ones removed ?"""
+    input_file = write_multidoc(tmp_path / "records.yaml", 4)
+    output_folder = tmp_path / "xml"
+    output_folder.mkdir()
+    monkeypatch.chdir(tmp_path)
+
+    report = yaml_to_xml.parse(input_file, str(output_folder), incremental=True)
+    assert report == yaml_to_xml.ParseReport(rebuilt=4, skipped=0, removed=0)
+    full_rows = read_csv(tmp_path / "yaml_list.csv")
+
+    report = yaml_to_xml.parse(input_file, str(output_folder), incremental=True)
+    assert report == yaml_to_xml.ParseReport(rebuilt=0, skipped=4, removed=0)
+    assert read_csv(tmp_path / "yaml_list.csv") == full_rows
+
+    with open(input_file, encoding="utf8") as stream:
+        documents = list(yaml.safe_load_all(stream))
+    documents[1]["identification"]["title"] = "Edited title"
+    del documents[3]
+    with open(input_file, "w", encoding="utf8") as stream:
+        yaml.safe_dump_all(documents, stream, allow_unicode=True)
+
+    report = yaml_to_xml.parse(input_file, str(output_folder), incremental=True)
+    assert report == yaml_to_xml.ParseReport(rebuilt=1, skipped=2, removed=1)
+    assert read_csv(tmp_path / "yaml_list.csv") == full_rows[:3]
+    assert "Edited title" in (output_folder / "record_1.xml").read_text(encoding="utf8")
+    assert not (output_folder / "record_3.xml").exists()
+
+
+def test_incremental_parse_rebuilds_missing_xml_files(tmp_path, monkeypatch):
+    """Is a record rebuilt when its xml file was deleted ?"""
+    input_file = write_multidoc(tmp_path / "records.yaml", 2)
+    monkeypatch.chdir(tmp_path)
+
+    yaml_to_xml.parse(input_file, str(tmp_path), incremental=True)
+    os.unlink(tmp_path / "record_0.xml")
+
+    report = yaml_to_xml.parse(input_file, str(tmp_path), incremental=True, jobs=2)
+    assert report == yaml_to_xml.ParseReport(rebuilt=1, skipped=1, removed=0)
+    assert (tmp_path / "record_0.xml").exists()
+
+
+# ===
+# Reference resolution
+
+
+def test_references_to_missing_records_are_reported(tmp_path, monkeypatch):
+    """Is a reference to an identifier missing from the yaml file reported, also when its record is skipped ?"""
+    input_file = write_multidoc(tmp_path / "records.yaml", 3)
+    with open(input_file, encoding="utf8") as stream:
+        documents = list(yaml.safe_load_all(stream))
+    documents[2]["associatedResource"][0]["value"] = "recrod_1"
+    with open(input_file, "w", encoding="utf8") as stream:
+        yaml.safe_dump_all(documents, stream, allow_unicode=True)
+    monkeypatch.chdir(tmp_path)
+
+    for skipped in (0, 3):
+        with pytest.warns(UserWarning, match="`record_2` references `recrod_1`"):
+            report = yaml_to_xml.parse(input_file, str(tmp_path), incremental=True, resolve_references=True)
+        assert report.skipped == skipped
+        assert report.unresolved == (("record_2", "recrod_1"),)